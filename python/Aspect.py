@@ -24,13 +24,39 @@
 #
 
 import Config
-import Action
 import Semaphore
 import Light
 import Log
+import WS281
+import Head
+
+# Aspects are compiled once per distinct aspect string.  Rule files repeat
+# the same aspect commands many times, e.g. "semaphore head-id:1 angle:0",
+# so each single command is also compiled once.  Compiled commands are
+# compact action tuples:
+#   (Aspect.c_light, head_id, light, color_index, flashing)
+#   (Aspect.c_semaphore, head_id, semaphore, angle, False)
+#   (Aspect.c_number_plate, None, None, present, False)
+# Call ClearCache() after loading the rules to release the caches.
 
 class Aspect:
 
+    # Kinds of action tuples
+    c_light = 0
+    c_semaphore = 1
+    c_number_plate = 2
+
+    # Compiled Aspects by normalized aspect string.  None marks an Aspect
+    # that does not match this signal's configuration.
+    c_cache = dict()
+
+    # Compiled action tuples by normalized single command.  None marks a
+    # command that does not match, or is invalid.
+    c_command_cache = dict()
+
+    # Interned tokens, so equal strings share one object
+    c_intern = dict()
+
     # Create a new Aspect
     # @param p_aspect_commands A string of aspect commands
     # @param p_config Reference to the Config object
@@ -41,8 +67,8 @@ class Aspect:
         self.m_config = p_config
 
         # Make parsing easier by converting to lower case
-        self.m_aspect_commands = p_aspect_commands.lower()
-        self.m_action_list = list()
+        self.m_aspect_commands = Aspect.Normalize(p_aspect_commands)
+        self.m_actions = ()
 
         # Criteria that must match Config
         self.m_head_list = list()
@@ -50,26 +76,149 @@ class Aspect:
 
         self.m_valid_config = False
 
+        # Target state of every fixture, compiled when the Aspect is valid
+        # light_targets: tuple of (light, color_index, flashing)
+        # semaphore_targets: tuple of (semaphore, angle)
+        self.m_light_targets = ()
+        self.m_semaphore_targets = ()
+
+
+    # Compile an aspect string, or reuse an earlier compilation of the
+    # same string
+    # @param p_aspect_commands A string of aspect commands
+    # @param p_config Reference to the Config object
+    # @param p_log Reference to the Log object
+    # @returns The Aspect, or None if it does not match the Config
+    #
+    @classmethod
+    def Compile(p_class, p_aspect_commands, p_config, p_log):
+        key = p_class.Normalize(p_aspect_commands)
+        if key in p_class.c_cache:
+            return p_class.c_cache[key]
+        aspect = Aspect(key, p_config, p_log)
+        if not aspect.eval():
+            aspect = None
+        p_class.c_cache[key] = aspect
+        return aspect
+
+
+    # Rebuild an Aspect saved with to_list() in the compiled rules cache
+    # @param p_action_list The saved list of actions
+    # @param p_config Reference to the Config object
+    # @param p_log Reference to the Log object
+    # @returns The Aspect
+    #
+    @classmethod
+    def FromList(p_class, p_action_list, p_config, p_log):
+        aspect = Aspect("", p_config, p_log)
+        actions = list()
+        for (kind, head_id, index, value, flashing) in p_action_list:
+            if kind == p_class.c_light:
+                fixture = Light.Light.c_light_list[index]
+            else:
+                fixture = Semaphore.Semaphore.c_semaphore_list[index]
+            actions.append((kind, head_id, fixture, value, flashing))
+        aspect.m_actions = tuple(actions)
+        aspect.m_valid_config = True
+        aspect.compile_targets()
+        return aspect
+
+
+    # @returns The actions as a list for the compiled rules cache, with
+    #          each light or semaphore replaced by its index in the class
+    #          list.  Valid only for the same Config.
+    #
+    def to_list(self):
+        out = list()
+        for (kind, head_id, fixture, value, flashing) in self.m_actions:
+            if kind == Aspect.c_light:
+                index = Light.Light.c_light_list.index(fixture)
+            else:
+                index = Semaphore.Semaphore.c_semaphore_list.index(fixture)
+            out.append([kind, head_id, index, value, flashing])
+        return out
+
+
+    # Release the compiler caches.  The compiled Aspects remain in use by
+    # the Rules.
+    #
+    @classmethod
+    def ClearCache(p_class):
+        p_class.c_cache = dict()
+        p_class.c_command_cache = dict()
+        p_class.c_intern = dict()
+
+
+    # @param p_str A string
+    # @returns The interned copy of p_str
+    #
+    @classmethod
+    def Intern(p_class, p_str):
+        interned = p_class.c_intern.get(p_str)
+        if interned is None:
+            p_class.c_intern[p_str] = p_str
+            interned = p_str
+        return interned
+
+
+    # Convert an aspect string to lower case with single spaces between
+    # words, no space after ':', and no spaces around the ';' separators
+    # @param p_aspect_commands A string of aspect commands
+    # @returns The normalized, interned string
+    #
+    @classmethod
+    def Normalize(p_class, p_aspect_commands):
+        cmds = list()
+        for cmd in p_aspect_commands.lower().split(';'):
+            # Also accept a space after the ':' of an argument
+            cmds.append(" ".join(cmd.split()).replace(": ", ":"))
+        return p_class.Intern(";".join(cmds))
+
 
     # Evaluate the aspect string. Save the condition results,
     # but do not execute the actions.
     # @returns True on success, False on evaluation error
     #
     def eval(self):
-        aspect_cmds = self.m_aspect_commands.split(';')
-        for aspect_cmd in aspect_cmds:
-            if not self.eval_single_aspect(aspect_cmd):
+        actions = list()
+        for aspect_cmd in self.m_aspect_commands.split(';'):
+            action = self.compile_single_aspect(aspect_cmd)
+            if action is None:
                 # This Aspect is invalid for the current configuration
                 return False
+            if action[0] == Aspect.c_number_plate:
+                # number-plate is simply used for modifying the rule
+                self.m_number_plate = action[3]
+            else:
+                actions.append(action)
+                if action[1] not in self.m_head_list:
+                    self.m_head_list.append(action[1])
+        self.m_actions = tuple(actions)
 
         # Perform a check on the command results
         self.m_valid_config = self.check_config()
+        if self.m_valid_config:
+            self.compile_targets()
         return self.m_valid_config
 
 
+    # Compile a single aspect command, or reuse an earlier compilation
+    # @p_aspect_cmd A normalized aspect command string.
+    # @returns An action tuple, or None if the command does not match the
+    #          Config or is invalid
+    #
+    def compile_single_aspect(self, p_aspect_cmd):
+        cache = Aspect.c_command_cache
+        if p_aspect_cmd in cache:
+            return cache[p_aspect_cmd]
+        action = self.eval_single_aspect(p_aspect_cmd)
+        cache[Aspect.Intern(p_aspect_cmd)] = action
+        return action
+
+
     # Evaluate a single aspect command>
     # @p_aspect_cmd An aspect command string.
-    # @returns True on success, false on parsing error
+    # @returns An action tuple, or None on parsing error or no match
     #
     def eval_single_aspect(self, p_aspect_cmd):
         # Keywords to collect in this parser
@@ -105,16 +254,22 @@ class Aspect:
                     number_plate = False
                 continue
 
-            if args[0] == "head-id":
-                head_id = int(args[1])
-                continue
-
-            if args[0] == "angle":
-                angle = int(args[1])
+            if args[0] == "head-id" or args[0] == "angle":
+                try:
+                    value = int(args[1])
+                except (IndexError, ValueError):
+                    self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
+                    self.m_log.add(self.m_config.m_hostname, \
+                        "Invalid number 202610171107");
+                    return None
+                if args[0] == "head-id":
+                    head_id = value
+                else:
+                    angle = value
                 continue
 
             if args[0] == "color":
-                color = args[1]
+                color = Aspect.Intern(args[1])
                 continue
 
             if args[0] == "flashing":
@@ -127,60 +282,81 @@ class Aspect:
                 self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
                 self.m_log.add(self.m_config.m_hostname, \
                     "Missing head parameter 202410112052");
-                return False
+                return None
             if not isinstance(angle, int):
                 self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
                 self.m_log.add(self.m_config.m_hostname, \
                     "Missing angle parameter 202410112053");
-                return False
-            matching_semaphore = Semaphore.Semaphore.CheckForMatch(head_id)
+                return None
+            if angle < 0 or angle > 90:
+                self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
+                self.m_log.add(self.m_config.m_hostname, \
+                    "Invalid angle 202610171106");
+                return None
+            head = Head.Head.Find(head_id)
+            matching_semaphore = None
+            if head:
+                matching_semaphore = head.m_semaphore
             if not matching_semaphore:
                 # No semaphore matching this description in the config file
                 #print("No semaphore:", head_id)
-                return False
-            action = Action.Action()
-            action.m_head_id = head_id
-            action.m_semaphore = matching_semaphore
-            action.m_angle = angle
-            self.m_action_list.append(action)
-            if head_id not in self.m_head_list:
-                self.m_head_list.append(head_id)
-            return True
+                return None
+            return (Aspect.c_semaphore, head_id, matching_semaphore, angle, False)
 
         if fixture == "light":
             if not head_id:
                 self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
                 self.m_log.add(self.m_config.m_hostname, \
                     "Missing head parameter 202410112054");
-                return False
+                return None
             if not color:
                 self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
                 self.m_log.add(self.m_config.m_hostname, \
                     "Missing color parameter 202410112056");
-                return False
-            matching_light = Light.Light.CheckForMatch(head_id, color)
+                return None
+            head = Head.Head.Find(head_id)
+            matching_light = None
+            if head:
+                matching_light = head.find_light(color)
             if not matching_light:
                 # No light matching this description in the config file
                 #print("No light:", head_id)
-                return False
-            action = Action.Action()
-            action.m_head_id = head_id
-            action.m_light = matching_light
-            action.m_color = color
-            action.m_flashing = flashing
-            self.m_action_list.append(action)
-            if head_id not in self.m_head_list:
-                self.m_head_list.append(head_id)
-            return True
+                return None
+            color_index = WS281.WS281.c_ws281.color_index(color)
+            if color_index is None:
+                self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
+                self.m_log.add(self.m_config.m_hostname, \
+                    "Color not in color-chart 202610171012");
+                return None
+            return (Aspect.c_light, head_id, matching_light, color_index, flashing)
 
         if fixture == "number-plate":
-            # number-plate is simply used for modifying the rule
-            self.m_number_plate = number_plate
-            return True
+            return (Aspect.c_number_plate, None, None, number_plate, False)
 
         self.m_log.add(self.m_config.m_hostname, p_aspect_cmd)
         self.m_log.add(self.m_config.m_hostname, "Invalid aspect 202410112057");
-        return False
+        return None
+
+
+    # Compile the target state of every fixture from the actions.  Lights
+    # without an action are off.
+    #
+    def compile_targets(self):
+        black_index = WS281.WS281.c_ws281.m_black_index
+        light_state = dict()
+        semaphore_list = list()
+        for (kind, head_id, fixture, value, flashing) in self.m_actions:
+            if kind == Aspect.c_light:
+                light_state[fixture] = (value, flashing)
+            else:
+                semaphore_list.append((fixture, value))
+
+        light_list = list()
+        for light in Light.Light.c_light_list:
+            (color_index, flashing) = light_state.get(light, (black_index, False))
+            light_list.append((light, color_index, flashing))
+        self.m_light_targets = tuple(light_list)
+        self.m_semaphore_targets = tuple(semaphore_list)
 
 
     # Check this Aspect against the Configuration of this signal.
@@ -203,15 +379,23 @@ class Aspect:
         return True
 
 
-    # Execute the Actions assigned to this Aspect
+    # Change from the current aspect to this Aspect.  Only the lights and
+    # semaphores whose target differs are changed, and the lights are all
+    # written together by the next flash scheduler tick.
     # @param p_source The source requesting the execution
     # @param p_log Log to print error messages
     # @returns True on success, False on failure
     #
     def execute(self, p_source, p_log):
-        for action in self.m_action_list:
-            if not action.execute(p_source, p_log):
-                p_log.add("Aspect", "execute failed 202410160828")
-                return False
+        for (light, color_index, flashing) in self.m_light_targets:
+            if light.m_aspect_color != color_index or light.m_aspect_flashing != flashing:
+                if not light.set_aspect(color_index, flashing):
+                    p_log.add("Aspect", "execute failed 202410160828")
+                    return False
+        for (semaphore, angle) in self.m_semaphore_targets:
+            if semaphore.m_angle_target != angle:
+                if not semaphore.set_aspect(angle):
+                    p_log.add("Aspect", "execute failed 202410160828")
+                    return False
         return True
 
@@ -0,0 +1,463 @@
+#
+# Cooperative uasyncio runtime for the SigOS main loop
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# The AsyncRuntime runs each area of SigOS in its own uasyncio task, so a
+# WiFi reconnect or a slow Telnet client no longer stalls the detectors,
+# state machines and rule activation.  Telnet clients are served with
+# asyncio.start_server(), one task per client.
+#
+# The runtime imports no hardware modules, the callers hand it the
+# functions to run, so it also runs on the MicroPython unix port.
+# Select it with "runtime": "asyncio" in config.json.
+
+import time
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+import Log
+import Command
+import Metrics
+import TelnetFilter
+
+# A task request may come from a scheduled interrupt callback, MicroPython
+# has ThreadSafeFlag for that.  Other ports use an Event.
+try:
+    TaskFlag = asyncio.ThreadSafeFlag
+except AttributeError:
+    TaskFlag = asyncio.Event
+
+
+class AsyncTelnetConn:
+
+    # Class variables, the same limits as TelnetConn
+
+    # Most output bytes waiting for one client, more output is dropped
+    c_tx_max = 4096
+    # Disconnect a client that does not accept the waiting output this fast
+    c_tx_stall_ms = 30000
+    # Appended once when output is dropped
+    c_tx_dropped = b"\r\n... output dropped, client too slow\r\n"
+
+    # Initialize a connection for a newly accepted Telnet client
+    # @param p_reader The asyncio StreamReader of the client
+    # @param p_writer The asyncio StreamWriter of the client
+    # @param p_client_list The list of open client connections, shared
+    #        with TelnetServer so the "close" command finds this client
+    # @param p_close_handler Function called with the source name of the
+    #        client host when its last connection closes, or None
+    #
+    def __init__(self, p_reader, p_writer, p_client_list, p_close_handler):
+        self.m_reader = p_reader
+        self.m_writer = p_writer
+        self.m_client_list = p_client_list
+        self.m_close_handler = p_close_handler
+        peer = p_writer.get_extra_info('peername')
+        self.m_client_addr = peer[0]
+        self.m_client_port = peer[1]
+        # The source name of this connection's commands and rule requests,
+        # the client host, so a later session can release its requests
+        self.m_source = str(self.m_client_addr)
+        # The next Log entry to send for "log follow", None when not following
+        self.m_follow_index = None
+        self.m_rx_filter = TelnetFilter.TelnetFilter()
+        self.m_closed = False
+        self.m_draining = False
+        self.m_tx_dropped = False
+        try:
+            # Make drain() wait for all the output, as MicroPython's does
+            p_writer.transport.set_write_buffer_limits(0)
+        except AttributeError:
+            pass
+        self.m_client_list.append(self)
+
+
+    # @returns The number of bytes written but not yet sent to the client
+    #
+    def unsent(self):
+        try:
+            # MicroPython keeps them in the StreamWriter
+            return len(self.m_writer.out_buf)
+        except AttributeError:
+            return self.m_writer.transport.get_write_buffer_size()
+
+
+    # Queue a string or bytes to send to the client.  Output beyond
+    # c_tx_max unsent bytes is dropped.
+    # @param p_text The text to send
+    #
+    def write(self, p_text):
+        if self.m_closed:
+            return
+        if isinstance(p_text, str):
+            p_text = p_text.encode()
+        if self.unsent() + len(p_text) > AsyncTelnetConn.c_tx_max:
+            # Drop the output, and tell the client once
+            if not self.m_tx_dropped:
+                self.m_tx_dropped = True
+                self.m_writer.write(AsyncTelnetConn.c_tx_dropped)
+            return
+        self.m_writer.write(p_text)
+
+
+    # Print a prompt on the terminal
+    #
+    def prompt(self):
+        self.write("> ")
+
+
+    # Send lines that were not requested by a command, such as "log follow"
+    # @param p_lines A list of strings
+    #
+    def push(self, p_lines):
+        if self.m_closed:
+            return
+        for line in p_lines:
+            self.write(line)
+            self.write("\r\n")
+        if not self.m_draining:
+            self.m_draining = True
+            asyncio.create_task(self.drain())
+
+
+    # Send the queued output, and disconnect the client if it does not
+    # accept it within c_tx_stall_ms
+    #
+    async def send(self):
+        try:
+            await asyncio.wait_for(self.m_writer.drain(), AsyncTelnetConn.c_tx_stall_ms / 1000)
+        except asyncio.TimeoutError:
+            Log.Log().add(self.m_source, "Disconnected client, output stalled")
+            self.close()
+            return
+        if self.unsent() == 0:
+            self.m_tx_dropped = False
+
+
+    # Send the queued output from its own task
+    #
+    async def drain(self):
+        try:
+            await self.send()
+        except OSError:
+            pass
+        self.m_draining = False
+
+
+    # Remove telnet command sequences and null bytes from a line
+    # @param p_line The bytes of one line from the client
+    # @returns The line as a string, without line breaks, or None if
+    #          it is not valid text
+    #
+    def decode_line(self, p_line):
+        buf = bytearray(p_line)
+        count = self.m_rx_filter.strip(buf, len(buf))
+        try:
+            return bytes(memoryview(buf)[0:count]).decode().rstrip("\r\n")
+        except UnicodeError:
+            return None
+
+
+    # Serve the client until it disconnects or is closed
+    # @param p_welcome The welcome message, or None
+    #
+    async def run(self, p_welcome):
+        try:
+            if p_welcome:
+                self.write(p_welcome)
+            self.prompt()
+            await self.send()
+
+            while not self.m_closed:
+                line = await self.m_reader.readline()
+                if not line:
+                    # The client closed the connection
+                    break
+                line = self.decode_line(line)
+                if line is None:
+                    continue
+                (cmd_match, func_result, result_list) = Command.Command.ParseAndExec(line, self.m_source, self)
+                if (not func_result):
+                    result_list.append('Command failed')
+                if self.m_closed:
+                    # The command closed this connection
+                    break
+                for out_line in result_list:
+                    if self.unsent() + len(out_line) + 2 > AsyncTelnetConn.c_tx_max:
+                        # Send before the limit, it is for slow clients
+                        await self.send()
+                    self.write(out_line)
+                    self.write("\r\n")
+                self.prompt()
+                await self.send()
+        except OSError:
+            # Connection reset by the client
+            pass
+        finally:
+            self.close()
+
+
+    # @returns True if another connection from this client host is open
+    #
+    def host_connected(self):
+        for client in self.m_client_list:
+            if client.m_source == self.m_source:
+                return True
+        return False
+
+
+    # Close the connection
+    #
+    def close(self):
+        if self in self.m_client_list:
+            self.m_client_list.remove(self)
+        if not self.m_closed:
+            self.m_closed = True
+            self.m_writer.close()
+            if self.m_close_handler and not self.host_connected():
+                self.m_close_handler(self.m_source)
+
+
+class AsyncRuntime:
+
+    # Time between watchdog feeds, must be well under the 2 second timeout
+    c_watchdog_ms = 500
+
+    # Time between WiFi connection checks
+    c_wifi_ms = 10000
+
+    # The watchdog timeout, for the feed slack metric
+    c_watchdog_timeout_ms = 2000
+
+    # Time spent in each run of a periodic task, and the time left before
+    # the watchdog timeout at each feed
+    c_loop_metric = Metrics.Metrics.Histogram("loop")
+    c_watchdog_metric = Metrics.Metrics.Histogram("watchdog slack")
+
+    # Initialize the runtime
+    # @param p_log Reference to the Log object
+    # @param p_client_list The list of open Telnet client connections
+    #
+    def __init__(self, p_log, p_client_list):
+        self.m_log = p_log
+        self.m_client_list = p_client_list
+        self.m_welcome = None
+        self.m_close_handler = None
+        self.m_wifi = None
+        self.m_wdt = None
+        self.m_repl_pin = None
+        self.m_task_list = list()
+        self.m_task_flags = dict()
+        self.m_tasks = list()
+        self.m_server = None
+
+
+    # Set the welcome message printed at the start of each client session
+    # @param p_welcome The welcome message
+    #
+    def set_welcome(self, p_welcome):
+        self.m_welcome = p_welcome
+
+
+    # Set the function called with the source name when a Telnet
+    # connection closes
+    # @param p_close_handler The function, or None
+    #
+    def set_close_handler(self, p_close_handler):
+        self.m_close_handler = p_close_handler
+
+
+    # Keep the WiFi connected and the clock updated from its own task
+    # @param p_wifi The WiFi object
+    #
+    def set_wifi(self, p_wifi):
+        self.m_wifi = p_wifi
+
+
+    # Feed the watchdog and watch the REPL button from the main task
+    # @param p_wdt The machine.WDT, or None
+    # @param p_repl_pin A Pin that reads 0 to drop to the REPL, or None
+    #
+    def set_watchdog(self, p_wdt, p_repl_pin):
+        self.m_wdt = p_wdt
+        self.m_repl_pin = p_repl_pin
+
+
+    # Add a task that calls a function periodically
+    # @param p_name The name of the task
+    # @param p_func Function to call, with no arguments
+    # @param p_period_ms Longest time between calls, or 0 for a task that
+    #        only runs when requested or when p_next_func asks
+    # @param p_next_func Optional function returning the milliseconds until
+    #        p_func needs to be called again, or None.  Shortens the sleep.
+    #
+    def add_task(self, p_name, p_func, p_period_ms, p_next_func=None):
+        self.m_task_list.append((p_name, p_func, p_period_ms, p_next_func))
+        self.m_task_flags[p_name] = TaskFlag()
+
+
+    # Run the named task now instead of at the end of its sleep.  Safe
+    # from a scheduled interrupt callback, see Scheduler.RequestTask()
+    # @param p_name The name of the task
+    #
+    def request_task(self, p_name):
+        flag = self.m_task_flags.get(p_name)
+        if flag is not None:
+            flag.set()
+
+
+    # Call a function periodically, forever
+    #
+    async def periodic(self, p_name, p_func, p_period_ms, p_next_func):
+        flag = self.m_task_flags[p_name]
+        while True:
+            # Clear before running, so a request made while p_func runs
+            # ends the next wait
+            if hasattr(flag, "clear"):
+                flag.clear()
+            start_us = time.ticks_us()
+            p_func()
+            Metrics.Metrics.Since(AsyncRuntime.c_loop_metric, start_us)
+            delay_ms = None
+            if p_period_ms > 0:
+                delay_ms = p_period_ms
+            if p_next_func:
+                remaining = p_next_func()
+                if remaining is not None and (delay_ms is None or remaining < delay_ms):
+                    delay_ms = remaining
+            if delay_ms is None:
+                await flag.wait()
+            else:
+                try:
+                    await asyncio.wait_for(flag.wait(), delay_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+
+
+    # Keep the WiFi connected and the clock updated
+    #
+    async def wifi_task(self):
+        while True:
+            await self.m_wifi.poll()
+            await asyncio.sleep(AsyncRuntime.c_wifi_ms / 1000)
+
+
+    # Serve one Telnet client, called by the server for each connection
+    #
+    async def telnet_client(self, p_reader, p_writer):
+        conn = AsyncTelnetConn(p_reader, p_writer, self.m_client_list, self.m_close_handler)
+        self.m_log.add(str(conn.m_client_addr), "Client connection")
+        await conn.run(self.m_welcome)
+
+
+    # Start the tasks and the Telnet server, then feed the watchdog
+    # until a task stops or the REPL button is pressed
+    # @param p_port The Telnet port number
+    #
+    async def main(self, p_port):
+        self.m_server = await asyncio.start_server(self.telnet_client, "0.0.0.0", p_port)
+        print("Telnet server started on port", p_port)
+
+        self.m_tasks = list()
+        for (name, func, period_ms, next_func) in self.m_task_list:
+            self.m_tasks.append(asyncio.create_task(self.periodic(name, func, period_ms, next_func)))
+        if self.m_wifi:
+            self.m_tasks.append(asyncio.create_task(self.wifi_task()))
+
+        feed_us = time.ticks_us()
+        while True:
+            # Not dead (yet), feed the watchdog
+            if self.m_wdt:
+                now_us = time.ticks_us()
+                Metrics.Metrics.Record(AsyncRuntime.c_watchdog_metric,
+                    AsyncRuntime.c_watchdog_timeout_ms * 1000 - time.ticks_diff(now_us, feed_us))
+                feed_us = now_us
+                self.m_wdt.feed()
+
+            # Test for REPL button
+            if self.m_repl_pin and self.m_repl_pin.value() == 0:
+                raise ValueError('Entering REPL')
+
+            # Stop feeding the watchdog if a task died
+            for task in self.m_tasks:
+                if task.done():
+                    raise Exception('Runtime task stopped 202610171101')
+
+            await asyncio.sleep(AsyncRuntime.c_watchdog_ms / 1000)
+
+
+    # Run until a task stops or the REPL button is pressed
+    # @param p_port The Telnet port number, default 23
+    #
+    def run(self, p_port=23):
+        asyncio.run(self.main(p_port))
+
+
+# Run the runtime on the local host with a test command, and talk to it
+# through a Telnet client connection.  Runs on the MicroPython unix port.
+# @param p_port The port number for the test server
+# @returns True if the test passed
+#
+def unit_test(p_port=8023):
+    log = Log.Log()
+    client_list = list()
+    runtime = AsyncRuntime(log, client_list)
+    runtime.set_welcome("test\r\n")
+    ticks = [0]
+    def tick():
+        ticks[0] += 1
+    runtime.add_task("tick", tick, 10)
+
+    def fn_echo(p_word_list, p_source):
+        return True, [p_word_list[1]]
+    Command.Command(["async-echo", "$word"], "Echo a word", fn_echo)
+
+    async def client():
+        # Let the server start
+        await asyncio.sleep(0.05)
+        reader, writer = await asyncio.open_connection("127.0.0.1", p_port)
+        await reader.readline()
+        writer.write(b"async-echo \xff\xfb\x01hello\r\n")
+        # Not valid UTF-8, ignored
+        writer.write(b"async-echo \xe9\r\n")
+        # Sub-negotiation containing an escaped IAC
+        writer.write(b"async-echo \xff\xfa\x18\xff\xff\x00\xff\xf0world\r\n")
+        await writer.drain()
+        line = await reader.readline()
+        line += await reader.readline()
+        writer.close()
+        return line
+
+    async def test():
+        server = asyncio.create_task(runtime.main(p_port))
+        line = await client()
+        await asyncio.sleep(0.05)
+        server.cancel()
+        return line
+
+    line = asyncio.run(test())
+    passed = line == b"> hello\r\n> world\r\n" and ticks[0] > 0 and len(client_list) == 0
+    print("AsyncRuntime reply:", line, "ticks:", ticks[0], "clients:", len(client_list))
+    return passed
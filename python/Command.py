@@ -23,11 +23,32 @@
 # 
 #
 
+import time
+import Metrics
+
+# Commands are compiled into a dispatch index when they are registered.
+# c_index is keyed by (first word, word count), so a command line only
+# reaches the few commands that can match it.  Each entry is a tree of
+# dicts: a literal word selects the child of that word, c_variable selects
+# the child for a "${name}" word, and c_leaf holds the Command at the end.
+# Literal words take precedence over variables.
+
 class Command:
 
     # Class variable containing the list of all registered commands.
     c_command_list = list()
 
+    # The connection whose command is executing, or None
+    c_connection = None
+
+    # Dispatch index of all registered commands
+    c_index = dict()
+
+    # Keys of the index tree for variable words and for the Command.
+    # They are not strings, so no word of a command line can select them.
+    c_variable = 1
+    c_leaf = 0
+
     # Define a command
     # @param p_word_list The list of words for the command
     # @param p_desc Text that describes the command, output of help()
@@ -37,47 +58,191 @@ class Command:
         self.m_word_list = p_word_list
         self.m_desc = p_desc
         self.m_func = p_func
+        # Latency histogram, shared by the commands with the same first
+        # word, registered on first use
+        self.m_metric = None
         Command.c_command_list.append(self)
         if (not self.m_func):
             raise Exception('Undefined Command function 02407231742')
+        Command.AddToIndex(self)
 
 
-    # Create a list of help strings describing the registered commands
+    # Add a command to the dispatch index
+    # @param p_command The Command to add
+    #
+    @classmethod
+    def AddToIndex(p_class, p_command):
+        words = p_command.m_word_list
+        key = (p_class.IndexWord(words[0]), len(words))
+        node = p_class.c_index.get(key)
+        if node is None:
+            node = dict()
+            p_class.c_index[key] = node
+        for word in words[1:]:
+            word = p_class.IndexWord(word)
+            child = node.get(word)
+            if child is None:
+                child = dict()
+                node[word] = child
+            node = child
+        if p_class.c_leaf in node:
+            raise Exception('Duplicate Command ' + " ".join(words) + ' 202610171103')
+        node[p_class.c_leaf] = p_command
+
+
+    # @param p_word A word of a command definition
+    # @returns The index key of the word
+    #
+    @classmethod
+    def IndexWord(p_class, p_word):
+        if (p_word[0] == "$"):
+            return p_class.c_variable
+        return p_word
+
+
+    # Split a command line into words.  Runs of whitespace separate words,
+    # and a word in double or single quotes may contain whitespace.
+    # @param p_line A single line of text
+    # @returns A list of words
+    #
+    @staticmethod
+    def Tokenize(p_line):
+        # Most lines have no quotes, split them without the character loop
+        if '"' not in p_line and "'" not in p_line:
+            return p_line.split()
+        words = list()
+        word = None
+        quote = None
+        for ch in p_line:
+            if quote:
+                if ch == quote:
+                    quote = None
+                else:
+                    word += ch
+            elif ch == '"' or ch == "'":
+                quote = ch
+                if word is None:
+                    word = ""
+            elif ch == " " or ch == "\t":
+                if word is not None:
+                    words.append(word)
+                    word = None
+            else:
+                if word is None:
+                    word = ch
+                else:
+                    word += ch
+        if word is not None:
+            words.append(word)
+        return words
+
+
+    # Find the command that matches a list of words
+    # @param p_word_list A list of input words
+    # @returns The matching Command, or None
+    #
+    @classmethod
+    def Lookup(p_class, p_word_list):
+        if len(p_word_list) == 0:
+            return None
+        index = p_class.c_index
+        node = index.get((p_word_list[0], len(p_word_list)))
+        if node is not None:
+            cmd = p_class.LookupNode(node, p_word_list, 1)
+            if cmd is not None:
+                return cmd
+        node = index.get((p_class.c_variable, len(p_word_list)))
+        if node is not None:
+            return p_class.LookupNode(node, p_word_list, 1)
+        return None
+
+
+    # Match the remaining words against a node of the index tree
+    # @param p_node The node of the index tree
+    # @param p_word_list A list of input words
+    # @param p_pos The index of the next word to match
+    # @returns The matching Command, or None
+    #
+    @classmethod
+    def LookupNode(p_class, p_node, p_word_list, p_pos):
+        if p_pos == len(p_word_list):
+            return p_node.get(p_class.c_leaf)
+        child = p_node.get(p_word_list[p_pos])
+        if child is not None:
+            cmd = p_class.LookupNode(child, p_word_list, p_pos + 1)
+            if cmd is not None:
+                return cmd
+        child = p_node.get(p_class.c_variable)
+        if child is not None:
+            return p_class.LookupNode(child, p_word_list, p_pos + 1)
+        return None
+
+
+    # Create a list of help strings describing the registered commands,
+    # in alphabetical order from the dispatch index
     # @returns A list of strings
     #
     @staticmethod
     def Help():
         help_list = list()
-        for cmd in Command.c_command_list:
-            s = ""
-            for word in cmd.m_word_list:
-                if (word[0] == "$"):
-                    s += word[1:]
-                    s += " "
-                else:
-                    s += word
-                    s += " "
-            s += ": "
-            s += cmd.m_desc
-            help_list.append(s)
+        for key in sorted(Command.c_index, key=str):
+            Command.HelpNode(Command.c_index[key], help_list)
         return help_list
 
 
+    # Add the help strings of all commands below a node of the index tree
+    # @param p_node The node of the index tree
+    # @param p_help_list The list of help strings to append to
+    #
+    @staticmethod
+    def HelpNode(p_node, p_help_list):
+        for key in sorted(p_node, key=str):
+            if key == Command.c_leaf:
+                p_help_list.append(p_node[key].help())
+            else:
+                Command.HelpNode(p_node[key], p_help_list)
+
+
+    # @returns The help string of this command
+    #
+    def help(self):
+        s = ""
+        for word in self.m_word_list:
+            if (word[0] == "$"):
+                s += word[1:]
+                s += " "
+            else:
+                s += word
+                s += " "
+        s += ": "
+        s += self.m_desc
+        return s
+
+
     # Attempt to execute the command given by the list of words
     # @param p_line A single line of "words" that form a command
     # @param p_source The name of the source/client making the request
+    # @param p_connection The connection that received the line, or None
     # @returns (cmd_match, func_result, result_list), where
     #          cmd_match is true if this command matches
     #          func_result is the result of the function
     #          result_list is a list of strings from the function
     #
     @staticmethod
-    def ParseAndExec(p_line, p_source):
-        word_list = p_line.split(" ")
-        for cmd in Command.c_command_list:
-            (cmd_match, func_result, result_list) = cmd.parse_and_exec(word_list, p_source)
-            if (cmd_match):
-                return cmd_match, func_result, result_list
+    def ParseAndExec(p_line, p_source, p_connection=None):
+        word_list = Command.Tokenize(p_line)
+        cmd = Command.Lookup(word_list)
+        if cmd is not None:
+            start_us = time.ticks_us()
+            Command.c_connection = p_connection
+            try:
+                (func_result, result_list) = cmd.m_func(word_list, p_source)
+            finally:
+                Command.c_connection = None
+            if cmd.m_metric is None:
+                cmd.m_metric = Metrics.Metrics.Histogram("command " + cmd.m_word_list[0])
+            Metrics.Metrics.Since(cmd.m_metric, start_us)
+            return True, func_result, result_list
         inv_cmd = ["Invalid command"]
         return False, False, inv_cmd
 
@@ -110,3 +275,47 @@ class Command:
         return True, func_result, result_list
 
 
+# Measure the dispatch time of the index against a linear scan of the
+# command list, at several numbers of registered commands.  The registry
+# is restored afterwards.
+# @param p_sizes The numbers of registered commands to measure
+# @param p_count The number of dispatches per measurement
+# @returns A list of (size, index us, linear us) per dispatch
+#
+def benchmark(p_sizes=(10, 50, 200), p_count=1000):
+    saved_list = Command.c_command_list
+    saved_index = Command.c_index
+    results = list()
+
+    def fn_bench(p_word_list, p_source):
+        return True, None
+
+    try:
+        for size in p_sizes:
+            Command.c_command_list = list()
+            Command.c_index = dict()
+            for i in range(size):
+                Command(["bench" + str(i), "set", "${value}"], "Benchmark", fn_bench)
+            # The last command registered is the worst case of the scan
+            line = "bench" + str(size - 1) + " set 1"
+
+            start = time.ticks_us()
+            for i in range(p_count):
+                Command.ParseAndExec(line, "bench")
+            index_us = time.ticks_diff(time.ticks_us(), start) / p_count
+
+            start = time.ticks_us()
+            for i in range(p_count):
+                word_list = line.split(" ")
+                for cmd in Command.c_command_list:
+                    (cmd_match, func_result, result_list) = cmd.parse_and_exec(word_list, "bench")
+                    if (cmd_match):
+                        break
+            linear_us = time.ticks_diff(time.ticks_us(), start) / p_count
+
+            print("commands:", size, "index us:", index_us, "linear us:", linear_us)
+            results.append((size, index_us, linear_us))
+    finally:
+        Command.c_command_list = saved_list
+        Command.c_index = saved_index
+    return results
@@ -25,13 +25,19 @@
 
 import os
 import sys
+import time
 import machine
 import Command
 import Log
+import LogFile
+import LogFollow
+import Syslog
+import Metrics
 import Config
 import Rules
 import TelnetServer
 import WiFi
+import WS281
 
 
 SigOS_Version = "20250228"
@@ -104,6 +110,27 @@ wl = ["release", "${rule}|{name}"]
 Command.Command(wl, "Release previous Rule activation by number or name", fn_release)
 
 
+def fn_release_all(p_word_list, p_source):
+    source = p_word_list[1]
+    out = list()
+    rules = Rules.Rules.c_rules
+    count = rules.release_all_by_source(source)
+    msg = "Released "
+    msg += str(count)
+    msg += " from: "
+    msg += source
+    out.append(msg)
+    active_rule = rules.get_active_rule()
+    if active_rule:
+        msg = "Active: "
+        msg += active_rule.m_rule
+        out.append(msg)
+    return True, out
+
+wl = ["release-all", "${source}"]
+Command.Command(wl, "Release all Rule activations requested by a source", fn_release_all)
+
+
 def fn_active(p_word_list, p_source):
     out = list()
     rules = Rules.Rules.c_rules
@@ -137,7 +164,9 @@ Command.Command(wl, "Show the number-plate, or None", fn_number_plate)
 
 
 def fn_log(p_word_list, p_source):
-    global g_log
+    if LogFile.LogFile.c_log_file:
+        # Include the entries from before the last reset
+        return True, LogFile.LogFile.c_log_file.get_all()
     log = Log.Log()
     all_logs = log.get_all()
     return True, all_logs
@@ -152,6 +181,9 @@ def fn_log_n(p_word_list, p_source):
     except:
         err = ["Invalid index"]
         return False, err
+    if LogFile.LogFile.c_log_file:
+        # Numbered as in "log", including the entries from before the last reset
+        return True, LogFile.LogFile.c_log_file.get_single(index)
     log = Log.Log()
     one_log = log.get_single(index)
     return True, one_log
@@ -160,11 +192,110 @@ wl = ["log", "${entry_num}"]
 Command.Command(wl, "Show a specified line of the log Log", fn_log_n)
 
 
+def fn_log_stats(p_word_list, p_source):
+    log = Log.Log()
+    out = log.get_stats()
+    if LogFile.LogFile.c_log_file:
+        out.append(str(LogFile.LogFile.c_log_file))
+    if Syslog.Syslog.c_syslog:
+        out.append(str(Syslog.Syslog.c_syslog))
+    return True, out
+
+wl = ["log", "stats"]
+Command.Command(wl, "Show the Log entries dropped by the rate limit and repeats collapsed, by source", fn_log_stats)
+
+
+def fn_log_stats_reset(p_word_list, p_source):
+    log = Log.Log()
+    log.reset_stats()
+    return True, ["ok"]
+
+wl = ["log", "stats", "reset"]
+Command.Command(wl, "Clear the Log counts of dropped and repeated entries", fn_log_stats_reset)
+
+
+# Parse a time for "log since"
+# @param p_word_list Either "HH:MM[:SS]" for today, "YYYY/MM/DD", or
+#        "YYYY/MM/DD" followed by "HH:MM[:SS]"
+# @returns The time in seconds
+#
+def parse_time(p_word_list):
+    now = time.localtime(time.time())
+    date = (now[0], now[1], now[2])
+    clock = (0, 0, 0)
+    for word in p_word_list:
+        if "/" in word:
+            date = tuple(int(x) for x in word.split("/"))
+            if len(date) != 3:
+                raise ValueError(word)
+        else:
+            clock = [int(x) for x in word.split(":")]
+            if len(clock) == 2:
+                clock.append(0)
+            if len(clock) != 3:
+                raise ValueError(word)
+    return int(time.mktime((date[0], date[1], date[2], clock[0], clock[1], clock[2], 0, 0, -1)))
+
+
+def fn_log_since(p_word_list, p_source):
+    try:
+        since = parse_time(p_word_list[2:])
+    except ValueError:
+        return False, ["Invalid time, use HH:MM[:SS], YYYY/MM/DD or both"]
+    if LogFile.LogFile.c_log_file:
+        return True, LogFile.LogFile.c_log_file.get_since(since)
+    log = Log.Log()
+    return True, log.get_since(since)
+
+wl = ["log", "since", "${time}"]
+Command.Command(wl, "Show the Log since a time, HH:MM[:SS] today or YYYY/MM/DD", fn_log_since)
+
+wl = ["log", "since", "${date}", "${time}"]
+Command.Command(wl, "Show the Log since a date and time, YYYY/MM/DD HH:MM[:SS]", fn_log_since)
+
+
+def fn_log_follow(p_word_list, p_source):
+    if not LogFollow.LogFollow.Follow(Command.Command.c_connection):
+        return False, ["Not a Telnet connection"]
+    return True, ["Following the Log, \"log unfollow\" to stop"]
+
+wl = ["log", "follow"]
+Command.Command(wl, "Send new Log entries to this connection as they are added", fn_log_follow)
+
+
+def fn_log_unfollow(p_word_list, p_source):
+    if not LogFollow.LogFollow.Unfollow(Command.Command.c_connection):
+        return False, ["Not following the Log"]
+    return True, ["ok"]
+
+wl = ["log", "unfollow"]
+Command.Command(wl, "Stop sending new Log entries to this connection", fn_log_unfollow)
+
+
+def fn_stats(p_word_list, p_source):
+    return True, Metrics.Metrics.Report()
+
+wl = ["stats"]
+Command.Command(wl, "Show the counters and latency histograms", fn_stats)
+
+
+def fn_stats_reset(p_word_list, p_source):
+    Metrics.Metrics.Reset()
+    return True, ["ok"]
+
+wl = ["stats", "reset"]
+Command.Command(wl, "Clear the counters and latency histograms", fn_stats_reset)
+
+
 def fn_close(p_word_list, p_source):
     log = Log.Log()
     log.add(p_source, "Disconnected client session")
     msg = list()
-    if not TelnetServer.TelnetServer.Close(p_source):
+    connection = Command.Command.c_connection
+    if connection is not None:
+        connection.close()
+        msg.append("ok")
+    elif not TelnetServer.TelnetServer.Close(p_source):
         msg.append("Failed to close connection")
     else:
         msg.append("ok")
@@ -232,6 +363,16 @@ wl = ["wifi"]
 Command.Command(wl, "Show the crrent WIFI configuration parameters", fn_wifi)
 
 
+def fn_ws281(p_word_list, p_source):
+    ws281 = WS281.WS281.c_ws281
+    if not ws281:
+        return False, ["WS281 not initialized"]
+    return True, ws281.get_stats()
+
+wl = ["ws281"]
+Command.Command(wl, "Show WS281 LED chain writes and writes saved per second", fn_ws281)
+
+
 def fn_os(p_word_list, p_source):
     out = list()
     out.append("SigOS " + SigOS_Version)
@@ -245,7 +386,8 @@ Command.Command(wl, "Show operating system and hardware info", fn_os)
 def fn_reboot(p_word_list, p_source):
     out = list()
     out.append("Rebooting...")
-    # Need write to log
+    Log.Log().add(p_source, "Reboot")
+    LogFile.LogFile.Flush()
     sys.exit()
 
 wl = ["reboot"]
@@ -255,7 +397,8 @@ Command.Command(wl, "Reboot SigOS, leaving hardware peripherals unaffected", fn_
 def fn_reset(p_word_list, p_source):
     out = list()
     out.append("Resetting...")
-    # Need write to log
+    Log.Log().add(p_source, "Reset")
+    LogFile.LogFile.Flush()
     machine.reset()
 
 wl = ["reset"]
@@ -27,6 +27,7 @@ import io
 import json
 import Semaphore
 import Light
+import Head
 import Detector
 import Log
 
@@ -63,6 +64,60 @@ class Config:
         self.m_rules_file = config["rules-file"]
         self.m_state_file = config["state-file"]
         self.m_ws281_gpio_pin = config["ws281-gpio-pin"]
+        # Optional, defaults to buffering LED writes into one write per tick
+        self.m_ws281_frame_buffered = True
+        if "ws281-frame-buffered" in config:
+            self.m_ws281_frame_buffered = config["ws281-frame-buffered"] == "true"
+        # Optional gamma correction of the light intensity, 1.0 is linear
+        self.m_ws281_gamma = 1.0
+        if "ws281-gamma" in config:
+            self.m_ws281_gamma = float(config["ws281-gamma"])
+        # Optional file for the compiled rules of this signal, "" to disable
+        self.m_rules_cache_file = "rules.cache"
+        if "rules-cache-file" in config:
+            self.m_rules_cache_file = config["rules-cache-file"]
+        # Optional number of entries kept in the Log
+        self.m_log_size = 32
+        if "log-size" in config:
+            self.m_log_size = int(config["log-size"])
+        # Optional rate limit of Log entries from each source, 0 for no limit
+        self.m_log_rate = 10
+        if "log-rate" in config:
+            self.m_log_rate = int(config["log-rate"])
+        self.m_log_burst = 32
+        if "log-burst" in config:
+            self.m_log_burst = int(config["log-burst"])
+        # Optional persistent Log in flash, "" to disable
+        self.m_log_file = ""
+        if "log-file" in config:
+            self.m_log_file = config["log-file"]
+        self.m_log_file_records = 128
+        if "log-file-records" in config:
+            self.m_log_file_records = int(config["log-file-records"])
+        self.m_log_flush_ms = 30000
+        if "log-flush-sec" in config:
+            self.m_log_flush_ms = int(config["log-flush-sec"]) * 1000
+        # Optional syslog collector for the Log, "" to disable
+        self.m_syslog_host = ""
+        if "syslog-host" in config:
+            self.m_syslog_host = config["syslog-host"]
+        self.m_syslog_port = 514
+        if "syslog-port" in config:
+            self.m_syslog_port = int(config["syslog-port"])
+        self.m_syslog_ms = 1000
+        if "syslog-interval-ms" in config:
+            self.m_syslog_ms = int(config["syslog-interval-ms"])
+        # Optional, defaults to keeping the Rules requested by a Telnet client
+        # after it disconnects, until "release-all <source>"
+        self.m_release_on_close = False
+        if "release-on-close" in config:
+            self.m_release_on_close = config["release-on-close"] == "true"
+        # Optional main loop runtime, "scheduler" (default) or "asyncio"
+        self.m_runtime = "scheduler"
+        if "runtime" in config:
+            self.m_runtime = config["runtime"]
+            if self.m_runtime != "scheduler" and self.m_runtime != "asyncio":
+                raise Exception('Unknown runtime ' + self.m_runtime + ' 202610171102')
 
         # Timezones
         self.m_tz_offset_sec = config["tz-offset-sec"]
@@ -72,10 +127,9 @@ class Config:
 
         # Build heads object
         heads = config["heads"]
-        self.m_head_count = 0
-        head_list = list()
         for head in heads:
             head_id = head["head-id"]
+            head_obj = Head.Head.Get(head_id)
             if ("lights" in head):
                 lights_list = head["lights"]
                 for light in lights_list:
@@ -84,7 +138,9 @@ class Config:
                     flashes_per_minute = light["flashes-per-minute"]
                     color_list = light["colors"]
                     # Create a new Light and store it in the Light class list
-                    Light.Light(head_id, light_id, ws281_id, flashes_per_minute, color_list, self.m_log)
+                    light_obj = Light.Light(head_id, light_id, ws281_id, flashes_per_minute, color_list, self.m_log)
+                    # Index it by color and ws281-id in its Head
+                    head_obj.add_light(light_obj)
             if ("semaphores" in head):
                 semaphore_list = head["semaphores"]
                 for semaphore in semaphore_list:
@@ -92,13 +148,13 @@ class Config:
                     degrees_0_pwm = semaphore["0-degrees-pwm"]
                     degrees_90_pwm = semaphore["90-degrees-pwm"]
                     gpio_pin = semaphore["gpio-pin"]
+                    # Optional, how the flag accelerates, see Semaphore.c_profile_names
+                    motion_profile = "linear"
+                    if "motion-profile" in semaphore:
+                        motion_profile = semaphore["motion-profile"]
                     # Create a new Semaphore and store it in the Semaphore class list
-                    Semaphore.Semaphore(head_id, gpio_pin, degrees_per_second, degrees_0_pwm, degrees_90_pwm, self.m_log)
-
-            # Keep count of the number of unique heads
-            if head_id not in head_list:
-                head_list.append(head_id)
-                self.m_head_count += 1
+                    semaphore_obj = Semaphore.Semaphore(head_id, gpio_pin, degrees_per_second, degrees_0_pwm, degrees_90_pwm, self.m_log, motion_profile)
+                    head_obj.add_semaphore(semaphore_obj)
 
         # Load the WS281 color chart
         self.m_color_chart = config["color-chart"]
@@ -122,7 +178,7 @@ class Config:
     # @returns The number of heads configured for this signal
     #
     def head_count(self):
-        return self.m_head_count
+        return Head.Head.Count()
 
 
     # @returns A string representation of this rule set
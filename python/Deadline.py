@@ -0,0 +1,119 @@
+#
+# Monotonic, wraparound-safe deadline for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# A Deadline is built on time.ticks_ms(), so it has millisecond resolution
+# and is not disturbed when NTP or the timezone offset changes the RTC.
+# Deadlines are re-armed in place with start(), so checking or restarting
+# one does not allocate a new object.  Durations must be less than half
+# of the ticks_ms() period, about 6 days on the ESP boards.
+# Use Timestamp only for displaying the wall-clock time.
+
+import time
+
+
+class Deadline:
+
+    # Create a new, disarmed Deadline
+    #
+    def __init__(self):
+        self.m_start_ms = 0
+        self.m_duration_ms = 0
+        self.m_armed = False
+        self.m_expired = False
+
+
+    # Arm this Deadline to expire after the given duration
+    # @param p_duration_ms Milliseconds from p_from_ms until expiration
+    # @param p_from_ms The start time from time.ticks_ms(), defaults to now
+    #
+    def start(self, p_duration_ms, p_from_ms=None):
+        if p_from_ms is None:
+            p_from_ms = time.ticks_ms()
+        self.m_start_ms = p_from_ms
+        self.m_duration_ms = int(p_duration_ms)
+        self.m_armed = True
+        self.m_expired = False
+
+
+    # Disarm this Deadline, it will not expire until started again
+    #
+    def cancel(self):
+        self.m_armed = False
+        self.m_expired = False
+
+
+    # @returns True if this Deadline has been started and not cancelled
+    #
+    def armed(self):
+        return self.m_armed
+
+
+    # @param p_now_ms The current time from time.ticks_ms(), defaults to now
+    # @returns True if this Deadline is armed and has expired
+    #
+    def expired(self, p_now_ms=None):
+        if not self.m_armed:
+            return False
+        if self.m_expired:
+            return True
+        if p_now_ms is None:
+            p_now_ms = time.ticks_ms()
+        if time.ticks_diff(p_now_ms, self.m_start_ms) >= self.m_duration_ms:
+            # Latch, so a late check after the ticks wrap is still expired
+            self.m_expired = True
+        return self.m_expired
+
+
+    # @param p_now_ms The current time from time.ticks_ms(), defaults to now
+    # @returns Milliseconds until expiration, zero if expired,
+    #          None if not armed
+    #
+    def remaining_ms(self, p_now_ms=None):
+        if not self.m_armed:
+            return None
+        if self.expired(p_now_ms):
+            return 0
+        if p_now_ms is None:
+            p_now_ms = time.ticks_ms()
+        return self.m_duration_ms - time.ticks_diff(p_now_ms, self.m_start_ms)
+
+
+    # @returns The time of expiration, in time.ticks_ms() units
+    #
+    def deadline_ms(self):
+        return time.ticks_add(self.m_start_ms, self.m_duration_ms)
+
+
+    # @returns A human-readable string value of this Deadline
+    #
+    def __str__(self):
+        if not self.m_armed:
+            return "disarmed"
+        s = "remaining "
+        s += str(self.remaining_ms())
+        s += "ms of "
+        s += str(self.m_duration_ms)
+        s += "ms"
+        return s
@@ -0,0 +1,169 @@
+#
+# Deferred work queue for interrupt handlers in SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# Interrupt handlers must not allocate memory, so they can not build log
+# strings or do slow work such as reading the ADC.  Instead the work is
+# registered here at startup, and the handler posts the small integer id
+# of the work into a preallocated queue.  The queue is drained outside of
+# the interrupt through micropython.schedule().
+
+import gc
+from array import array
+import micropython
+import machine
+import Log
+
+
+class Deferred:
+
+    # Size of the pending queue, posts beyond this are counted and dropped
+    c_queue_size = 16
+
+    # Preallocated ring of pending work ids
+    c_queue = array('H', [0] * c_queue_size)
+    c_queue_head = 0
+    c_queue_count = 0
+
+    # Number of posts dropped because the queue was full
+    c_overflow = 0
+
+    # True while a drain is scheduled but has not yet run
+    c_scheduled = False
+
+    # Registered work, parallel lists indexed by work id
+    c_func_list = list()
+    c_arg_list = list()
+
+
+    # Register work that may be requested from an interrupt handler.
+    # Call this at startup, never from an interrupt handler.
+    # @param p_func Function called later as p_func(p_arg), outside of the interrupt
+    # @param p_arg Argument passed to p_func
+    # @returns The work id to pass to Post()
+    #
+    @classmethod
+    def Register(p_class, p_func, p_arg):
+        p_class.c_func_list.append(p_func)
+        p_class.c_arg_list.append(p_arg)
+        return len(p_class.c_func_list) - 1
+
+
+    # Register a log message that may be reported from an interrupt handler.
+    # @param p_source Name of the source associated with the log entry
+    # @param p_text Text string to add to the log
+    # @returns The work id to pass to Post()
+    #
+    @classmethod
+    def RegisterLog(p_class, p_source, p_text):
+        return p_class.Register(log_message, (p_source, p_text))
+
+
+    # Request the registered work to be performed.  Safe to call from an
+    # interrupt handler: does not allocate memory.
+    # @param p_id A work id from Register() or RegisterLog()
+    #
+    @classmethod
+    def Post(p_class, p_id):
+        if p_class.c_queue_count >= p_class.c_queue_size:
+            p_class.c_overflow += 1
+        else:
+            tail = p_class.c_queue_head + p_class.c_queue_count
+            if tail >= p_class.c_queue_size:
+                tail -= p_class.c_queue_size
+            p_class.c_queue[tail] = p_id
+            p_class.c_queue_count += 1
+        p_class.Rearm()
+
+
+    # Schedule a drain if work is pending and no drain is scheduled.  Safe
+    # to call from an interrupt handler: does not allocate memory.  Called
+    # by Post() and by the periodic timer ticks, so work left queued when
+    # micropython.schedule() failed is drained by a later attempt.
+    #
+    @classmethod
+    def Rearm(p_class):
+        if p_class.c_scheduled or p_class.c_queue_count == 0:
+            return
+        p_class.c_scheduled = True
+        try:
+            micropython.schedule(drain_callback, 0)
+        except RuntimeError:
+            # MicroPython's schedule queue is full, try again on the next call
+            p_class.c_scheduled = False
+
+
+    # Perform all pending work.  Runs from the MicroPython scheduler,
+    # outside of the interrupt handler.
+    #
+    @classmethod
+    def Drain(p_class):
+        p_class.c_scheduled = False
+        while p_class.c_queue_count > 0:
+            # Dequeue with interrupts disabled, Post() may run from a timer
+            state = machine.disable_irq()
+            head = p_class.c_queue_head
+            work_id = p_class.c_queue[head]
+            head += 1
+            if head >= p_class.c_queue_size:
+                head = 0
+            p_class.c_queue_head = head
+            p_class.c_queue_count -= 1
+            machine.enable_irq(state)
+            p_class.c_func_list[work_id](p_class.c_arg_list[work_id])
+
+        if p_class.c_overflow > 0:
+            msg = "Deferred queue overflow, dropped "
+            msg += str(p_class.c_overflow)
+            msg += " 202610171105"
+            p_class.c_overflow = 0
+            Log.Log().add("Deferred", msg)
+
+
+    # Measure heap growth of a function that is meant to be allocation free,
+    # such as a timer callback.
+    # @param p_func The function to call, with no arguments
+    # @param p_count The number of times to call p_func
+    # @returns The number of bytes allocated across all calls
+    #
+    @staticmethod
+    def HeapGrowth(p_func, p_count):
+        gc.collect()
+        before = gc.mem_alloc()
+        for i in range(p_count):
+            p_func()
+        return gc.mem_alloc() - before
+
+
+# Scheduled by Post() to drain the queue
+#
+def drain_callback(p_arg):
+    Deferred.Drain()
+
+
+# Registered by RegisterLog() to write a message to the Log
+# @param p_arg Tuple of (source, text)
+#
+def log_message(p_arg):
+    Log.Log().add(p_arg[0], p_arg[1])
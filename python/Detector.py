@@ -23,13 +23,17 @@
 # 
 #
 
+import time
+from array import array
 import machine
 from machine import Pin
 import Config
 import TargetedCommand
 import GPIO
 import Log
-import Timestamp
+import Deadline
+import Metrics
+import Scheduler
 
 
 class Detector:
@@ -37,6 +41,26 @@ class Detector:
     # Store each created Detector in this class list
     c_detector_list = list()
 
+    # Changes of the input level, in "irq" and in "poll" mode
+    c_edge_metric = Metrics.Metrics.Counter("detector edges")
+
+    # Detector state machine switch values
+    c_switch_init = 0
+    c_switch_soak = 1
+    c_switch_hold = 2
+    c_switch_stable = 3
+
+    # Preallocated ring buffer of edges captured by the pin interrupt
+    # handlers. Each entry is (detector index, pin level, ticks_us),
+    # stored in parallel arrays so the handler never allocates.
+    c_ring_size = 32
+    c_ring_detector = bytearray(c_ring_size)
+    c_ring_level = bytearray(c_ring_size)
+    c_ring_ticks = array('i', [0] * c_ring_size)
+    c_ring_head = 0
+    c_ring_count = 0
+    c_ring_overflow = 0
+
 
     # Create a new detector
     # @param p_detector_config Base of the parsed json Detector
@@ -56,11 +80,31 @@ class Detector:
         self.m_active_hold_sec = p_detector_config["active-hold-sec"]
         self.m_inactive_soak_sec = p_detector_config["inactive-soak-sec"]
         self.m_inactive_hold_sec = p_detector_config["inactive-hold-sec"]
+        self.m_active_soak_ms = int(self.m_active_soak_sec * 1000)
+        self.m_active_hold_ms = int(self.m_active_hold_sec * 1000)
+        self.m_inactive_soak_ms = int(self.m_inactive_soak_sec * 1000)
+        self.m_inactive_hold_ms = int(self.m_inactive_hold_sec * 1000)
         self.m_soak_state = None
-        self.m_soak_timestamp = None
-        self.m_hold_timestamp = None
+        self.m_soak_deadline = Deadline.Deadline()
+        self.m_hold_deadline = Deadline.Deadline()
         self.m_current_state = None
-        self.m_switch = 0
+        self.m_level = None
+        self.m_switch = Detector.c_switch_init
+        self.m_gpio = None
+        self.m_index = len(Detector.c_detector_list)
+        self.m_irq_handler = None
+
+        # "irq" captures every edge with a pin interrupt, "poll" samples
+        # the pin each time Poll() is called
+        self.m_mode = "irq"
+        if "mode" in p_detector_config:
+            self.m_mode = p_detector_config["mode"]
+        if self.m_mode != "irq" and self.m_mode != "poll":
+            msg = 'Invalid value for mode: "'
+            msg += str(self.m_mode)
+            msg += '" 202610171150'
+            self.m_log.add("Detector", msg)
+            self.m_mode = "poll"
 
         if self.m_active_hi.lower() == "true":
             self.m_active_hi = True
@@ -69,7 +113,7 @@ class Detector:
 
         if self.m_gpio_pull.lower() == "up":
             self.m_gpio_pull_pin = Pin.PULL_UP
-        elif self.m_pgio_pull.lower() == "down":
+        elif self.m_gpio_pull.lower() == "down":
             self.m_gpio_pull_pin = Pin.PULL_DOWN
         else:
             msg = 'Invalid value for gpio-pull: "'
@@ -126,92 +170,197 @@ class Detector:
         #self.m_gpio = Pin(self.m_gpio_pin, Pin.IN, self.m_gpio_pull_pin)
         owner = self.ident()
         self.m_gpio = GPIO.GPIO(owner, self.m_gpio_pin, Pin.IN, self.m_gpio_pull_pin, self.m_log)
+        if self.m_gpio.m_pin is None:
+            return
+
+        # Start from the current level of the pin
+        self.on_level(self.m_gpio.m_pin.value(), time.ticks_ms())
+
+        if self.m_mode == "irq":
+            # Keep a reference to the bound handler, so the interrupt
+            # does not allocate a new bound method on every edge
+            self.m_irq_handler = self.irq_handler
+            self.m_gpio.m_pin.irq(trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, handler=self.m_irq_handler)
         return
 
 
+    # Pin interrupt handler, records the edge in the ring buffer, and asks
+    # for the "detectors" task when the ring was empty.
+    # Must not allocate memory.
+    # @param p_pin The Pin that caused the interrupt
+    #
+    def irq_handler(self, p_pin):
+        if Detector.c_ring_count == 0:
+            Scheduler.Scheduler.RequestTask("detectors")
+        if Detector.c_ring_count >= Detector.c_ring_size:
+            Detector.c_ring_overflow += 1
+            return
+        tail = Detector.c_ring_head + Detector.c_ring_count
+        if tail >= Detector.c_ring_size:
+            tail -= Detector.c_ring_size
+        Detector.c_ring_detector[tail] = self.m_index
+        Detector.c_ring_level[tail] = p_pin.value()
+        Detector.c_ring_ticks[tail] = time.ticks_us()
+        Detector.c_ring_count += 1
+
+
     # Perform periodic polling for all of the registered Detectors.
+    # Evaluates the edges captured by the interrupt handlers in the order
+    # they occurred, samples the detectors in "poll" mode, and then checks
+    # the soak and hold deadlines.
     # Call this method only after loading all Config
     #
     @classmethod
     def Poll(p_class):
+        now_ms = time.ticks_ms()
+        now_us = time.ticks_us()
+
+        # Drain the edge ring
+        while p_class.c_ring_count > 0:
+            state = machine.disable_irq()
+            head = p_class.c_ring_head
+            index = p_class.c_ring_detector[head]
+            level = p_class.c_ring_level[head]
+            edge_us = p_class.c_ring_ticks[head]
+            head += 1
+            if head >= p_class.c_ring_size:
+                head = 0
+            p_class.c_ring_head = head
+            p_class.c_ring_count -= 1
+            machine.enable_irq(state)
+
+            # Convert the edge time to the ticks_ms time base
+            edge_ms = time.ticks_add(now_ms, -(time.ticks_diff(now_us, edge_us) // 1000))
+            p_class.c_detector_list[index].on_level(level, edge_ms)
+
+        if p_class.c_ring_overflow > 0:
+            msg = "Edge ring overflow, dropped "
+            msg += str(p_class.c_ring_overflow)
+            msg += " 202610171152"
+            p_class.c_ring_overflow = 0
+            Log.Log().add("Detector", msg)
+
         for detector in p_class.c_detector_list:
-            detector.poll()
+            detector.poll(now_ms)
 
 
-    # Poll the detector gpio pin and test for soak and hold times.
+    # @returns True if any Detector samples its pin in "poll" mode, and so
+    #          needs Poll() to run periodically
+    #
+    @classmethod
+    def NeedsSampling(p_class):
+        for detector in p_class.c_detector_list:
+            if detector.m_mode == "poll":
+                return True
+        return False
+
+
+    # @returns Milliseconds until the earliest soak or hold deadline of
+    #          all Detectors, or None if none is pending
+    #
+    @classmethod
+    def NextDeadlineMs(p_class):
+        earliest = None
+        for detector in p_class.c_detector_list:
+            for deadline in (detector.m_soak_deadline, detector.m_hold_deadline):
+                remaining = deadline.remaining_ms()
+                if remaining is not None and (earliest is None or remaining < earliest):
+                    earliest = remaining
+        return earliest
+
+
+    # Sample the pin when in "poll" mode, and test for soak and hold times.
     # Execute commands if a new state is declared.
+    # @param p_now_ms The current time from time.ticks_ms()
     #
-    def poll(self):
-        # Get current pin state
-        state = self.m_gpio.m_pin.value()
-
-        if self.m_switch == 0:
-            # Initialization
-            self.m_soak_state = None
-            self.m_soak_timestamp = None
-            self.m_hold_timestamp = None
-            self.m_current_state = None
-            self.m_switch = 1
-
-        if self.m_switch == 1:
-            # Start a new soak state and time
-            self.m_soak_state = state
-            self.m_soak_timestamp = Timestamp.Timestamp()
-            if state == self.m_active_hi:
-                self.m_soak_timestamp.expire_after(self.m_active_soak_sec)
-            else:
-                self.m_soak_timestamp.expire_after(self.m_inactive_soak_sec)
-            self.m_switch = 2
+    def poll(self, p_now_ms):
+        if self.m_gpio is None or self.m_gpio.m_pin is None:
+            return
+        if self.m_mode == "poll":
+            self.on_level(self.m_gpio.m_pin.value(), p_now_ms)
+        self.advance(p_now_ms)
+
+
+    # Process a new level of the detector input
+    # @param p_level The pin level, 0 or 1
+    # @param p_time_ms The time of the level change, from time.ticks_ms()
+    #
+    def on_level(self, p_level, p_time_ms):
+        # Bring the state machine up to the time of this edge
+        self.advance(p_time_ms)
+
+        if p_level == self.m_level:
+            # No change
             return
+        self.m_level = p_level
+        Metrics.Metrics.Count(Detector.c_edge_metric)
+
+        if self.m_switch == Detector.c_switch_soak:
+            if p_level == self.m_current_state:
+                # Input returned to the declared state before the soak
+                # completed, ignore the glitch
+                self.m_soak_state = None
+                self.m_soak_deadline.cancel()
+                self.m_switch = Detector.c_switch_stable
+            else:
+                # Input has changed during soak, restart soak with new state
+                self.start_soak(p_level, p_time_ms)
+        elif self.m_switch == Detector.c_switch_hold:
+            # Changes during the hold time are evaluated when it expires
+            pass
+        elif p_level != self.m_current_state:
+            # Detected state change, start soak
+            self.start_soak(p_level, p_time_ms)
+
+
+    # Start a new soak state and time
+    # @param p_level The pin level being soaked
+    # @param p_time_ms The start time of the soak, from time.ticks_ms()
+    #
+    def start_soak(self, p_level, p_time_ms):
+        self.m_soak_state = p_level
+        if p_level == self.m_active_hi:
+            soak_ms = self.m_active_soak_ms
+        else:
+            soak_ms = self.m_inactive_soak_ms
+        self.m_soak_deadline.start(soak_ms, p_time_ms)
+        self.m_switch = Detector.c_switch_soak
 
-        if self.m_switch == 2:
-            if state != self.m_soak_state:
-                # Input has changed during soak, circle back
-                # around and restart soak with new state
-                self.m_switch = 1
-                return
 
-            # Input still matches soak state
-            if self.m_soak_timestamp.expired():
-                # Soak state has completed, delcare current state
+    # Run the soak and hold deadlines that have expired by the given time
+    # @param p_now_ms The time to advance to, from time.ticks_ms()
+    #
+    def advance(self, p_now_ms):
+        while True:
+            if self.m_switch == Detector.c_switch_soak:
+                if not self.m_soak_deadline.expired(p_now_ms):
+                    return
+                # Soak state has completed, declare current state
                 # and start hold time and execute actions
-                self.m_current_state = state
+                self.m_current_state = self.m_soak_state
                 self.m_soak_state = None
-                self.m_soak_timestamp = None
-                self.m_hold_timestamp = Timestamp.Timestamp()
                 if self.m_current_state == self.m_active_hi:
-                    self.m_hold_timestamp.expire_after(self.m_active_hold_sec)
-                    self.execute_cmds(self.m_active_cmd_list)
+                    hold_ms = self.m_active_hold_ms
+                    cmd_list = self.m_active_cmd_list
                 else:
-                    self.m_hold_timestamp.expire_after(self.m_inactive_hold_sec)
-                    self.execute_cmds(self.m_inactive_cmd_list)
-
-                # Transition to hold state
-                self.m_switch = 3
-                return
-
-            if self.m_switch == 3:
-                # Hold state
-                if self.m_hold_timestamp.expired():
-                    # Hold time has expired, now eligible for change
-                    self.m_hold_timestamp = None
-                    self.m_switch = 4
-                return
-
-            if self.m_switch == 4:
-                # Waiting here for detector change of state
-                if state == self.m_current_state:
-                    # No change in state
+                    hold_ms = self.m_inactive_hold_ms
+                    cmd_list = self.m_inactive_cmd_list
+                self.m_soak_deadline.cancel()
+                self.m_hold_deadline.start(hold_ms, self.m_soak_deadline.deadline_ms())
+                self.m_switch = Detector.c_switch_hold
+                self.execute_cmds(cmd_list)
+                continue
+
+            if self.m_switch == Detector.c_switch_hold:
+                if not self.m_hold_deadline.expired(p_now_ms):
                     return
-
-                # Detected state change, circle around to soak
-                self.m_switch = 1
-                return
-
-            if self.m_switch > 4:
-                # Invalid switch
-                raise Exception("Invalid detector switch  202412021835")
-                self.m_switch = 0
+                # Hold time has expired, now eligible for change
+                self.m_hold_deadline.cancel()
+                self.m_switch = Detector.c_switch_stable
+                if self.m_level != self.m_current_state:
+                    # Input changed during the hold time
+                    self.start_soak(self.m_level, self.m_hold_deadline.deadline_ms())
+                continue
 
             return
 
@@ -23,12 +23,18 @@
 # 
 #
 
-import Semaphore
-import Light
-
 class Head:
 
-    # Create a Rule object to encapsulates a single operating rule
+    # Class variables
+
+    # All heads in the order they appear in the config, and indexed by head-id
+    c_head_list = list()
+    c_head_index = dict()
+
+    # All lights indexed by ws281-id
+    c_ws281_index = dict()
+
+    # Create a Head object to hold the lights and semaphore of one head
     # @param p_head_id ID of the head
     #
     def __init__(self, p_head_id):
@@ -36,12 +42,75 @@ class Head:
         self.m_light_list = list()
         self.m_semaphore_list = list()
 
+        # The first light on this head with a color, indexed by color name
+        self.m_color_index = dict()
+
+        # The lights on this head indexed by ws281-id
+        self.m_ws281_index = dict()
+
+        # The semaphore of this head, or None.  A head has zero or one semaphores.
+        self.m_semaphore = None
+
+        # True while light output of this head is inhibited, typically
+        # while its semaphore is moving
+        self.m_inhibit = False
+
+        # Save the new instance in the class
+        Head.c_head_list.append(self)
+        Head.c_head_index[p_head_id] = self
+
+
+    # Find a head, creating it if this is the first reference to the head-id
+    # @param p_head_id ID of the head
+    # @returns The Head
+    #
+    @classmethod
+    def Get(p_class, p_head_id):
+        head = p_class.c_head_index.get(p_head_id)
+        if head is None:
+            head = Head(p_head_id)
+        return head
+
+
+    # @param p_head_id ID of the head
+    # @returns The Head, or None
+    #
+    @classmethod
+    def Find(p_class, p_head_id):
+        return p_class.c_head_index.get(p_head_id)
+
+
+    # @returns The number of created Head objects
+    #
+    @classmethod
+    def Count(p_class):
+        return len(p_class.c_head_list)
+
+
+    # Find the light at a position in the WS281 chain
+    # @param p_ws281_id The zero-based index of the LED in the WS281 chain
+    # @returns The matching Light, or None
+    #
+    @classmethod
+    def FindWs281(p_class, p_ws281_id):
+        return p_class.c_ws281_index.get(p_ws281_id)
+
 
     # Add a light to this signal head
     # @param p_light_obj A Light object
     #
     def add_light(self, p_light_obj):
         self.m_light_list.append(p_light_obj)
+        p_light_obj.m_head = self
+
+        # The first light wins, as with a search of the light list
+        for color in p_light_obj.m_color_list:
+            if color not in self.m_color_index:
+                self.m_color_index[color] = p_light_obj
+        if p_light_obj.m_ws281_id not in self.m_ws281_index:
+            self.m_ws281_index[p_light_obj.m_ws281_id] = p_light_obj
+        if p_light_obj.m_ws281_id not in Head.c_ws281_index:
+            Head.c_ws281_index[p_light_obj.m_ws281_id] = p_light_obj
 
 
     # Add a semaphore to this signal head.
@@ -49,6 +118,28 @@ class Head:
     #
     def add_semaphore(self, p_semaphore_obj):
         self.m_semaphore_list.append(p_semaphore_obj)
+        p_semaphore_obj.m_head = self
+        if self.m_semaphore is None:
+            self.m_semaphore = p_semaphore_obj
+
+
+    # @param p_color The color name
+    # @returns The Light on this head that can display the color, or None
+    #
+    def find_light(self, p_color):
+        return self.m_color_index.get(p_color)
+
+
+    # Inhibit the light output of this head.  Typically called by a
+    # Semaphore during movement, from the servo timer interrupt.
+    # @param p_inhibit The inhibit state, True for inhibit
+    #
+    def inhibit(self, p_inhibit):
+        if self.m_inhibit == p_inhibit:
+            return
+        self.m_inhibit = p_inhibit
+        for light in self.m_light_list:
+            light.request_update()
 
 
     # @returns The number of lights on this head
@@ -68,6 +159,8 @@ class Head:
     def __str__(self):
         s = "  head_id: "
         s += str(self.m_head_id)
+        s += ", inhibit:"
+        s += str(self.m_inhibit)
 
         for light in self.m_light_list:
             s += str(light)
@@ -77,4 +170,3 @@ class Head:
 
         s += "\n"
         return s
-
@@ -26,6 +26,7 @@
 import machine
 from machine import Pin, PWM, Timer
 import WS281
+import Deferred
 
 
 class Light:
@@ -36,6 +37,27 @@ class Light:
     # Class variable for generating timer id's
     c_timer_id = 1
 
+    # The single timer driving all flashing lights
+    c_timer = None
+
+    # Flash scheduler tick period in milliseconds, and its limits. Flash
+    # half-periods are rounded to c_min_tick_ms, and the tick never exceeds
+    # c_max_tick_ms so steady aspect changes are displayed promptly.
+    c_tick_ms = 0
+    c_min_tick_ms = 10
+    c_max_tick_ms = 100
+
+    # Flash groups, one entry per distinct flashes-per-minute rate.
+    # These are parallel lists indexed by the group number.
+    c_group_rate = list()       # flashes-per-minute of the group
+    c_group_ticks = list()      # Number of ticks in half a flash period
+    c_group_count = list()      # Ticks counted in the current half period
+    c_group_phase = list()      # True while the group's flashing lights are lit
+    c_group_lights = list()     # List of Lights in the group
+
+    # Set when any Light has requested an update outside of its flash phase
+    c_update_pending = False
+
     # Create a Light object
     # @param p_head_id The identifier (number) of the Head containing this light,
     #                  1 is the highest head, 2 is the next highest, etc
@@ -54,9 +76,12 @@ class Light:
         self.m_flashes_per_minute = p_flashes_per_minute
         self.m_color_list = p_color_list
         self.m_state_on = False
-        self.m_inhibit = False
+        # The Head of this light, set by Head.add_light()
+        self.m_head = None
         self.m_update_req = False
-        self.m_timer = None
+        self.m_group = None
+        self.m_half_period_ms = 0
+        self.m_black_index = None
         self.m_aspect_color = None
         self.m_aspect_intensity = 100
         self.m_aspect_flashing = False
@@ -66,13 +91,6 @@ class Light:
         Light.c_light_list.append(self)
 
 
-    # Destructor
-    #
-    def __del__(self):
-        if self.m_timer:
-            self.m_timer.deinit()
-
-
     # Initialize the hardware associated with Lights, if any.
     # Call this method after loading all Config but before executing Rules that change Aspects.
     # @param p_config The configuration object
@@ -81,34 +99,90 @@ class Light:
     def InitHardware(p_class, p_config):
         for light in p_class.c_light_list:
             light.init_hardware()
+        p_class.InitFlashScheduler()
 
 
-    # @returns The number of created Light objects
+    # Group the lights by flash rate and start the single flash timer.
+    # The timer runs at the greatest common divisor of all flash half-periods,
+    # and each group counts ticks until its own half-period has elapsed.
     #
     @classmethod
-    def Count(p_class):
-        return len(p_class.c_light_list)
+    def InitFlashScheduler(p_class):
+        tick_ms = p_class.c_max_tick_ms
+        for light in p_class.c_light_list:
+            if light.m_half_period_ms <= 0:
+                # Invalid flash rate, already logged by init_hardware()
+                continue
+
+            # Find or create the group for this flash rate
+            group = None
+            for i in range(len(p_class.c_group_rate)):
+                if p_class.c_group_rate[i] == light.m_flashes_per_minute:
+                    group = i
+                    break
+            if group is None:
+                group = len(p_class.c_group_rate)
+                p_class.c_group_rate.append(light.m_flashes_per_minute)
+                p_class.c_group_ticks.append(light.m_half_period_ms)
+                p_class.c_group_count.append(0)
+                p_class.c_group_phase.append(True)
+                p_class.c_group_lights.append(list())
+                tick_ms = gcd(tick_ms, light.m_half_period_ms)
+
+            light.m_group = group
+            p_class.c_group_lights[group].append(light)
+
+        if tick_ms < p_class.c_min_tick_ms:
+            tick_ms = p_class.c_min_tick_ms
+        p_class.c_tick_ms = tick_ms
+
+        # Convert the group half-periods from milliseconds to ticks
+        for i in range(len(p_class.c_group_ticks)):
+            ticks = p_class.c_group_ticks[i] // tick_ms
+            if ticks < 1:
+                ticks = 1
+            p_class.c_group_ticks[i] = ticks
+
+        if len(p_class.c_light_list) == 0:
+            # Nothing to flash
+            return
+
+        p_class.c_timer = machine.Timer(p_class.c_timer_id)
+        p_class.c_timer.init(mode=Timer.PERIODIC, period=tick_ms, callback=flashing_callback)
 
 
-    # Check the Light list for one that matches the input parameters
-    # @param p_head_id The Head ID of the Light to match
-    # @returns The matching Light, or None
+    # @returns The number of created Light objects
     #
     @classmethod
-    def CheckForMatch(p_class, p_head_id, p_color):
-        for light in p_class.c_light_list:
-            if p_head_id == light.m_head_id:
-                if p_color in light.m_color_list:
-                    return light
-        return None
+    def Count(p_class):
+        return len(p_class.c_light_list)
 
 
-    # Toggle lights with Aspect of "flashing"
+    # Called on every flash scheduler tick. Advances the phase counter of
+    # each flash group, and updates only the flashing lights of the groups
+    # that crossed a phase boundary, plus any light with a pending update.
     #
     @classmethod
     def AdjustFlash(p_class):
-        for light in p_class.c_light_list:
-            light.adjust_flash()
+        for group in range(len(p_class.c_group_count)):
+            count = p_class.c_group_count[group] + 1
+            if count < p_class.c_group_ticks[group]:
+                p_class.c_group_count[group] = count
+                continue
+
+            # Phase boundary, toggle the flashing lights of this group
+            p_class.c_group_count[group] = 0
+            phase = not p_class.c_group_phase[group]
+            p_class.c_group_phase[group] = phase
+            for light in p_class.c_group_lights[group]:
+                if light.m_aspect_flashing:
+                    light.adjust_flash(phase)
+
+        if p_class.c_update_pending:
+            p_class.c_update_pending = False
+            for light in p_class.c_light_list:
+                if light.m_update_req:
+                    light.adjust_flash(light.flash_phase())
 
 
     # Toggle lights with Aspect of "flashing"
@@ -120,111 +194,99 @@ class Light:
             light.adjust_intensity(p_intensity_percent)
 
 
-    # Turn all lights off. Called before changing Aspects
-    #
-    @classmethod
-    def AllOff(p_class):
-        for light in p_class.c_light_list:
-            light.off()
-
-
-    # This method will inhibit the output of a light.  Typically called by a
-    # Semaphore during movement.
-    # @param p_head_id The head-id of the light to inhibit
-    # @param p_inhibit The inhibit state, True for inhibit
-    #
-    @classmethod
-    def Inhibit(p_class, p_head_id, p_inhibit):
-        for light in p_class.c_light_list:
-            if p_head_id == light.m_head_id:
-                # Found the matching light
-                # Change inhibit state
-                light.m_inhibit = p_inhibit
-
-
     # Initialize Light hardware
-    # Note: this is performed in the WS281 driver
+    # Note: this is performed in the WS281 driver, and the flash timer
+    # is shared by all Lights, see InitFlashScheduler()
     #
     def init_hardware(self):
         # Save link to WS281 driver
         self.m_ws281 = WS281.WS281.c_ws281
-        # Start timer
-        self.m_timer = machine.Timer(Light.c_timer_id)
-        # Compute the timer interrupt period.
-        period = 60.0 / self.m_flashes_per_minute
-        # Halve the period, because we need two interrupts per flash (on then off).
-        period /= 2.0
-        # Convert from seconds to milliseconds
-        i_period = int(period * 1000.0)
-        if i_period <= 0:
+        self.m_black_index = self.m_ws281.m_black_index
+        # Compute the flash half-period, because we need two phases
+        # per flash (on then off), rounded to the minimum tick.
+        self.m_half_period_ms = 0
+        if self.m_flashes_per_minute > 0:
+            period = 30000 // self.m_flashes_per_minute
+            self.m_half_period_ms = (period // Light.c_min_tick_ms) * Light.c_min_tick_ms
+        if self.m_half_period_ms <= 0:
             msg = "Invalid value for flashes-per-minute ("
             msg += str(self.m_flashes_per_minute)
             msg += ") 202410170833"
             self.m_log.add("Light", msg)
-            return
-        self.m_timer.init(mode=Timer.PERIODIC, period=i_period, callback=flashing_callback)
 
 
     # Modify the aspect of this light
-    # @param p_color The name of the color to set.
+    # @param p_color_index The WS281 color number of the color to set.
     # @param p_flashing When True then make this light flash
     # @returns True on success, False if the requested state does not match
     #
-    def set_aspect(self, p_color, p_flashing):
-        self.m_aspect_color = p_color
+    def set_aspect(self, p_color_index, p_flashing):
+        self.m_aspect_color = p_color_index
         self.m_aspect_flashing = p_flashing
-        self.m_state_on = True
-        self.m_update_req = True
         # All LED updates are performed in the timer callback adjust_flash()
+        self.request_update()
         return True
 
 
     # Turn this light off
     #
     def off(self):
-        self.set_aspect("black", False)
+        self.set_aspect(self.m_black_index, False)
 
 
-    # Called by timer handler to toggle lights with Aspect of flashing
+    # Ask the flash scheduler to update this light on its next tick
     #
-    def adjust_flash(self):
-        if self.m_inhibit:
-            # Turn off LED - this is the highest priority action
-            self.m_ws281.set_color(self.m_ws281_id, "black", self.m_aspect_intensity, self.m_log)
-            return
-
-        if self.m_aspect_flashing:
-            # Update flashing on every interrupt
-            self.m_update_req = True
+    def request_update(self):
+        self.m_update_req = True
+        Light.c_update_pending = True
 
-        if not self.m_update_req:
-            # Nobody has requested an update
-            return
 
-        if self.m_state_on:
-            self.m_ws281.set_color(self.m_ws281_id, self.m_aspect_color, self.m_aspect_intensity, self.m_log)
-        else:
-            self.m_ws281.set_color(self.m_ws281_id, "black", self.m_aspect_intensity, self.m_log)
+    # @returns The current phase of this light's flash group, True when
+    #          flashing lights are lit
+    #
+    def flash_phase(self):
+        if self.m_group is None:
+            return True
+        return Light.c_group_phase[self.m_group]
 
-        # Update flashing state for next interrupt
-        if self.m_aspect_flashing:
-            if self.m_state_on:
-                self.m_state_on = False
-            else:
-                self.m_state_on = True
 
-        # Acknowledge the update has occured
+    # Called by the flash scheduler to update the LED of this light
+    # @param p_phase_on The phase of the flash group, True when flashing
+    #        lights are lit
+    #
+    def adjust_flash(self, p_phase_on):
+        # Acknowledge the update
         self.m_update_req = False
 
+        if self.m_head is not None and self.m_head.m_inhibit:
+            # Turn off LED - this is the highest priority action
+            on = False
+        elif self.m_aspect_flashing:
+            on = p_phase_on
+        else:
+            on = True
+
+        self.m_state_on = on
+        if on:
+            self.m_ws281.set_color(self.m_ws281_id, self.m_aspect_color, self.m_aspect_intensity, self.m_log)
+        else:
+            self.m_ws281.set_color(self.m_ws281_id, self.m_black_index, self.m_aspect_intensity, self.m_log)
+
 
     # Called by timer handler to toggle lights with Aspect of flashing
     # @param p_intensity_percent The intensity as a percentage 0-100
     #
     def adjust_intensity(self, p_intensity_percent):
-        self.m_aspect_intensity = int(p_intensity_percent)
+        intensity = int(p_intensity_percent)
+        if intensity < 0:
+            intensity = 0
+        elif intensity > 100:
+            intensity = 100
+        if intensity == self.m_aspect_intensity:
+            return
+        self.m_aspect_intensity = intensity
         # Change intensity
-        self.m_update_req = True
-        #self.adjust_flash()
+        self.request_update()
 
 
     # @returns A string representation of this Light
@@ -240,12 +302,17 @@ class Light:
         s += str(self.m_ws281_id)
         s += ", flashes-per-minute:"
         s += str(self.m_flashes_per_minute)
+        s += ", flash-group:"
+        s += str(self.m_group)
         s += ", state_on:"
         s += str(self.m_state_on)
         s += ", inhibit:"
-        s += str(self.m_inhibit)
+        s += str(self.m_head is not None and self.m_head.m_inhibit)
         s += ", aspect_color:"
-        s += str(self.m_aspect_color)
+        if self.m_ws281:
+            s += str(self.m_ws281.color_name(self.m_aspect_color))
+        else:
+            s += str(self.m_aspect_color)
         s += ", aspect_intensity:"
         s += str(self.m_aspect_intensity)
         s += ", aspect_flashing:"
@@ -253,9 +320,41 @@ class Light:
         return s
 
 
-# Timer callback to toggle lights with Aspect of flashing
+# @returns The greatest common divisor of p_a and p_b
+#
+def gcd(p_a, p_b):
+    while p_b:
+        p_a, p_b = p_b, p_a % p_b
+    return p_a
+
+
+# Timer callback to toggle lights with Aspect of flashing.
+# Must not allocate memory, see unit_test()
 #
 def flashing_callback(p_timer):
     Light.AdjustFlash()
+    # Push all pixel changes from this tick in a single write
+    WS281.WS281.Refresh()
+    # Retry a drain of the Deferred queue that could not be scheduled
+    Deferred.Deferred.Rearm()
+
+
+# Unit test: the flash timer callback must not allocate. Call from the REPL
+# after InitHardware().
+# @param p_ticks Number of simulated timer ticks
+#
+def unit_test(p_ticks=5000):
+    # Flash every light and force an update on every tick
+    for light in Light.c_light_list:
+        light.set_aspect(light.m_black_index, True)
+
+    def tick():
+        Light.c_update_pending = True
+        flashing_callback(None)
+
+    grown = Deferred.Deferred.HeapGrowth(tick, p_ticks)
+    if grown != 0:
+        print("Failed 1000 heap grew", grown, "bytes\n")
+    print("Unit tests completed\n")
 
 
@@ -28,6 +28,7 @@ from machine import ADC, Pin, Timer
 import Light
 import GPIO
 import Config
+import Deferred
 
 
 class LightLevel:
@@ -49,6 +50,7 @@ class LightLevel:
         self.m_adc = None
         self.m_adc_uv_max = 0
         self.m_timer = None
+        self.m_read_id = None
         LightLevel.c_light_level = self
 
 
@@ -98,6 +100,9 @@ class LightLevel:
         # This is the resulting value from read_uv() with max input
         self.m_adc_uv_max = 2667000
 
+        # The ADC is read outside of the timer interrupt
+        self.m_read_id = Deferred.Deferred.Register(read_light_level_deferred, self)
+
         # Start timer
         self.m_timer = machine.Timer(LightLevel.c_timer_id)
 
@@ -112,9 +117,10 @@ class LightLevel:
     # Read the current ambient light level and adjust the output Light levels
     #
     def read_light_level(self):
-        # Read the current microvolts and convert to percentage
+        # Read the current microvolts and convert to percentage,
+        # integer math only
         uv = self.m_adc.read_uv()
-        percent_intensity = (uv * 100) / self.m_adc_uv_max
+        percent_intensity = (uv * 100) // self.m_adc_uv_max
 
         # Keep within the configured min/max levels
         if percent_intensity < self.m_light_level_min_percent:
@@ -123,15 +129,23 @@ class LightLevel:
             percent_intensity = self.m_light_level_max_percent
 
         # Check if the intensity level has changed
-        if int(self.m_percent_intensity_prev) == int(percent_intensity):
+        if self.m_percent_intensity_prev == percent_intensity:
             return
 
         Light.Light.AdjustIntensity(percent_intensity)
         self.m_percent_intensity_prev = percent_intensity
 
 
-# Timer callback to read ambient light level and adjust Light output levels
+# Timer callback to read ambient light level and adjust Light output levels.
+# The ADC read is deferred out of the interrupt handler.
 #
 def light_level_callback(p_timer):
-    LightLevel.c_light_level.read_light_level()
+    Deferred.Deferred.Post(LightLevel.c_light_level.m_read_id)
+
+
+# Deferred work registered by init_hardware()
+# @param p_light_level The LightLevel object
+#
+def read_light_level_deferred(p_light_level):
+    p_light_level.read_light_level()
 
@@ -23,24 +23,67 @@
 # 
 #
 
+
+import time
+import gc
+from array import array
 import Timestamp
 
 class Log:
 
     # Class variables
 
-    # The log is stored in these parallel lists, limited in size
-    # by c_log_limit
-    c_log_time = list()
-    c_log_source = list()
-    c_log_text = list()
-
     # Limits the number of lines maintained in c_log_xxx
     c_log_limit = 32
 
+    # The log is a ring of c_log_limit entries stored in these parallel
+    # arrays.  An entry keeps the raw time in seconds, the id of its
+    # interned source and a reference to its text.  Strings are formatted
+    # only when an entry is read.
+    c_log_time = array('L', [0] * 32)
+    c_log_source = array('H', [0] * 32)
+    c_log_text = [None] * 32
+
+    # Repeats of the same message from the same source are collapsed into
+    # one entry, with the number of repeats and the time of the last one
+    c_log_repeat = array('H', [0] * 32)
+    c_log_last = array('L', [0] * 32)
+
+    # Ring index of the oldest entry, and the number of entries
+    c_log_head = 0
+    c_log_count = 0
+
+    # The number of entries ever added
+    c_log_total = 0
+
+    # Interned source names, indexed by source id.  The table is rebuilt
+    # from the sources still in the ring when it reaches c_source_limit.
+    c_source_list = list()
+    c_source_index = dict()
+    c_source_limit = 64
+
+    # Per source id: the ring index of its newest entry or -1, and its
+    # token bucket in thousandths of an entry with the time of the last refill
+    c_source_newest = array('h', [-1] * 64)
+    c_source_tokens = array('l', [0] * 64)
+    c_source_refill_ms = array('l', [0] * 64)
+
+    # Entries per second allowed from each source, 0 for no limit, and
+    # the number of entries a source may add at once
+    c_rate = 0
+    c_burst = 32
+
+    # Entries dropped by the rate limit, and repeats collapsed, by source name
+    c_dropped = dict()
+    c_collapsed = dict()
+
     # Save a reference to the Config
     c_config = None
 
+    # Function called with no arguments after each new entry, or None.
+    # It must not allocate, add() may run from a scheduled interrupt callback.
+    c_add_hook = None
+
     # Initialize
     #
     def __init__(self):
@@ -52,50 +95,270 @@ class Log:
     @classmethod
     def SetConfig(p_class, p_config):
         Log.c_config = p_config
+        p_class.SetCapacity(p_config.m_log_size)
+        p_class.SetRateLimit(p_config.m_log_rate, p_config.m_log_burst)
 
 
-    # Add new entry to the log
+    # Limit the rate of entries from each source
+    # @param p_rate Entries per second, 0 for no limit
+    # @param p_burst The number of entries a source may add at once
+    #
+    @classmethod
+    def SetRateLimit(p_class, p_rate, p_burst):
+        p_class.c_rate = p_rate
+        p_class.c_burst = max(1, p_burst)
+        for i in range(len(p_class.c_source_list)):
+            p_class.c_source_tokens[i] = p_class.c_burst * 1000
+
+
+    # Change the number of entries kept in the log, keeping the newest entries
+    # @param p_limit The number of entries
+    #
+    @classmethod
+    def SetCapacity(p_class, p_limit):
+        if p_limit < 1:
+            raise Exception('Log: Invalid size 202610171111')
+        if p_limit == p_class.c_log_limit:
+            return
+        count = min(p_class.c_log_count, p_limit)
+        first = p_class.c_log_count - count
+        log_time = array('L', [0] * p_limit)
+        log_source = array('H', [0] * p_limit)
+        log_text = [None] * p_limit
+        log_repeat = array('H', [0] * p_limit)
+        log_last = array('L', [0] * p_limit)
+        for i in range(count):
+            index = p_class.ring_index(first + i)
+            log_time[i] = p_class.c_log_time[index]
+            log_source[i] = p_class.c_log_source[index]
+            log_text[i] = p_class.c_log_text[index]
+            log_repeat[i] = p_class.c_log_repeat[index]
+            log_last[i] = p_class.c_log_last[index]
+        p_class.c_log_time = log_time
+        p_class.c_log_source = log_source
+        p_class.c_log_text = log_text
+        p_class.c_log_repeat = log_repeat
+        p_class.c_log_last = log_last
+        p_class.c_log_limit = p_limit
+        p_class.c_log_head = 0
+        p_class.c_log_count = count
+        p_class.c_source_limit = max(64, p_limit + 16)
+        p_class.CompactSources()
+
+
+    # @param p_index Zero is the oldest entry, 1 the next oldest, etc
+    # @returns The position of the entry in the ring
+    #
+    @classmethod
+    def ring_index(p_class, p_index):
+        index = p_class.c_log_head + p_index
+        if index >= p_class.c_log_limit:
+            index -= p_class.c_log_limit
+        return index
+
+
+    # Intern a source name
+    # @param p_source Name of the source
+    # @returns The source id
+    #
+    @classmethod
+    def SourceId(p_class, p_source):
+        source_id = p_class.c_source_index.get(p_source)
+        if source_id is not None:
+            return source_id
+        if len(p_class.c_source_list) >= p_class.c_source_limit:
+            p_class.CompactSources()
+        source_id = len(p_class.c_source_list)
+        p_class.c_source_list.append(p_source)
+        p_class.c_source_index[p_source] = source_id
+        p_class.c_source_newest[source_id] = -1
+        p_class.c_source_tokens[source_id] = p_class.c_burst * 1000
+        p_class.c_source_refill_ms[source_id] = time.ticks_ms()
+        return source_id
+
+
+    # Rebuild the source table with only the sources still in the ring
+    #
+    @classmethod
+    def CompactSources(p_class):
+        limit = p_class.c_source_limit
+        source_list = list()
+        source_index = dict()
+        source_newest = array('h', [-1] * limit)
+        source_tokens = array('l', [0] * limit)
+        source_refill_ms = array('l', [0] * limit)
+        for i in range(p_class.c_log_count):
+            index = p_class.ring_index(i)
+            old_id = p_class.c_log_source[index]
+            name = p_class.c_source_list[old_id]
+            source_id = source_index.get(name)
+            if source_id is None:
+                source_id = len(source_list)
+                source_list.append(name)
+                source_index[name] = source_id
+                source_tokens[source_id] = p_class.c_source_tokens[old_id]
+                source_refill_ms[source_id] = p_class.c_source_refill_ms[old_id]
+            p_class.c_log_source[index] = source_id
+            # Entries are visited oldest first, so the last one is the newest
+            source_newest[source_id] = index
+        p_class.c_source_list = source_list
+        p_class.c_source_index = source_index
+        p_class.c_source_newest = source_newest
+        p_class.c_source_tokens = source_tokens
+        p_class.c_source_refill_ms = source_refill_ms
+
+
+    # Take one entry from the token bucket of a source
+    # @param p_source_id The source id
+    # @returns True if the source may add an entry
+    #
+    @classmethod
+    def TakeToken(p_class, p_source_id):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, p_class.c_source_refill_ms[p_source_id])
+        p_class.c_source_refill_ms[p_source_id] = now
+        full = p_class.c_burst * 1000
+        if elapsed > full:
+            # Long enough to fill the bucket at any rate of 1 or more
+            tokens = full
+        else:
+            tokens = p_class.c_source_tokens[p_source_id] + elapsed * p_class.c_rate
+            if tokens > full:
+                tokens = full
+        if tokens < 1000:
+            p_class.c_source_tokens[p_source_id] = tokens
+            return False
+        p_class.c_source_tokens[p_source_id] = tokens - 1000
+        return True
+
+
+    # @param p_text The text of a new entry
+    # @param p_old_text The text of an earlier entry
+    # @returns True if both are the same message.  Messages that end
+    #          with the same 12 digit message code are the same message.
+    #
+    @staticmethod
+    def SameMessage(p_text, p_old_text):
+        if p_text is p_old_text or p_text == p_old_text:
+            return True
+        if len(p_text) < 13 or len(p_old_text) < 13:
+            return False
+        # Check single characters first, which does not allocate
+        if p_text[-13] != " " or p_old_text[-13] != " ":
+            return False
+        if not p_text[-1].isdigit() or not p_text[-12].isdigit():
+            return False
+        return p_text[-12:] == p_old_text[-12:]
+
+
+    # Add new entry to the log.  Only references are stored, so adding an
+    # entry from a known source does not allocate.
+    # A repeat of the newest message of the source is counted in that
+    # entry, and entries beyond the rate limit of the source are dropped.
     # @param p_source Name of the source associated with the log entry
     # @param p_text Test string to add to the log
     #
     def add(self, p_source, p_text):
-        # Add the log entry
-        ts = Timestamp.Timestamp()
-        Log.c_log_time.append(str(ts))
         if p_source is None:
             raise Exception('Log: Undefined source 202402181548')
-        Log.c_log_source.append(p_source)
         if p_text is None:
             raise Exception('Log: Undefined text 202402181549')
-        Log.c_log_text.append(p_text)
-        #print(str(ts), p_source, p_text)
+        source_id = Log.c_source_index.get(p_source)
+        if source_id is None:
+            source_id = Log.SourceId(p_source)
+
+        index = Log.c_source_newest[source_id]
+        if index >= 0 and Log.c_log_source[index] == source_id and \
+                Log.SameMessage(p_text, Log.c_log_text[index]):
+            if Log.c_log_repeat[index] < 65535:
+                Log.c_log_repeat[index] += 1
+            Log.c_log_last[index] = int(time.time())
+            Log.c_collapsed[p_source] = Log.c_collapsed.get(p_source, 0) + 1
+            return
+
+        if Log.c_rate and not Log.TakeToken(source_id):
+            Log.c_dropped[p_source] = Log.c_dropped.get(p_source, 0) + 1
+            return
+
+        # Overwrite the oldest entry when the ring is full
+        if Log.c_log_count < Log.c_log_limit:
+            index = Log.ring_index(Log.c_log_count)
+            Log.c_log_count += 1
+        else:
+            index = Log.c_log_head
+            Log.c_log_head = Log.ring_index(1)
+
+        now = int(time.time())
+        Log.c_log_time[index] = now
+        Log.c_log_source[index] = source_id
+        Log.c_log_text[index] = p_text
+        Log.c_log_repeat[index] = 0
+        Log.c_log_last[index] = now
+        Log.c_source_newest[source_id] = index
+        Log.c_log_total += 1
+        if Log.c_add_hook:
+            Log.c_add_hook()
+
 
-        # Remove oldest entry if necessary
-        if (len(Log.c_log_time) > Log.c_log_limit):
-            Log.c_log_time.pop(0)
-            Log.c_log_source.pop(0)
-            Log.c_log_text.pop(0)
-            #print("popped oldest log")
+    # Get the raw values of an entry in the log
+    # @param p_index Zero gets the oldest entry, 1 gets the next
+    #                oldest entry, etc
+    # @returns A tuple of (time in seconds, source, text), or None
+    #
+    def get_entry(self, p_index):
+        if p_index < 0 or p_index >= Log.c_log_count:
+            return None
+        index = Log.ring_index(p_index)
+        return (Log.c_log_time[index], Log.c_source_list[Log.c_log_source[index]], Log.c_log_text[index])
+
+
+    # @param p_index Zero gets the oldest entry, 1 gets the next
+    #                oldest entry, etc
+    # @returns A tuple of (number of repeats, time of the last repeat in
+    #          seconds) of an entry in the log, or None
+    #
+    def get_repeats(self, p_index):
+        if p_index < 0 or p_index >= Log.c_log_count:
+            return None
+        index = Log.ring_index(p_index)
+        return (Log.c_log_repeat[index], Log.c_log_last[index])
+
+
+    # Format an entry of the log
+    # @param p_entry A tuple from get_entry()
+    # @param p_repeats A tuple from get_repeats(), or None
+    # @returns The string of the log entry
+    #
+    def format_entry(self, p_entry, p_repeats=None):
+        (entry_time, source, text) = p_entry
+        s = Timestamp.Timestamp.Format(entry_time)
+        s += " "
+        if Log.c_config and Log.c_config.m_tz_abbrev:
+            s += Log.c_config.m_tz_abbrev
+            s += " "
+        s += source
+        s += " "
+        s += text
+        if p_repeats and p_repeats[0]:
+            s += " (repeated "
+            s += str(p_repeats[0])
+            s += " times, last "
+            s += Timestamp.Timestamp.Format(p_repeats[1])
+            s += ")"
+        return s
 
 
     # Get an entry from the log
-    # @param p_index Zero gets the most recent entry, 1 gets the next
-    #                most recent entry, etc
+    # @param p_index Zero gets the oldest entry, 1 gets the next
+    #                oldest entry, etc
     # @returns A list containing the string of the specified log entry
     #
     def get_single(self, p_index):
         l = list()
-        if (p_index >= len(Log.c_log_time)):
+        entry = self.get_entry(p_index)
+        if entry is None:
             return l
-        s = str(Log.c_log_time[p_index])
-        s += " "
-        if Log.c_config.m_tz_abbrev:
-            s += Log.c_config.m_tz_abbrev
-            s += " "
-        s += Log.c_log_source[p_index]
-        s += " "
-        s += Log.c_log_text[p_index]
-        l.append(s)
+        l.append(self.format_entry(entry, self.get_repeats(p_index)))
         return l
 
 
@@ -104,9 +367,8 @@ class Log:
     #
     def get_all(self):
         l = list()
-        for i in range(len(Log.c_log_time)):
-            s = self.get_single(i)[0]
-            l.append(s)
+        for i in range(Log.c_log_count):
+            l.append(self.format_entry(self.get_entry(i), self.get_repeats(i)))
         return l
 
 
@@ -115,16 +377,63 @@ class Log:
     #
     def get_all_rev(self):
         l = list()
-        for i in range(len(Log.c_log_time)-1, -1):
-            s = self.get_single(i)
+        for i in range(Log.c_log_count - 1, -1, -1):
+            l.append(self.format_entry(self.get_entry(i), self.get_repeats(i)))
+        return l
+
+
+    # Get the entries in the log at or after a time
+    # @param p_time The time in seconds
+    # @return A list of log entries, oldest to newest
+    #
+    def get_since(self, p_time):
+        l = list()
+        for i in range(Log.c_log_count):
+            entry = self.get_entry(i)
+            if entry[0] >= p_time:
+                l.append(self.format_entry(entry, self.get_repeats(i)))
+        return l
+
+
+    # @returns A list of lines with the entries dropped by the rate limit
+    #          and the repeats collapsed, by source
+    #
+    def get_stats(self):
+        l = list()
+        names = list(Log.c_dropped)
+        for name in Log.c_collapsed:
+            if name not in Log.c_dropped:
+                names.append(name)
+        names.sort()
+        for name in names:
+            s = name
+            s += ": dropped "
+            s += str(Log.c_dropped.get(name, 0))
+            s += ", repeated "
+            s += str(Log.c_collapsed.get(name, 0))
             l.append(s)
+        if Log.c_rate:
+            s = "Limit "
+            s += str(Log.c_rate)
+            s += " per second, burst "
+            s += str(Log.c_burst)
+        else:
+            s = "No rate limit"
+        l.append(s)
         return l
 
 
+    # Clear the counts of dropped and repeated entries
+    #
+    def reset_stats(self):
+        Log.c_dropped = dict()
+        Log.c_collapsed = dict()
+
+
     # @returns The number of entries in the log
     #
     def get_num_entries(self):
-        return len(Log.c_log_time)
+        return Log.c_log_count
 
 
     def unit_test(self):
@@ -146,5 +455,102 @@ class Log:
         if (log2.get_num_entries() != Log.c_log_limit):
             print("Failed 1020\n")
 
-        print("Unit tests completed\n") 
+        # The ring keeps the newest entries, oldest first
+        if log2.get_entry(Log.c_log_limit - 1)[2] != "Message X":
+            print("Failed 1030\n")
+        if log2.get_entry(0)[2] != "Message 1":
+            print("Failed 1040\n")
+
+        # Shrinking keeps the newest entries
+        Log.SetCapacity(4)
+        if log2.get_num_entries() != 4 or log2.get_entry(3)[1] != "EFG":
+            print("Failed 1050\n")
+
+        # The source table is rebuilt when full
+        for i in range(Log.c_source_limit + 8):
+            log2.add("source" + str(i), "Message")
+        if len(Log.c_source_list) > Log.c_source_limit:
+            print("Failed 1060\n")
+        if log2.get_entry(3)[1] != "source" + str(Log.c_source_limit + 7):
+            print("Failed 1070\n")
+        Log.SetCapacity(32)
+
+        # Repeats of the newest message of a source are collapsed
+        log2.add("Repeat", "No matching color in chart 202410160905")
+        count = log2.get_num_entries()
+        log2.add("Repeat", "No matching color in chart 202410160905")
+        log2.add("Repeat", "Different text 202410160905")
+        if log2.get_num_entries() != count or log2.get_repeats(count - 1)[0] != 2:
+            print("Failed 1080\n")
+        log2.add("Repeat", "Message 202410160906")
+        if log2.get_num_entries() != count + 1:
+            print("Failed 1090\n")
+
+        # The rate limit drops entries beyond the burst
+        Log.SetRateLimit(1, 4)
+        for i in range(10):
+            log2.add("Flood", "Message " + str(i))
+        if Log.c_dropped.get("Flood") != 6:
+            print("Failed 1100\n")
+        Log.SetRateLimit(0, 32)
+        log2.reset_stats()
+
+        print("Unit tests completed\n")
+
+
+# Benchmark the ring against the previous list implementation, which
+# formatted the time on every add and evicted with pop(0).
+# @param p_count Number of entries added
+# @param p_limit Capacity of the log
+# @returns A list of (name, bytes per add, us per add)
+#
+def benchmark(p_count=1000, p_limit=32):
+
+    class ListLog:
+        c_log_time = list()
+        c_log_source = list()
+        c_log_text = list()
+
+        def add(self, p_source, p_text):
+            ListLog.c_log_time.append(str(Timestamp.Timestamp()))
+            ListLog.c_log_source.append(p_source)
+            ListLog.c_log_text.append(p_text)
+            if (len(ListLog.c_log_time) > p_limit):
+                ListLog.c_log_time.pop(0)
+                ListLog.c_log_source.pop(0)
+                ListLog.c_log_text.pop(0)
+
+    names = ("c_log_limit", "c_log_time", "c_log_source", "c_log_text",
+        "c_log_repeat", "c_log_last", "c_log_head", "c_log_count", "c_log_total",
+        "c_source_list", "c_source_index", "c_source_limit", "c_source_newest",
+        "c_source_tokens", "c_source_refill_ms", "c_rate", "c_dropped", "c_collapsed")
+    saved = [getattr(Log, name) for name in names]
 
+    # Different messages, so the ring does not collapse them
+    texts = ["Activated: " + str(i) for i in range(8)]
+    results = list()
+    try:
+        # Start from an empty ring without a rate limit
+        Log.c_log_count = 0
+        Log.c_log_limit = 0
+        Log.SetCapacity(p_limit)
+        Log.c_rate = 0
+        Log.c_dropped = dict()
+        Log.c_collapsed = dict()
+        for (name, log, count) in (("ring", Log(), 8), ("ring repeat", Log(), 1), ("list", ListLog(), 8)):
+            # Fill the log first, so every measured add evicts an entry
+            for i in range(p_limit):
+                log.add("Rules", texts[i % count])
+            gc.collect()
+            before = gc.mem_alloc()
+            start = time.ticks_us()
+            for i in range(p_count):
+                log.add("Rules", texts[i % count])
+            elapsed_us = time.ticks_diff(time.ticks_us(), start)
+            allocated = gc.mem_alloc() - before
+            print(name, "bytes per add:", allocated / p_count, "us per add:", elapsed_us / p_count)
+            results.append((name, allocated / p_count, elapsed_us / p_count))
+    finally:
+        for i in range(len(names)):
+            setattr(Log, names[i], saved[i])
+    return results
@@ -0,0 +1,409 @@
+#
+# Persistent Log in flash for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+import os
+import struct
+import Log
+
+# The Log is kept in RAM and lost on every reset.  LogFile copies new Log
+# entries to flash in batches, as fixed size binary records in a pair of
+# rotating segment files.  When the active segment is full the other one
+# is truncated and becomes active, so flash holds between one and two
+# segments of the newest records.
+
+class LogFile:
+
+    # Class variables
+
+    # The singleton, or None when the persistent log is disabled
+    c_log_file = None
+
+    # Record layout: sequence, time, time of the last repeat, repeats,
+    # source length and text length, followed by the source and text
+    c_format = "<IIIHBB"
+    c_header_size = 16
+    c_source_max = 24
+    c_text_max = 88
+    c_record_size = 128
+
+    # The time of the last repeat and the repeats, rewritten in place when
+    # more repeats collapse into the newest record after it was flushed
+    c_repeats_format = "<IH"
+    c_repeats_offset = 8
+
+    # Most lines returned by a query
+    c_line_limit = 64
+
+    # Create the persistent log and find the newest records in flash
+    # @param p_file_name Base name of the segment files, ".0" and ".1" are appended
+    # @param p_records Number of records in each segment
+    # @param p_log Reference to the Log object
+    #
+    def __init__(self, p_file_name, p_records, p_log):
+        self.m_log = p_log
+        self.m_file_names = (p_file_name + ".0", p_file_name + ".1")
+        self.m_records = p_records
+        self.m_counts = [0, 0]
+        self.m_active = 0
+        self.m_next_sequence = 0
+
+        # Log.c_log_total at the last flush, entries since are in RAM only
+        self.m_flushed_total = Log.Log.c_log_total - Log.Log.c_log_count
+
+        # Entries overwritten in the RAM ring before they were flushed
+        self.m_missed = 0
+
+        # (segment, record) of the newest record written, and the repeats
+        # of its Log entry when it was written
+        self.m_last_position = None
+        self.m_last_repeats = None
+
+        last = [None, None]
+        for segment in (0, 1):
+            try:
+                size = os.stat(self.m_file_names[segment])[6]
+            except OSError:
+                size = 0
+            # A record cut short by a reset is overwritten by the next flush
+            count = size // LogFile.c_record_size
+            if count > self.m_records:
+                count = self.m_records
+            self.m_counts[segment] = count
+            if count > 0:
+                last[segment] = self.read_header(segment, count - 1)[0]
+
+        # The active segment holds the newest record
+        if last[1] is not None and (last[0] is None or last[1] > last[0]):
+            self.m_active = 1
+        newest = last[self.m_active]
+        if newest is not None:
+            self.m_next_sequence = newest + 1
+
+        # Save this singleton
+        LogFile.c_log_file = self
+
+
+    # Flush the persistent log, if enabled.  Call before a reset.
+    #
+    @classmethod
+    def Flush(p_class):
+        if p_class.c_log_file:
+            p_class.c_log_file.flush()
+
+
+    # @returns The number of records in flash
+    #
+    def record_count(self):
+        return self.m_counts[0] + self.m_counts[1]
+
+
+    # @param p_index Zero is the oldest record in flash, 1 the next oldest, etc
+    # @returns A tuple of (segment, record number in the segment)
+    #
+    def locate(self, p_index):
+        older = 1 - self.m_active
+        if p_index < self.m_counts[older]:
+            return (older, p_index)
+        return (self.m_active, p_index - self.m_counts[older])
+
+
+    # Read the header of one record
+    # @param p_segment The segment, 0 or 1
+    # @param p_record The record number in the segment
+    # @returns A tuple of (sequence, time, last time, repeats, source length, text length)
+    #
+    def read_header(self, p_segment, p_record):
+        fs = open(self.m_file_names[p_segment], "rb")
+        try:
+            fs.seek(p_record * LogFile.c_record_size)
+            return struct.unpack(LogFile.c_format, fs.read(LogFile.c_header_size))
+        finally:
+            fs.close()
+
+
+    # Write the Log entries added since the last flush, in one write per
+    # segment.  Repeats collapsed into the newest record since it was
+    # written are updated in place.
+    #
+    def flush(self):
+        total = Log.Log.c_log_total
+        oldest = total - Log.Log.c_log_count
+        start = self.m_flushed_total
+        log = Log.Log()
+        if self.m_last_position is not None and start - 1 >= oldest:
+            repeats = log.get_repeats(start - 1 - oldest)
+            if repeats != self.m_last_repeats:
+                self.rewrite_repeats(repeats)
+        if start < oldest:
+            self.m_missed += oldest - start
+            start = oldest
+        flushed = start < total
+        while start < total:
+            room = self.m_records - self.m_counts[self.m_active]
+            count = min(room, total - start)
+            buf = bytearray(count * LogFile.c_record_size)
+            for i in range(count):
+                index = start + i - oldest
+                self.pack(buf, i * LogFile.c_record_size, log.get_entry(index), log.get_repeats(index))
+            self.write(buf, count)
+            start += count
+        self.m_flushed_total = total
+        if flushed:
+            self.m_last_repeats = log.get_repeats(total - 1 - oldest)
+
+
+    # Encode one Log entry into a record
+    # @param p_buf The buffer of records
+    # @param p_offset The offset of the record in p_buf
+    # @param p_entry A tuple from Log.get_entry()
+    # @param p_repeats A tuple from Log.get_repeats()
+    #
+    def pack(self, p_buf, p_offset, p_entry, p_repeats):
+        (entry_time, source, text) = p_entry
+        source = source.encode()[:LogFile.c_source_max]
+        text = text.encode()[:LogFile.c_text_max]
+        struct.pack_into(LogFile.c_format, p_buf, p_offset, self.m_next_sequence, entry_time,
+            p_repeats[1], p_repeats[0], len(source), len(text))
+        offset = p_offset + LogFile.c_header_size
+        p_buf[offset:offset + len(source)] = source
+        offset += LogFile.c_source_max
+        p_buf[offset:offset + len(text)] = text
+        self.m_next_sequence += 1
+
+
+    # Append records to the active segment, and rotate when it is full
+    # @param p_buf The records
+    # @param p_count The number of records in p_buf
+    #
+    def write(self, p_buf, p_count):
+        segment = self.m_active
+        try:
+            if self.m_counts[segment] == 0:
+                # Truncate the segment
+                fs = open(self.m_file_names[segment], "wb")
+            else:
+                fs = open(self.m_file_names[segment], "r+b")
+                fs.seek(self.m_counts[segment] * LogFile.c_record_size)
+            fs.write(p_buf)
+            fs.close()
+        except OSError:
+            self.m_log.add("LogFile", "Failed to write " + self.m_file_names[segment] + " 202610171112")
+            self.m_last_position = None
+            return
+        self.m_last_position = (segment, self.m_counts[segment] + p_count - 1)
+        self.m_counts[segment] += p_count
+        if self.m_counts[segment] >= self.m_records:
+            self.m_active = 1 - segment
+            self.m_counts[self.m_active] = 0
+
+
+    # Update the repeats of the newest record written
+    # @param p_repeats A tuple from Log.get_repeats()
+    #
+    def rewrite_repeats(self, p_repeats):
+        (segment, record) = self.m_last_position
+        try:
+            fs = open(self.m_file_names[segment], "r+b")
+            fs.seek(record * LogFile.c_record_size + LogFile.c_repeats_offset)
+            fs.write(struct.pack(LogFile.c_repeats_format, p_repeats[1], p_repeats[0]))
+            fs.close()
+        except OSError:
+            self.m_log.add("LogFile", "Failed to write " + self.m_file_names[segment] + " 202610171112")
+            return
+        self.m_last_repeats = p_repeats
+
+
+    # Read records from flash
+    # @param p_first The index of the first record, zero is the oldest
+    # @param p_count The number of records
+    # @returns A list of tuples of (time, source, text, repeats, last time)
+    #
+    def read_records(self, p_first, p_count):
+        records = list()
+        fs = None
+        segment = None
+        for index in range(p_first, p_first + p_count):
+            (seg, record) = self.locate(index)
+            if seg != segment:
+                if fs:
+                    fs.close()
+                segment = seg
+                fs = open(self.m_file_names[segment], "rb")
+                fs.seek(record * LogFile.c_record_size)
+            data = fs.read(LogFile.c_record_size)
+            (sequence, entry_time, last_time, repeats, source_len, text_len) = \
+                struct.unpack_from(LogFile.c_format, data, 0)
+            offset = LogFile.c_header_size
+            source = data[offset:offset + source_len].decode()
+            offset += LogFile.c_source_max
+            text = data[offset:offset + text_len].decode()
+            records.append((entry_time, source, text, repeats, last_time))
+        if fs:
+            fs.close()
+        return records
+
+
+    # Find the first record at or after a time, by binary search over the
+    # record index.  Assumes the clock did not go backwards, as it does
+    # when a reset happens before NTP has set it.
+    # @param p_time The time in seconds
+    # @returns The index of the record, or record_count() if there is none
+    #
+    def find_time(self, p_time):
+        low = 0
+        high = self.record_count()
+        while low < high:
+            middle = (low + high) // 2
+            (segment, record) = self.locate(middle)
+            if self.read_header(segment, record)[1] < p_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    # Format records from flash followed by entries from the Log
+    # @param p_first The index of the first record in flash
+    # @param p_count The number of records from flash
+    # @param p_ram_first The index in the Log of the first entry to include
+    # @param p_time Only include Log entries at or after this time
+    # @returns A list of strings, oldest to newest, at most c_line_limit
+    #
+    def format_lines(self, p_first, p_count, p_ram_first, p_time=0):
+        log = Log.Log()
+        lines = list()
+        count = min(p_count, LogFile.c_line_limit)
+        for (entry_time, source, text, repeats, last_time) in self.read_records(p_first, count):
+            lines.append(log.format_entry((entry_time, source, text), (repeats, last_time)))
+        for index in range(p_ram_first, log.get_num_entries()):
+            if len(lines) >= LogFile.c_line_limit:
+                break
+            entry = log.get_entry(index)
+            if entry[0] >= p_time:
+                lines.append(log.format_entry(entry, log.get_repeats(index)))
+        return lines
+
+
+    # @returns The number of records in flash older than the oldest Log
+    #          entry.  Newer records are also in the Log.
+    #
+    def older_count(self):
+        oldest = Log.Log.c_log_total - Log.Log.c_log_count
+        flushed = max(0, self.m_flushed_total - oldest)
+        return max(0, self.record_count() - flushed)
+
+
+    # Get the newest entries from flash and RAM, as many as the Log holds
+    # @returns A list of strings, oldest to newest
+    #
+    def get_all(self):
+        older = self.older_count()
+        count = max(0, min(older, Log.Log.c_log_limit - Log.Log.c_log_count))
+        return self.format_lines(older - count, count, 0)
+
+
+    # Get one entry of the list returned by get_all(), reading at most one
+    # record from flash
+    # @param p_index Zero gets the oldest entry, 1 gets the next oldest, etc
+    # @returns A list of one string, or an empty list if there is no
+    #          such entry
+    #
+    def get_single(self, p_index):
+        if p_index < 0:
+            return list()
+        log = Log.Log()
+        older = self.older_count()
+        count = max(0, min(older, Log.Log.c_log_limit - Log.Log.c_log_count))
+        if p_index >= count:
+            return log.get_single(p_index - count)
+        (entry_time, source, text, repeats, last_time) = self.read_records(older - count + p_index, 1)[0]
+        return [log.format_entry((entry_time, source, text), (repeats, last_time))]
+
+
+    # Get the entries from flash and RAM at or after a time
+    # @param p_time The time in seconds
+    # @returns A list of strings, oldest to newest, at most c_line_limit
+    #
+    def get_since(self, p_time):
+        older = self.older_count()
+        first = min(self.find_time(p_time), older)
+        return self.format_lines(first, older - first, 0, p_time)
+
+
+    # @returns A string with the state of the persistent log
+    #
+    def __str__(self):
+        s = "Log file: "
+        s += self.m_file_names[self.m_active]
+        s += ", records: "
+        s += str(self.record_count())
+        s += ", next sequence: "
+        s += str(self.m_next_sequence)
+        s += ", missed: "
+        s += str(self.m_missed)
+        return s
+
+
+# Unit test: write more than two segments and read them back.  Run on the
+# device or on a host from a scratch directory.
+# @param p_file_name Base name of the segment files
+#
+def unit_test(p_file_name="test.log"):
+    for name in (p_file_name + ".0", p_file_name + ".1"):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+    log = Log.Log()
+    log_file = LogFile(p_file_name, 8, log)
+    for i in range(20):
+        log.add("Test", "Message " + str(i))
+        if i % 3 == 0:
+            log_file.flush()
+    log_file.flush()
+    if log_file.record_count() != 12:
+        print("Failed 1000 count", log_file.record_count(), "\n")
+    records = log_file.read_records(0, log_file.record_count())
+    if records[0][2] != "Message 8" or records[-1][2] != "Message 19":
+        print("Failed 1010\n")
+
+    # The newest records are found again after a reset
+    log_file = LogFile(p_file_name, 8, log)
+    if log_file.m_next_sequence != 20 or log_file.record_count() != 12:
+        print("Failed 1020\n")
+    if log_file.find_time(0) != 0 or log_file.find_time(records[-1][0] + 1) != 12:
+        print("Failed 1030\n")
+
+    # Repeats collapsed after a flush reach the record in flash
+    log.add("Test", "Repeated")
+    log_file.flush()
+    log.add("Test", "Repeated")
+    log.add("Test", "Repeated")
+    log_file.flush()
+    record = log_file.read_records(log_file.record_count() - 1, 1)[0]
+    if record[2] != "Repeated" or record[3] != log.get_repeats(log.get_num_entries() - 1)[0]:
+        print("Failed 1040", record, "\n")
+    LogFile.c_log_file = None
+    print("Unit tests completed\n")
@@ -0,0 +1,129 @@
+#
+# Live Log streaming to Telnet clients for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# A Telnet client that runs "log follow" receives every new Log entry.
+# Entries are pushed from a main loop task, never from Log.add(), which
+# may run from a scheduled interrupt callback.
+# Each connection keeps its own position in m_follow_index, the
+# Log.c_log_total of the next entry to send, or None when not following,
+# so a closed connection stops following with it.
+# The "log-follow" task does not run periodically.  While a connection
+# follows, each new Log entry requests it through Log.c_add_hook.
+
+import Log
+import Scheduler
+
+
+class LogFollow:
+
+    # Class variables
+
+    # The list of open Telnet client connections, shared with TelnetServer
+    c_client_list = None
+
+    # Most entries sent to a client on one poll
+    c_batch_max = 32
+
+    # Start sending new Log entries to a connection
+    # @param p_connection The Telnet connection, or None
+    # @returns True if the connection is an open Telnet connection
+    #
+    @classmethod
+    def Follow(p_class, p_connection):
+        if p_class.c_client_list is None or p_connection not in p_class.c_client_list:
+            return False
+        p_connection.m_follow_index = Log.Log.c_log_total
+        Log.Log.c_add_hook = p_class.Wake
+        return True
+
+
+    # Stop sending new Log entries to a connection
+    # @param p_connection The Telnet connection, or None
+    # @returns True if the connection was following the Log
+    #
+    @classmethod
+    def Unfollow(p_class, p_connection):
+        if p_connection is None or p_connection.m_follow_index is None:
+            return False
+        p_connection.m_follow_index = None
+        if p_class.Count() == 0:
+            Log.Log.c_add_hook = None
+        return True
+
+
+    # @returns The number of connections following the Log
+    #
+    @classmethod
+    def Count(p_class):
+        count = 0
+        if p_class.c_client_list is not None:
+            for client in p_class.c_client_list:
+                if client.m_follow_index is not None:
+                    count += 1
+        return count
+
+
+    # Request the "log-follow" task, called by Log.add() for each new entry
+    #
+    @classmethod
+    def Wake(p_class):
+        Scheduler.Scheduler.RequestTask("log-follow")
+
+
+    # Send new Log entries to the followers.  Requests itself again while
+    # a follower has more than c_batch_max entries waiting, and stops the
+    # requests from Log.add() once no connection follows.
+    #
+    @classmethod
+    def Poll(p_class):
+        if not p_class.c_client_list:
+            Log.Log.c_add_hook = None
+            return
+        total = Log.Log.c_log_total
+        oldest = total - Log.Log.c_log_count
+        log = Log.Log()
+        following = False
+        # Iterate over a copy, a push may close its connection
+        for client in list(p_class.c_client_list):
+            start = client.m_follow_index
+            if start is None:
+                continue
+            following = True
+            if start >= total:
+                continue
+            lines = list()
+            if start < oldest:
+                lines.append("... " + str(oldest - start) + " log entries missed")
+                start = oldest
+            end = min(total, start + p_class.c_batch_max)
+            for k in range(start, end):
+                index = k - oldest
+                lines.append(log.format_entry(log.get_entry(index), log.get_repeats(index)))
+            client.m_follow_index = end
+            client.push(lines)
+            if end < total:
+                p_class.Wake()
+        if not following:
+            Log.Log.c_add_hook = None
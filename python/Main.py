@@ -29,6 +29,9 @@ import sys
 import time
 import Config
 import Log
+import LogFile
+import LogFollow
+import Syslog
 import TelnetServer
 import WiFi
 import Commands
@@ -42,6 +45,9 @@ import WS281
 import Detector
 import StateConfig
 import StateMachine
+import Scheduler
+import AsyncRuntime
+import Metrics
 
 # Initialize logger
 g_log = Log.Log()
@@ -52,6 +58,16 @@ print("Loading config")
 g_config = Config.Config("config.json", g_log)
 Log.Log.SetConfig(g_config)
 
+# Keep the Log in flash across resets, if configured
+g_log_file = None
+if g_config.m_log_file:
+    g_log_file = LogFile.LogFile(g_config.m_log_file, g_config.m_log_file_records, g_log)
+
+# Forward the Log to a syslog collector, if configured
+g_syslog = None
+if g_config.m_syslog_host:
+    g_syslog = Syslog.Syslog(g_config.m_syslog_host, g_config.m_syslog_port, g_config.m_hostname, g_log)
+
 # Initialize hardware
 WS281.WS281.InitHardware(g_config, Light.Light.Count(), g_log)
 Semaphore.Semaphore.InitHardware(g_config)
@@ -68,36 +84,58 @@ g_repl_button = GPIO.GPIO("REPLButton", 0, Pin.IN, Pin.PULL_UP, g_log)
 print("Loading rules from", g_config.m_rules_file)
 g_rules = Rules.Rules(g_config.m_rules_file, g_config, g_log)
 
+# Optionally release the Rules requested by a Telnet client host when its
+# last connection closes
+if g_config.m_release_on_close:
+    TelnetServer.TelnetConn.c_close_handler = g_rules.release_all_by_source
+
+# Telnet clients that run "log follow"
+LogFollow.LogFollow.c_client_list = TelnetServer.TelnetConn.c_client_list
+
 
 # Load state machines, if any
 print("Loading state machines")
 StateConfig.StateConfig(g_config.m_state_file, g_config.m_hostname, g_log)
 StateMachine.StateMachine.Print()
 
+# Initialzie the Rules state machine.  This lights the default aspect,
+# so do it before waiting for WiFi.
+g_rules.startup(g_config.m_hostname)
+
 g_wifi = None
 g_telnet_server = None
 
+# The Scheduler must exist before sockets are opened so they
+# can register with it
+g_scheduler = None
+g_runtime = None
+if g_config.m_runtime == "asyncio":
+    g_runtime = AsyncRuntime.AsyncRuntime(g_log, TelnetServer.TelnetConn.c_client_list)
+else:
+    g_scheduler = Scheduler.Scheduler()
+
 def do_connect():
     global g_config
     global g_wifi
     g_wifi = WiFi.WiFi(g_config, g_log)
     g_wifi.connect()
 
+    welcome = g_config.m_hostname + " " + str(g_wifi.m_wifi_ip) + "\r\n"
+    if g_runtime:
+        # The AsyncRuntime starts its own Telnet server
+        g_runtime.set_welcome(welcome)
+        return
+
     global g_telnet_server
     g_telnet_server = TelnetServer.TelnetServer()
-
-    welcome = g_config.m_hostname + " " + str(g_wifi.m_wifi_ip) + "\r\n"
     g_telnet_server.set_welcome(welcome)
 
     g_telnet_server.start()
 
 do_connect()
 
-
-# Initialzie the Rules state machine
-g_rules.startup(g_config.m_hostname)
-
 # Init and start the watchdog
+g_watchdog_timeout_ms = 2000
 print("Platform =", sys.platform)
 g_wdt = None
 if sys.platform == 'esp8266':
@@ -106,34 +144,125 @@ if sys.platform == 'esp8266':
     g_wdt = WDT()
     pass
 elif sys.platform == 'esp32':
-    g_wdt = WDT(timeout=2000)
+    g_wdt = WDT(timeout=g_watchdog_timeout_ms)
 else:
     raise Exception('Unrecognized hardware ', sys.platform, '02407241136')
 
-def loop():
+# Time left before the watchdog timeout at each feed
+g_watchdog_metric = Metrics.Metrics.Histogram("watchdog slack")
+g_watchdog_feed_us = time.ticks_us()
+
+# Not dead (yet), feed the watchdog and test for the REPL button
+#
+def task_watchdog():
+    global g_watchdog_feed_us
+    now_us = time.ticks_us()
+    Metrics.Metrics.Record(g_watchdog_metric,
+        g_watchdog_timeout_ms * 1000 - time.ticks_diff(now_us, g_watchdog_feed_us))
+    g_watchdog_feed_us = now_us
+    g_wdt.feed()
+    if g_repl_button.m_pin.value() == 0:
+        raise ValueError('Entering REPL')
+
+
+# Send waiting Telnet output, and drop clients that stopped reading
+#
+def task_telnet():
+    TelnetServer.TelnetConn.FlushAll()
+
+
+# Keep WiFi connected and the clock updated, then wake early for the
+# next reconnection step or NTP update
+#
+def task_wifi():
+    g_wifi.maintain()
+    g_scheduler.wake("wifi", g_wifi.next_maintain_ms())
+
+
+# Run state timeout transitions, then sleep until the next timeout
+#
+def task_state_machines():
+    StateMachine.StateMachine.CheckTimeouts()
+    remaining = StateMachine.StateMachine.NextTimeoutMs()
+    if remaining is not None:
+        g_scheduler.wake("state-machines", remaining)
+
+
+# Process detector edges, then wake early for the next soak or hold
+# deadline.  The pin interrupt requests this task when it captures an
+# edge.  Edges are timestamped, so one that waits for the next wake of
+# the main loop still starts its soak from the time of the edge.
+#
+def task_detectors():
+    Detector.Detector.Poll()
+    remaining = Detector.Detector.NextDeadlineMs()
+    if remaining is not None:
+        g_scheduler.wake("detectors", remaining)
+
+
+# Time between watchdog feeds, must be well under the 2 second timeout
+g_watchdog_ms = 500
+# Time between checks for stalled Telnet clients
+g_telnet_ms = 1000
+# Time between WiFi connection checks
+g_wifi_ms = 10000
+# Time between samples of detectors in "poll" mode
+g_detector_ms = 50
+# Longest time between state timeout checks in the AsyncRuntime
+g_state_ms = 1000
+
+# @returns The period of the detectors task, 0 when every detector is in
+#          "irq" mode and the task only runs when requested or due
+#
+def detector_period_ms():
+    if Detector.Detector.NeedsSampling():
+        return g_detector_ms
+    return 0
+
+
+# Run each area in its own uasyncio task
+#
+def async_loop():
 
     print("Accepting connections")
-    # Time between polls
-    poll_time = 0.2
-    while (True):
+    g_runtime.set_watchdog(g_wdt, g_repl_button.m_pin)
+    g_runtime.set_wifi(g_wifi)
+    if g_config.m_release_on_close:
+        g_runtime.set_close_handler(g_rules.release_all_by_source)
+    Scheduler.Scheduler.c_runtime = g_runtime
+    g_runtime.add_task("state-machines", StateMachine.StateMachine.CheckTimeouts,
+        g_state_ms, StateMachine.StateMachine.NextTimeoutMs)
+    if len(Detector.Detector.c_detector_list) > 0:
+        g_runtime.add_task("detectors", Detector.Detector.Poll,
+            detector_period_ms(), Detector.Detector.NextDeadlineMs)
+    if g_log_file:
+        g_runtime.add_task("log-file", g_log_file.flush, g_config.m_log_flush_ms)
+    g_runtime.add_task("log-follow", LogFollow.LogFollow.Poll, 0)
+    if g_syslog:
+        g_runtime.add_task("syslog", g_syslog.poll, g_config.m_syslog_ms)
+    g_runtime.run()
 
-        # Not dead (yet), feed the watchdog
-        g_wdt.feed()
 
-        # Test for REPL button
-        if g_repl_button.m_pin.value() == 0:
-            raise ValueError('Entering REPL')
+def loop():
 
-        # Perform polls
-        g_wifi.poll()
-        #g_telnet_server.poll()
-        Detector.Detector.Poll()
-        StateMachine.StateMachine.Poll(poll_time)
-        TelnetServer.TelnetConn.Poll()
- 
-        # Sleep at end of the loop to let other code run
-        #print("sleeping...\n")
-        time.sleep(poll_time)
+    print("Accepting connections")
+    g_scheduler.add_task("watchdog", task_watchdog, g_watchdog_ms)
+    g_scheduler.add_task("wifi", task_wifi, g_wifi_ms)
+    g_scheduler.add_task("telnet", task_telnet, g_telnet_ms)
+    g_scheduler.add_task("state-machines", task_state_machines, 0)
+    if len(Detector.Detector.c_detector_list) > 0:
+        g_scheduler.add_task("detectors", task_detectors, detector_period_ms())
+    if g_log_file:
+        g_scheduler.add_task("log-file", g_log_file.flush, g_config.m_log_flush_ms)
+    g_scheduler.add_task("log-follow", LogFollow.LogFollow.Poll, 0)
+    if g_syslog:
+        g_scheduler.add_task("syslog", g_syslog.poll, g_config.m_syslog_ms)
 
-loop()
+    # Sleep in select.poll until a socket is ready or a task is due
+    while (True):
+        g_scheduler.run_once()
 
+if g_runtime:
+    async_loop()
+else:
+    loop()
@@ -0,0 +1,239 @@
+#
+# Metrics registry for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+import time
+import gc
+from array import array
+
+# Counters and latency histograms with preallocated storage.  Metrics are
+# registered once, usually at import or load time, and then updated by
+# id, so updating a metric does not allocate and Count() may be called
+# from an interrupt.
+
+class Metrics:
+
+    # Class variables
+
+    # Upper bounds of the histogram buckets in microseconds.  The last
+    # bucket counts everything above the last bound.
+    c_bounds = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000, 3000000)
+    c_bucket_count = 13
+
+    # Most counters and histograms that may be registered.  When all are
+    # in use, further names share one named "other".
+    c_counter_limit = 16
+    c_histogram_limit = 40
+
+    # Counters, indexed by counter id
+    c_counter_names = list()
+    c_counters = array('L', [0] * 16)
+
+    # Histograms, indexed by histogram id.  Bucket b of histogram h is
+    # c_buckets[h * c_bucket_count + b].  A minimum of -1 means no samples.
+    c_histogram_names = list()
+    c_buckets = array('L', [0] * (40 * 13))
+    c_samples = array('L', [0] * 40)
+    c_min = array('l', [-1] * 40)
+    c_max = array('l', [0] * 40)
+
+    # Time of the last reset, from time.ticks_ms()
+    c_reset_ms = time.ticks_ms()
+
+    # Register a counter, or find one registered earlier with the same name
+    # @param p_name The name of the counter
+    # @returns The counter id
+    #
+    @classmethod
+    def Counter(p_class, p_name):
+        if p_name in p_class.c_counter_names:
+            return p_class.c_counter_names.index(p_name)
+        if len(p_class.c_counter_names) >= p_class.c_counter_limit - 1:
+            p_name = "other"
+            if p_name in p_class.c_counter_names:
+                return p_class.c_counter_names.index(p_name)
+        p_class.c_counter_names.append(p_name)
+        return len(p_class.c_counter_names) - 1
+
+
+    # Register a histogram, or find one registered earlier with the same name
+    # @param p_name The name of the histogram
+    # @returns The histogram id
+    #
+    @classmethod
+    def Histogram(p_class, p_name):
+        if p_name in p_class.c_histogram_names:
+            return p_class.c_histogram_names.index(p_name)
+        if len(p_class.c_histogram_names) >= p_class.c_histogram_limit - 1:
+            p_name = "other"
+            if p_name in p_class.c_histogram_names:
+                return p_class.c_histogram_names.index(p_name)
+        p_class.c_histogram_names.append(p_name)
+        return len(p_class.c_histogram_names) - 1
+
+
+    # Add one to a counter.  Safe to call from an interrupt.
+    # @param p_id The counter id
+    #
+    @classmethod
+    def Count(p_class, p_id):
+        p_class.c_counters[p_id] += 1
+
+
+    # Add a sample to a histogram
+    # @param p_id The histogram id
+    # @param p_us The sample in microseconds, negative samples count as 0
+    #
+    @classmethod
+    def Record(p_class, p_id, p_us):
+        if p_us < 0:
+            p_us = 0
+        # Binary search for the bucket
+        bounds = p_class.c_bounds
+        low = 0
+        high = len(bounds)
+        while low < high:
+            middle = (low + high) >> 1
+            if p_us <= bounds[middle]:
+                high = middle
+            else:
+                low = middle + 1
+        p_class.c_buckets[p_id * p_class.c_bucket_count + low] += 1
+        p_class.c_samples[p_id] += 1
+        if p_class.c_min[p_id] < 0 or p_us < p_class.c_min[p_id]:
+            p_class.c_min[p_id] = p_us
+        if p_us > p_class.c_max[p_id]:
+            p_class.c_max[p_id] = p_us
+
+
+    # Add the time elapsed since a start time to a histogram
+    # @param p_id The histogram id
+    # @param p_start_us The start time from time.ticks_us()
+    #
+    @classmethod
+    def Since(p_class, p_id, p_start_us):
+        p_class.Record(p_id, time.ticks_diff(time.ticks_us(), p_start_us))
+
+
+    # Clear all counters and histograms
+    #
+    @classmethod
+    def Reset(p_class):
+        for i in range(len(p_class.c_counters)):
+            p_class.c_counters[i] = 0
+        for i in range(len(p_class.c_buckets)):
+            p_class.c_buckets[i] = 0
+        for i in range(len(p_class.c_samples)):
+            p_class.c_samples[i] = 0
+            p_class.c_min[i] = -1
+            p_class.c_max[i] = 0
+        p_class.c_reset_ms = time.ticks_ms()
+
+
+    # @param p_id The histogram id
+    # @param p_fraction The fraction of samples, 0.5 for the median
+    # @returns The upper bound of the bucket holding the fraction of
+    #          samples, or None for the last bucket
+    #
+    @classmethod
+    def Percentile(p_class, p_id, p_fraction):
+        target = p_class.c_samples[p_id] * p_fraction
+        seen = 0
+        for bucket in range(p_class.c_bucket_count):
+            seen += p_class.c_buckets[p_id * p_class.c_bucket_count + bucket]
+            if seen >= target:
+                if bucket < len(p_class.c_bounds):
+                    return p_class.c_bounds[bucket]
+                return None
+        return None
+
+
+    # @param p_bound A bucket bound from Percentile()
+    # @returns The bound as a string
+    #
+    @classmethod
+    def format_bound(p_class, p_bound):
+        if p_bound is None:
+            return ">" + str(p_class.c_bounds[-1]) + "us"
+        return "<=" + str(p_bound) + "us"
+
+
+    # @returns A list of strings with the value of every metric
+    #
+    @classmethod
+    def Report(p_class):
+        out = list()
+        elapsed_ms = time.ticks_diff(time.ticks_ms(), p_class.c_reset_ms)
+        out.append("Since reset: " + str(elapsed_ms // 1000) + " s")
+        for i in range(len(p_class.c_counter_names)):
+            s = p_class.c_counter_names[i]
+            s += ": "
+            s += str(p_class.c_counters[i])
+            if elapsed_ms > 0:
+                s += ", "
+                s += str((p_class.c_counters[i] * 1000) // elapsed_ms)
+                s += "/s"
+            out.append(s)
+        for i in range(len(p_class.c_histogram_names)):
+            s = p_class.c_histogram_names[i]
+            s += ": n="
+            s += str(p_class.c_samples[i])
+            if p_class.c_samples[i] > 0:
+                s += ", min="
+                s += str(p_class.c_min[i])
+                s += "us, p50"
+                s += p_class.format_bound(p_class.Percentile(i, 0.5))
+                s += ", p99"
+                s += p_class.format_bound(p_class.Percentile(i, 0.99))
+                s += ", max="
+                s += str(p_class.c_max[i])
+                s += "us"
+            out.append(s)
+        return out
+
+
+# Benchmark the cost of updating a metric, which must stay at a few
+# microseconds.  Call from the REPL.
+# @param p_count Number of updates
+# @returns A tuple of (us per Count, us per Since, bytes allocated)
+#
+def benchmark(p_count=1000):
+    counter = Metrics.Counter("benchmark count")
+    histogram = Metrics.Histogram("benchmark since")
+
+    start = time.ticks_us()
+    for i in range(p_count):
+        Metrics.Count(counter)
+    count_us = time.ticks_diff(time.ticks_us(), start) / p_count
+
+    gc.collect()
+    before = gc.mem_alloc()
+    start = time.ticks_us()
+    for i in range(p_count):
+        Metrics.Since(histogram, time.ticks_us())
+    since_us = time.ticks_diff(time.ticks_us(), start) / p_count
+    allocated = gc.mem_alloc() - before
+
+    print("us per Count:", count_us, "us per Since:", since_us, "bytes allocated:", allocated)
+    return (count_us, since_us, allocated)
@@ -24,17 +24,28 @@
 #
 
 import io
+import time
 import json
+import heapq
+import hashlib
+import binascii
 import Rule
 import Log
 import Aspect
-import Light
+import RulesLoader
+import Metrics
 
 class Rules:
 
     # Class variable for the Rules singleton object
     c_rules = None
 
+    # Change when the compiled rules cache format changes
+    c_cache_version = 1
+
+    # Time to request a rule, including the change of Aspect
+    c_request_metric = Metrics.Metrics.Histogram("rules request")
+
     # Create an object to encapsulate all rules for a Signal
     # @param p_rule_file Filename of a json rules file
     # @param p_config Reference to the Config object
@@ -45,45 +56,114 @@ class Rules:
         self.m_log = p_log
 
         self.m_rule_file = p_rule_file
-        fs = io.open(p_rule_file, mode='r')
-        rd = json.load(fs)
-        fs.close()
 
-        self.m_rule_set = rd["rule-set"]
-        self.m_source = rd["rule-set-source"]
-        self.m_author = rd["author"]
-        self.m_default_rule_number = rd["default-rule"]
+        self.m_rule_list = list()
         self.m_default_rule = None
         self.m_default_rule_source = None
 
-        rules = rd["rules"]
+        # Use the compiled rules of the last boot if config.json and the
+        # rules file have not changed
+        self.m_cache_file = p_config.m_rules_cache_file
+        self.m_cache_key = None
+        rd = None
+        if self.m_cache_file:
+            self.m_cache_key = rules_key((p_config.m_file, p_rule_file))
+            rd = self.load_cache()
 
-        self.m_rule_list = list()
-        for rule in rules:
-            # Evaluate the Aspect commands to determine if
-            # this Rule applies to this signal
-            aspect_list = rule["aspect"]
-            for aspect_cmds in aspect_list:
-                aspect = Aspect.Aspect(aspect_cmds, p_config, p_log)
-                if not aspect.eval():
-                    # This Aspect does not match the Configuration
-                    continue
+        if rd is None:
+            # Parse one rule at a time, keeping only the rules for this signal
+            rd = RulesLoader.RulesLoader(p_rule_file).load(self.add_rule)
 
-                # Keep this rule only if the Aspect matches the Config
-                robj = Rule.Rule(rule["rule"], rule["name"], rule["indication"], rule["priority"], aspect)
-                self.m_rule_list.append(robj)
+            # The compiled Aspects are kept by the Rules
+            Aspect.Aspect.ClearCache()
 
-                # Keep only the first matching Aspect
-                break
+            # Older rules files name this "source"
+            if "rule-set-source" not in rd:
+                rd["rule-set-source"] = rd["source"]
+            if self.m_cache_file:
+                self.save_cache(rd)
+
+        self.m_rule_set = rd["rule-set"]
+        self.m_source = rd["rule-set-source"]
+        self.m_author = rd["author"]
+        self.m_default_rule_number = rd["default-rule"]
 
-        # The request list is maintained in ascending order
-        # according to rule priority.
-        self.m_request_list = list()
+        self.build_index()
+        self.init_requests()
 
         # Save this singleton
         Rules.c_rules = self
 
 
+    # Keep a rule from the rules file if one of its Aspects matches this
+    # signal's Config
+    # @param p_rule The dict of one rule from the rules file
+    #
+    def add_rule(self, p_rule):
+        # Evaluate the Aspect commands to determine if
+        # this Rule applies to this signal
+        aspect_list = p_rule["aspect"]
+        for aspect_cmds in aspect_list:
+            aspect = Aspect.Aspect.Compile(aspect_cmds, self.m_config, self.m_log)
+            if not aspect:
+                # This Aspect does not match the Configuration
+                continue
+
+            # Keep this rule only if the Aspect matches the Config
+            robj = Rule.Rule(p_rule["rule"], p_rule["name"], p_rule["indication"], p_rule["priority"], aspect)
+            self.m_rule_list.append(robj)
+
+            # Keep only the first matching Aspect
+            break
+
+
+    # Load the compiled rules cache
+    # @returns A dict of the rule set attributes, or None if the cache is
+    #          missing, stale or invalid
+    #
+    def load_cache(self):
+        try:
+            fs = io.open(self.m_cache_file, mode='r')
+        except OSError:
+            return None
+        try:
+            rd = json.load(fs)
+            if rd["key"] != self.m_cache_key:
+                return None
+            rule_list = list()
+            for (rule, name, indication, priority, action_list) in rd["rules"]:
+                aspect = Aspect.Aspect.FromList(action_list, self.m_config, self.m_log)
+                rule_list.append(Rule.Rule(rule, name, indication, priority, aspect))
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.m_log.add("Rules", "Invalid rules cache 202610171109")
+            return None
+        finally:
+            fs.close()
+        self.m_rule_list = rule_list
+        del rd["rules"]
+        return rd
+
+
+    # Save the compiled rules of this signal
+    # @param p_rd A dict of the rule set attributes
+    #
+    def save_cache(self, p_rd):
+        rd = dict()
+        rd["key"] = self.m_cache_key
+        for name in ("rule-set", "rule-set-source", "author", "default-rule"):
+            rd[name] = p_rd[name]
+        rule_list = list()
+        for rule in self.m_rule_list:
+            rule_list.append([rule.m_rule, rule.m_name, rule.m_indication, rule.m_priority, rule.m_aspect.to_list()])
+        rd["rules"] = rule_list
+        try:
+            fs = io.open(self.m_cache_file, mode='w')
+            json.dump(rd, fs)
+            fs.close()
+        except OSError:
+            self.m_log.add("Rules", "Failed to write rules cache 202610171110")
+
+
     # Startup by activating the default Rule.
     # Call this once at system startup after the hardware has been initialized
     # @param p_source The name of the source, should be this hostname
@@ -108,6 +188,33 @@ class Rules:
             self.m_log.add(p_source, msg)
 
 
+    # Index the rules by rule number and by name.  The first rule in
+    # m_rule_list wins, as with a linear search.
+    #
+    def build_index(self):
+        self.m_rule_index = dict()
+        for rule in self.m_rule_list:
+            if rule.m_rule not in self.m_rule_index:
+                self.m_rule_index[rule.m_rule] = rule
+            if rule.m_name not in self.m_rule_index:
+                self.m_rule_index[rule.m_name] = rule
+
+
+    # Create an empty request list.
+    # The request list is a heap of [-priority, sequence, rule] entries,
+    # so the active rule is the highest priority one, and among equal
+    # priorities the earliest request.  m_request_index finds the entry
+    # of a rule requested by a source: m_request_index[source][rule number].
+    # Released entries are marked by clearing the rule, and are dropped
+    # when they reach the top of the heap.
+    #
+    def init_requests(self):
+        self.m_request_heap = list()
+        self.m_request_index = dict()
+        self.m_request_count = 0
+        self.m_request_sequence = 0
+
+
     # Insert the given rule into the request list.
     # @p_rule The rule to be inserted
     # @p_source The name of the source making the request.
@@ -115,17 +222,19 @@ class Rules:
     #          is already in the list.
     #
     def request(self, p_rule, p_source):
-        index = len(self.m_request_list)
-        for rule in reversed(self.m_request_list):
-            if p_rule.m_rule == rule.m_rule:
-                if p_rule.m_source == p_source:
-                    # Already in the request list
-                    return False
-            if p_rule.m_priority > rule.m_priority:
-                break
-            index -= 1
+        source_index = self.m_request_index.get(p_source)
+        if source_index is None:
+            source_index = dict()
+            self.m_request_index[p_source] = source_index
+        elif p_rule.m_rule in source_index:
+            # Already in the request list
+            return False
         p_rule.m_source = p_source
-        self.m_request_list.insert(index, p_rule)
+        self.m_request_sequence += 1
+        entry = [-p_rule.m_priority, self.m_request_sequence, p_rule]
+        source_index[p_rule.m_rule] = entry
+        heapq.heappush(self.m_request_heap, entry)
+        self.m_request_count += 1
         return True
         
 
@@ -136,32 +245,83 @@ class Rules:
     #          was not in the list.
     #
     def release(self, p_rule, p_source):
-        index = 0
-        for rule in self.m_request_list:
-            if p_rule.m_rule == rule.m_rule:
-                if p_source == rule.m_source:
-                    self.m_request_list.pop(index)
-                    return True
-            index += 1
-        return False
+        source_index = self.m_request_index.get(p_source)
+        if source_index is None:
+            return False
+        entry = source_index.pop(p_rule.m_rule, None)
+        if entry is None:
+            return False
+        if len(source_index) == 0:
+            del self.m_request_index[p_source]
+        entry[2] = None
+        self.m_request_count -= 1
+        self.compact()
+        return True
+
+
+    # Remove every rule requested by a source from the request list,
+    # except the default rule of the default source and the last rule.
+    # Rules are removed in ascending priority, so the rule that remains
+    # when the source holds the last rule is its highest priority one.
+    # @p_source The name of the source
+    # @returns The number of rules removed
+    #
+    def release_all(self, p_source):
+        source_index = self.m_request_index.get(p_source)
+        if source_index is None:
+            return 0
+        count = 0
+        for entry in sorted(source_index.values(), reverse=True):
+            if self.m_request_count < 2:
+                break
+            rule_number = entry[2].m_rule
+            if p_source == self.m_default_rule_source and rule_number == self.m_default_rule.m_rule:
+                continue
+            del source_index[rule_number]
+            entry[2] = None
+            self.m_request_count -= 1
+            count += 1
+        if len(source_index) == 0:
+            del self.m_request_index[p_source]
+        self.compact()
+        return count
+
+
+    # Rebuild the heap without the released entries once they
+    # outnumber the requests
+    #
+    def compact(self):
+        if len(self.m_request_heap) <= 2 * self.m_request_count + 8:
+            return
+        heap = list()
+        for entry in self.m_request_heap:
+            if entry[2] is not None:
+                heap.append(entry)
+        heapq.heapify(heap)
+        self.m_request_heap = heap
         
 
     # Remove the highest priority rule from the request list
     # @returns The removed rule, or None
     #
     def pop_active(self):
-        if len(self.m_request_list) == 0:
+        rule = self.get_active_rule()
+        if rule is None:
             return None
-
-        return self.m_request_list.pop()
+        self.release(rule, rule.m_source)
+        return rule
 
 
     # @returns The highest priority rule in the list, or None if empty
     #
     def get_active_rule(self):
-        if len(self.m_request_list) == 0:
-            return None
-        return self.m_request_list[-1]
+        heap = self.m_request_heap
+        while len(heap) > 0:
+            rule = heap[0][2]
+            if rule is not None:
+                return rule
+            heapq.heappop(heap)
+        return None
 
 
     # Find and return a rule by number or name.
@@ -169,12 +329,43 @@ class Rules:
     # @returns The matching rule, or None if not a valid rule.
     #
     def find_rule(self, p_rule_or_name):
-        for rule in self.m_rule_list:
-            if (rule.m_rule == p_rule_or_name):
-                return rule
-            if (rule.m_name == p_rule_or_name):
-                return rule
-        return None
+        return self.m_rule_index.get(p_rule_or_name)
+
+
+    # Log the change of the active rule and set the new Aspect
+    # @param p_pre_active_rule The active rule before the change, or None
+    # @param p_source The name of the source causing the change
+    # @param p_error_code The code logged if the new Aspect fails
+    # @returns True if the active rule changed
+    #
+    def update_active(self, p_pre_active_rule, p_source, p_error_code):
+        # Has the active rule changed?
+        post_active_rule = self.get_active_rule()
+        if post_active_rule is None:
+            return False
+        if p_pre_active_rule and p_pre_active_rule.m_rule == post_active_rule.m_rule:
+            # No, same rule is in effect, no change required
+            return False
+
+        # We have changed the current active rule
+        if (p_pre_active_rule):
+            s = "Released: "
+            s += p_pre_active_rule.m_rule
+            s += ":"
+            s += p_pre_active_rule.m_name
+            self.m_log.add(p_source, s)
+
+        s = "Activated: "
+        s += post_active_rule.m_rule
+        s += ":"
+        s += post_active_rule.m_name
+        self.m_log.add(p_source, s)
+
+        # Change the hardware state that differs from the new Aspect
+        if not post_active_rule.execute(p_source, self.m_log):
+            self.m_log.add("Rules", "Failed to execute " + p_error_code)
+
+        return True
 
 
     # Request activation of a rule by number or name
@@ -187,6 +378,16 @@ class Rules:
     #          3 - if the rule was added and activated
     #
     def request_by_rule_or_name(self, p_rule_or_name, p_source):
+        start_us = time.ticks_us()
+        state = self.request_rule(p_rule_or_name, p_source)
+        Metrics.Metrics.Since(Rules.c_request_metric, start_us)
+        return state
+
+
+    # Request activation of a rule by number or name, see
+    # request_by_rule_or_name()
+    #
+    def request_rule(self, p_rule_or_name, p_source):
         # Verify the request is a valid rule
         valid_rule = self.find_rule(p_rule_or_name)
 
@@ -205,33 +406,9 @@ class Rules:
             # This rule is already in the list
             return 1
 
-        # Has the active rule changed?
-        post_active_rule = self.get_active_rule()
-        if pre_active_rule and pre_active_rule.m_rule == post_active_rule.m_rule:
-            # No, same rule is in effect, no change required
+        if not self.update_active(pre_active_rule, p_source, "202410151727"):
             return 2
 
-        # We have changed the current active rule
-        if (pre_active_rule):
-            s = "Released: "
-            s += pre_active_rule.m_rule
-            s += ":"
-            s += pre_active_rule.m_name
-            self.m_log.add(p_source, s)
-
-        s = "Activated: "
-        s += post_active_rule.m_rule
-        s += ":"
-        s += post_active_rule.m_name
-        self.m_log.add(p_source, s)
-
-        # Turn off all lights before setting new Aspect
-        Light.Light.AllOff()
-
-        # Change hardware state
-        if not post_active_rule.execute(p_source, self.m_log):
-            self.m_log.add("Rules", "Failed to execute 202410151727")
-
         return 3
 
 
@@ -252,7 +429,7 @@ class Rules:
             return 0
 
         # Don't delete the last rule in the request queue
-        if len(self.m_request_list) < 2:
+        if self.m_request_count < 2:
             return 0
 
         # Don't remove the default rule
@@ -269,43 +446,35 @@ class Rules:
             # This rule was not in the request list
             return 1
 
-        # Has the active rule changed?
-        post_active_rule = self.get_active_rule()
-        if (pre_active_rule.m_rule == post_active_rule.m_rule):
-            # No, same rule is in effect, no change required
+        if not self.update_active(pre_active_rule, p_source, "202410160914"):
             return 2
 
-        # We have changed the current active rule
-        if (pre_active_rule):
-            s = "Released: "
-            s += pre_active_rule.m_rule
-            s += ":"
-            s += pre_active_rule.m_name
-            self.m_log.add(p_source, s)
-
-        s = "Activated: "
-        s += post_active_rule.m_rule
-        s += ":"
-        s += post_active_rule.m_name
-        self.m_log.add(p_source, s)
+        return 3
 
-        # Turn off all lights before setting new Aspect
-        Light.Light.AllOff()
 
-        # Change hardware state
-        if not post_active_rule.execute(p_source, self.m_log):
-            self.m_log.add("Rules", "Failed to execute 202410160914")
+    # Release every rule requested by a source, e.g. when a client
+    # disconnects
+    # @param p_source The name of the requestor
+    # @returns The number of rules released
+    #
+    def release_all_by_source(self, p_source):
+        # Remember the current active rule
+        pre_active_rule = self.get_active_rule()
 
-        return 3
+        count = self.release_all(p_source)
+        if count > 0:
+            self.update_active(pre_active_rule, p_source, "202610171105")
+        return count
 
 
     # @returns A string representation of the request list
     #
     def request_list(self):
         out = list()
-        for rule in self.m_request_list:
-            s = str(rule)
-            out.append(s)
+        # Listed in ascending priority, the active rule last
+        for entry in sorted(self.m_request_heap, reverse=True):
+            if entry[2] is not None:
+                out.append(str(entry[2]))
         return out
 
 
@@ -315,7 +484,7 @@ class Rules:
         s = "rule-set: "
         s += self.m_rule_set
         s += "\nrule-set-source: "
-        s += self.m_rule_set_source
+        s += self.m_source
         s += "\nauthor: "
         s += self.m_author
         s += "\n"
@@ -338,3 +507,116 @@ class Rules:
         return out
 
 
+# Hash the files that the compiled rules depend on
+# @param p_file_list The names of the files
+# @returns The hash as a hex string
+#
+def rules_key(p_file_list):
+    h = hashlib.sha256()
+    h.update(str(Rules.c_cache_version).encode())
+    buf = bytearray(256)
+    for name in p_file_list:
+        fs = io.open(name, mode='rb')
+        while True:
+            count = fs.readinto(buf)
+            if not count:
+                break
+            h.update(memoryview(buf)[0:count])
+        fs.close()
+    return binascii.hexlify(h.digest()).decode()
+
+
+# Run thousands of interleaved requests and releases from many sources,
+# and check the active rule and the request list after each one against
+# a sorted list, which is how the request list used to be kept.
+# @param p_count The number of operations
+# @param p_sources The number of sources
+# @param p_rule_count The number of rules
+# @param p_seed Seed of the pseudo-random operation sequence
+# @returns True if every result matched
+#
+def stress_test(p_count=5000, p_sources=16, p_rule_count=24, p_seed=12345):
+    import time
+    rules = Rules.__new__(Rules)
+    rules.m_rule_list = list()
+    for i in range(p_rule_count):
+        # Few distinct priorities, so equal priorities are common
+        rules.m_rule_list.append(Rule.Rule(str(i), "name-" + str(i), "", (i * 7) % 5, None))
+    rules.build_index()
+    rules.init_requests()
+    rules.m_default_rule = rules.m_rule_list[0]
+    rules.m_default_rule_source = "source-0"
+    rules.request(rules.m_default_rule.copy(), "source-0")
+
+    # The reference request list, in ascending order of priority, with
+    # the active rule last
+    ref = [rules.m_default_rule.copy()]
+    ref[0].m_source = "source-0"
+
+    def ref_request(p_rule, p_source):
+        index = len(ref)
+        for rule in reversed(ref):
+            if p_rule.m_rule == rule.m_rule and rule.m_source == p_source:
+                return False
+            if p_rule.m_priority > rule.m_priority:
+                break
+            index -= 1
+        p_rule.m_source = p_source
+        ref.insert(index, p_rule)
+        return True
+
+    def ref_release(p_rule, p_source):
+        for index in range(len(ref)):
+            if p_rule.m_rule == ref[index].m_rule and p_source == ref[index].m_source:
+                ref.pop(index)
+                return True
+        return False
+
+    seed = p_seed
+    passed = True
+    elapsed_us = 0
+    for n in range(p_count):
+        # Linear congruential generator, the same on every port
+        seed = (seed * 1103515245 + 12345) & 0x7FFFFFFF
+        rule = rules.m_rule_list[(seed >> 4) % p_rule_count]
+        source = "source-" + str((seed >> 12) % p_sources)
+        op = (seed >> 20) % 16
+
+        start = time.ticks_us()
+        if op < 9:
+            result = rules.request(rule.copy(), source)
+        elif op < 15:
+            result = rules.release(rule, source)
+        else:
+            result = rules.release_all(source)
+        elapsed_us += time.ticks_diff(time.ticks_us(), start)
+
+        if op < 9:
+            expect = ref_request(rule.copy(), source)
+        elif op < 15:
+            expect = ref_release(rule, source)
+        else:
+            expect = 0
+            for ref_rule in list(ref):
+                if len(ref) < 2:
+                    break
+                if ref_rule.m_source != source:
+                    continue
+                if source == "source-0" and ref_rule.m_rule == rules.m_default_rule.m_rule:
+                    continue
+                ref_release(ref_rule, source)
+                expect += 1
+
+        active = rules.get_active_rule()
+        if len(ref) == 0:
+            matched = active is None
+        else:
+            matched = active is not None and active.m_rule == ref[-1].m_rule and \
+                active.m_source == ref[-1].m_source
+        if result != expect or rules.m_request_count != len(ref) or not matched:
+            print("Mismatch at operation", n, "op", op, rule.m_rule, source, result, expect)
+            passed = False
+            break
+
+    print("Rules stress test:", p_count, "operations,", elapsed_us // p_count, "us each, passed:", passed)
+    return passed
@@ -0,0 +1,282 @@
+#
+# Streaming loader for rules files
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# The RulesLoader reads a rules file in small chunks and parses one rule
+# object at a time, so the whole file never exists as a dict/list tree.
+# Each rule is handed to a function as soon as it is parsed, which keeps
+# only what matches this signal.  Peak heap while loading is bounded by
+# the largest single rule.  The other top-level members of the file are
+# small, and are returned as a dict.
+
+import io
+import json
+import gc
+
+
+class RulesLoader:
+
+    # Characters read from the file at a time
+    c_chunk_size = 256
+
+    # Parser states
+    c_state_key = 0
+    c_state_colon = 1
+    c_state_value = 2
+    c_state_scalar = 3
+    c_state_rules = 4
+    c_state_rule = 5
+    c_state_done = 6
+
+    # Create a loader for a rules file
+    # @param p_rule_file Filename of a json rules file
+    #
+    def __init__(self, p_rule_file):
+        self.m_rule_file = p_rule_file
+
+
+    # Parse the rules file
+    # @param p_rule_func Function called with the dict of each rule,
+    #        in file order
+    # @returns A dict of the top-level members other than "rules"
+    #
+    def load(self, p_rule_func):
+        fs = io.open(self.m_rule_file, mode='r')
+        try:
+            return self.parse(fs, p_rule_func)
+        finally:
+            fs.close()
+
+
+    # Parse a rules file stream
+    # @param p_fs The open file
+    # @param p_rule_func Function called with the dict of each rule
+    # @returns A dict of the top-level members other than "rules"
+    #
+    def parse(self, p_fs, p_rule_func):
+        header = dict()
+        state = RulesLoader.c_state_key
+        depth = 0
+        in_string = False
+        escape = False
+        key = None
+        # Text of the key or value being captured, or None
+        pieces = None
+        start = 0
+
+        while state != RulesLoader.c_state_done:
+            chunk = p_fs.read(RulesLoader.c_chunk_size)
+            if not chunk:
+                break
+            start = 0
+            for i in range(len(chunk)):
+                c = chunk[i]
+
+                if in_string:
+                    if escape:
+                        escape = False
+                    elif c == '\\':
+                        escape = True
+                    elif c == '"':
+                        in_string = False
+                        if state == RulesLoader.c_state_key:
+                            pieces.append(chunk[start:i])
+                            key = json.loads('"' + "".join(pieces) + '"')
+                            pieces = None
+                            state = RulesLoader.c_state_colon
+                    continue
+
+                if c == '"':
+                    in_string = True
+                    if state == RulesLoader.c_state_key and depth == 1:
+                        pieces = list()
+                        start = i + 1
+                        continue
+                    if state != RulesLoader.c_state_value:
+                        continue
+
+                if c == ' ' or c == '\t' or c == '\r' or c == '\n':
+                    continue
+
+                if state == RulesLoader.c_state_key:
+                    if c == '{':
+                        depth = 1
+                    elif c == '}':
+                        depth = 0
+                        state = RulesLoader.c_state_done
+                        break
+                    continue
+
+                if state == RulesLoader.c_state_colon:
+                    if c == ':':
+                        state = RulesLoader.c_state_value
+                    continue
+
+                if state == RulesLoader.c_state_value:
+                    if key == "rules" and c == '[':
+                        depth = 2
+                        state = RulesLoader.c_state_rules
+                        continue
+                    # Capture any other value whole
+                    pieces = list()
+                    start = i
+                    state = RulesLoader.c_state_scalar
+                    if c == '"':
+                        continue
+
+                if state == RulesLoader.c_state_scalar:
+                    if c == '{' or c == '[':
+                        depth += 1
+                    elif depth == 1 and (c == ',' or c == '}'):
+                        pieces.append(chunk[start:i])
+                        header[key] = json.loads("".join(pieces))
+                        pieces = None
+                        state = RulesLoader.c_state_key
+                        if c == '}':
+                            depth = 0
+                            state = RulesLoader.c_state_done
+                            break
+                    elif c == '}' or c == ']':
+                        depth -= 1
+                    continue
+
+                if state == RulesLoader.c_state_rules:
+                    if c == '{':
+                        depth = 3
+                        pieces = list()
+                        start = i
+                        state = RulesLoader.c_state_rule
+                    elif c == ']':
+                        depth = 1
+                        state = RulesLoader.c_state_key
+                    continue
+
+                if state == RulesLoader.c_state_rule:
+                    if c == '{' or c == '[':
+                        depth += 1
+                    elif c == '}' or c == ']':
+                        depth -= 1
+                        if depth == 2:
+                            # End of one rule object
+                            pieces.append(chunk[start:i + 1])
+                            text = "".join(pieces)
+                            pieces = None
+                            p_rule_func(json.loads(text))
+                            text = None
+                            state = RulesLoader.c_state_rules
+
+            if pieces is not None:
+                pieces.append(chunk[start:])
+
+        if state != RulesLoader.c_state_done:
+            raise Exception('Incomplete rules file ' + self.m_rule_file + ' 202610171108')
+        return header
+
+
+# Load each rules file with the RulesLoader and with json.load(), check
+# that both give the same rules, and record the peak gc.mem_alloc() of
+# each.  Automatic collection is disabled while loading, so the heap only
+# grows between the explicit collections.  The RulesLoader is sampled at
+# the end of each rule, before collecting, so each sample is the peak
+# since the previous rule: the chunks read, the pieces list, the joined
+# rule text, the json.loads() temporaries and the parsed rule.  json.load()
+# is sampled once when it returns, the peak of the whole tree and its
+# temporaries.  Both are measured from after the file is opened and read
+# once, so a read-ahead buffer of the port is not counted.
+# @param p_rule_files The rules files to load
+# @param p_rule_dir The directory of the rules files, "" for the current
+#        directory as on the board, "../rules" when run from python/
+#        on the unix port
+# @returns True if every file loaded the same both ways
+#
+def unit_test(p_rule_files=("atsf1953_rules_ss1.json", "atsf1959_rules_ss2.json", "bnsf_rules_20220801.json"), p_rule_dir=""):
+    passed = True
+    for rule_file in p_rule_files:
+        if p_rule_dir:
+            rule_file = p_rule_dir + "/" + rule_file
+        rule_list = list()
+        peak = [0]
+
+        def sample():
+            alloc = gc.mem_alloc() - base
+            if alloc > peak[0]:
+                peak[0] = alloc
+            gc.collect()
+
+        def add_rule(p_rule):
+            rule_list.append(p_rule["rule"])
+            sample()
+
+        loader = RulesLoader(rule_file)
+        fs = io.open(rule_file, mode='r')
+        fs.read(1)
+        fs.seek(0)
+        gc.collect()
+        base = gc.mem_alloc()
+        gc.disable()
+        try:
+            header = loader.parse(fs, add_rule)
+            # The members after the rules
+            sample()
+        finally:
+            gc.enable()
+        fs.close()
+        stream_peak = peak[0]
+        rule_list_stream = rule_list
+
+        fs = io.open(rule_file, mode='r')
+        fs.read(1)
+        fs.seek(0)
+        gc.collect()
+        base = gc.mem_alloc()
+        gc.disable()
+        try:
+            rd = json.load(fs)
+            tree_peak = gc.mem_alloc() - base
+        except MemoryError:
+            # json.load() needs more than the heap without collecting
+            rd = None
+            tree_peak = "MemoryError"
+        finally:
+            gc.enable()
+        fs.close()
+        if rd is None:
+            gc.collect()
+            fs = io.open(rule_file, mode='r')
+            rd = json.load(fs)
+            fs.close()
+
+        rule_list = list()
+        for rule in rd["rules"]:
+            rule_list.append(rule["rule"])
+        for name in header:
+            if header[name] != rd[name]:
+                passed = False
+        if rule_list != rule_list_stream or len(header) != len(rd) - 1:
+            passed = False
+        rd = None
+
+        print(rule_file, "rules:", len(rule_list), "peak bytes streamed:", stream_peak, "json.load:", tree_peak)
+    print("RulesLoader passed:", passed)
+    return passed
@@ -0,0 +1,330 @@
+#
+# Deadline-driven scheduler for the SigOS main loop
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# The Scheduler keeps a min-heap of task deadlines and blocks in
+# select.poll() on the registered sockets until the earliest deadline.
+# Socket traffic is handled as soon as it arrives, and the main loop only
+# wakes when a task is due.
+#
+# Heap entries are [key, sequence, task], where key is the deadline in
+# milliseconds relative to m_base_ms.  The base is moved forward
+# periodically so the keys stay well inside the ticks_ms() period.
+# Rescheduling a task pushes a new entry, and stale entries are dropped
+# when they reach the top of the heap.
+#
+# Code that may run from a scheduled interrupt callback must not touch the
+# heap, it uses RequestTask() instead, which only sets flags.  A request
+# made while the main loop is handling events runs the task without
+# blocking.  One made while blocked in select.poll() is picked up on the
+# next wake, at the latest the next periodic task such as the watchdog.
+
+import time
+import select
+import heapq
+import Deadline
+import Metrics
+
+
+class SchedulerTask:
+
+    # Create a task, use Scheduler.add_task() instead of calling directly
+    # @param p_name The name of the task, used with Scheduler.wake()
+    # @param p_func Function to call, with no arguments, when the task is due
+    # @param p_period_ms The period of a repeating task, or 0 for a task that
+    #        only runs when woken
+    #
+    def __init__(self, p_name, p_func, p_period_ms):
+        self.m_name = p_name
+        self.m_func = p_func
+        self.m_period_ms = p_period_ms
+        self.m_deadline = Deadline.Deadline()
+        self.m_entry = None
+        self.m_run_count = 0
+        # Set by Scheduler.RequestTask()
+        self.m_requested = False
+
+
+    # @returns A string representation of this task
+    #
+    def __str__(self):
+        s = "task:"
+        s += self.m_name
+        s += ", period-ms:"
+        s += str(self.m_period_ms)
+        s += ", runs:"
+        s += str(self.m_run_count)
+        s += ", next:"
+        s += str(self.m_deadline)
+        return s
+
+
+class Scheduler:
+
+    # Class variable holding the Scheduler singleton
+    c_scheduler = None
+
+    # The runtime given task requests, the Scheduler singleton or the
+    # AsyncRuntime, either has a request_task() method
+    c_runtime = None
+
+    # Longest time to block when no task is scheduled
+    c_max_wait_ms = 60000
+
+    # Move the heap key base forward after this many milliseconds
+    c_rebase_ms = 24 * 60 * 60 * 1000
+
+    # Time spent handling events and running tasks in each loop iteration
+    c_loop_metric = Metrics.Metrics.Histogram("loop")
+
+    # Create the Scheduler singleton
+    #
+    def __init__(self):
+        self.m_heap = list()
+        self.m_sequence = 0
+        self.m_base_ms = time.ticks_ms()
+        self.m_task_dict = dict()
+        self.m_poller = select.poll()
+        self.m_socket_handler = dict()
+        self.m_requested = False
+        Scheduler.c_scheduler = self
+        Scheduler.c_runtime = self
+
+
+    # Add a task to the scheduler
+    # @param p_name The name of the task
+    # @param p_func Function to call, with no arguments, when the task is due
+    # @param p_period_ms The period of a repeating task, or 0 for a task that
+    #        only runs when woken with wake()
+    # @param p_first_ms Milliseconds until the first run, None to wait for wake()
+    # @returns The new SchedulerTask
+    #
+    def add_task(self, p_name, p_func, p_period_ms, p_first_ms=0):
+        task = SchedulerTask(p_name, p_func, p_period_ms)
+        self.m_task_dict[p_name] = task
+        if p_first_ms is not None:
+            self.schedule(task, p_first_ms)
+        return task
+
+
+    # Run the named task no later than p_delay_ms from now.  Has no effect
+    # if the task is already due sooner.
+    # @param p_name The name of the task
+    # @param p_delay_ms Milliseconds from now, None is ignored
+    #
+    def wake(self, p_name, p_delay_ms):
+        if p_delay_ms is None:
+            return
+        # At least one tick, so a task that wakes itself cannot spin
+        if p_delay_ms < 1:
+            p_delay_ms = 1
+        task = self.m_task_dict.get(p_name)
+        if task is None:
+            return
+        if task.m_entry is not None:
+            remaining = task.m_deadline.remaining_ms()
+            if remaining is not None and remaining <= p_delay_ms:
+                return
+        self.schedule(task, p_delay_ms)
+
+
+    # Wake a task of the Scheduler singleton, if one is running.
+    # @param p_name The name of the task
+    # @param p_delay_ms Milliseconds from now
+    #
+    @classmethod
+    def WakeTask(p_class, p_name, p_delay_ms):
+        if p_class.c_scheduler:
+            p_class.c_scheduler.wake(p_name, p_delay_ms)
+
+
+    # Ask the runtime to run the named task soon.  Does not allocate, and
+    # is safe from a scheduled interrupt callback.
+    # @param p_name The name of the task
+    #
+    @classmethod
+    def RequestTask(p_class, p_name):
+        if p_class.c_runtime:
+            p_class.c_runtime.request_task(p_name)
+
+
+    # Mark the named task to run on the next loop iteration, see RequestTask()
+    # @param p_name The name of the task
+    #
+    def request_task(self, p_name):
+        task = self.m_task_dict.get(p_name)
+        if task is None:
+            return
+        task.m_requested = True
+        self.m_requested = True
+
+
+    # Put the requested tasks on the heap, due now
+    #
+    def take_requests(self):
+        # Clear first, a request made during the loop is seen next time
+        self.m_requested = False
+        for task in self.m_task_dict.values():
+            if task.m_requested:
+                task.m_requested = False
+                if task.m_entry is None or not task.m_deadline.expired():
+                    self.schedule(task, 0)
+
+
+    # Put a task on the heap
+    # @param p_task The SchedulerTask
+    # @param p_delay_ms Milliseconds from now
+    #
+    def schedule(self, p_task, p_delay_ms):
+        if p_delay_ms < 0:
+            p_delay_ms = 0
+        p_task.m_deadline.start(p_delay_ms)
+        key = time.ticks_diff(p_task.m_deadline.deadline_ms(), self.m_base_ms)
+        self.m_sequence += 1
+        entry = [key, self.m_sequence, p_task]
+        p_task.m_entry = entry
+        heapq.heappush(self.m_heap, entry)
+
+
+    # Register a socket to be watched by the Scheduler
+    # @param p_socket The socket
+    # @param p_events The select events, e.g. select.POLLIN
+    # @param p_handler Function called as p_handler(p_socket, p_events)
+    #
+    def register_socket(self, p_socket, p_events, p_handler):
+        self.m_socket_handler[p_socket] = p_handler
+        self.m_poller.register(p_socket, p_events)
+
+
+    # Change the events watched for a registered socket
+    # @param p_socket The socket
+    # @param p_events The select events
+    #
+    def modify_socket(self, p_socket, p_events):
+        if p_socket in self.m_socket_handler:
+            self.m_poller.modify(p_socket, p_events)
+
+
+    # Stop watching a socket
+    # @param p_socket The socket
+    #
+    def unregister_socket(self, p_socket):
+        if p_socket in self.m_socket_handler:
+            del self.m_socket_handler[p_socket]
+            self.m_poller.unregister(p_socket)
+
+
+    # Move the heap key base forward to p_now_ms and rebuild the heap
+    # @param p_now_ms The current time from time.ticks_ms()
+    #
+    def rebase(self, p_now_ms):
+        self.m_base_ms = p_now_ms
+        heap = list()
+        for entry in self.m_heap:
+            task = entry[2]
+            if task.m_entry is entry:
+                entry[0] = time.ticks_diff(task.m_deadline.deadline_ms(), p_now_ms)
+                heap.append(entry)
+        heapq.heapify(heap)
+        self.m_heap = heap
+
+
+    # @returns The earliest task on the heap, dropping stale entries, or None
+    #
+    def peek(self):
+        while len(self.m_heap) > 0:
+            entry = self.m_heap[0]
+            if entry[2].m_entry is entry:
+                return entry[2]
+            heapq.heappop(self.m_heap)
+        return None
+
+
+    # @param p_now_ms The current time from time.ticks_ms()
+    # @returns Milliseconds until the earliest task is due
+    #
+    def next_wait_ms(self, p_now_ms):
+        task = self.peek()
+        if task is None:
+            return Scheduler.c_max_wait_ms
+        wait = time.ticks_diff(task.m_deadline.deadline_ms(), p_now_ms)
+        if wait < 0:
+            return 0
+        if wait > Scheduler.c_max_wait_ms:
+            return Scheduler.c_max_wait_ms
+        return wait
+
+
+    # Block until a socket is ready or the earliest task is due, then
+    # handle the ready sockets and run the due tasks.
+    #
+    def run_once(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.m_base_ms) > Scheduler.c_rebase_ms:
+            self.rebase(now)
+
+        wait_ms = 0
+        if not self.m_requested:
+            wait_ms = self.next_wait_ms(now)
+        events = self.m_poller.poll(wait_ms)
+        start_us = time.ticks_us()
+        for event in events:
+            handler = self.m_socket_handler.get(event[0])
+            if handler:
+                handler(event[0], event[1])
+        if self.m_requested:
+            self.take_requests()
+
+        # Run every task that is due
+        now = time.ticks_ms()
+        while True:
+            task = self.peek()
+            if task is None:
+                break
+            if time.ticks_diff(now, task.m_deadline.deadline_ms()) < 0:
+                break
+            heapq.heappop(self.m_heap)
+            task.m_entry = None
+            if task.m_period_ms > 0:
+                # Schedule the next run first, so the task may wake itself sooner
+                self.schedule(task, task.m_period_ms)
+            task.m_run_count += 1
+            task.m_func()
+        Metrics.Metrics.Since(Scheduler.c_loop_metric, start_us)
+
+
+    # Run forever
+    #
+    def run(self):
+        while True:
+            self.run_once()
+
+
+    # @returns A list of strings describing the scheduled tasks
+    #
+    def task_list(self):
+        out = list()
+        for name in self.m_task_dict:
+            out.append(str(self.m_task_dict[name]))
+        return out
@@ -26,9 +26,11 @@
 import sys
 import machine
 from machine import Pin, PWM, Timer
-import Light
+from array import array
 import GPIO
 import Log
+import Deferred
+import Metrics
 
 
 class Semaphore:
@@ -39,6 +41,22 @@ class Semaphore:
     # Class variable for generating timer id's
     c_timer_id = 0
 
+    # Servo timer ticks
+    c_tick_metric = Metrics.Metrics.Counter("servo ticks")
+
+    # The single timer driving all semaphore servos
+    c_timer = None
+
+    # Motion engine tick rate, matches the 50Hz servo frame
+    c_tick_hz = 50
+
+    # Motion profiles, each a table of c_profile_size + 1 entries giving
+    # the fraction of the move completed, scaled 0 to 1024.
+    # Built by BuildProfiles() from c_profile_names.
+    c_profile_size = 32
+    c_profile_names = ("linear", "ease-in", "ease-out", "ease-in-out")
+    c_profiles = dict()
+
     # Create a Semaphore object
     # @param p_head_id The identifier (number) of the Head containing this semaphore,
     #        1 is the highest head, 2 is the next highest, etc.
@@ -48,26 +66,43 @@ class Semaphore:
     # @param p_0_degrees_pwd Servo PWM value for 0 degrees
     # @param p_90_degrees_pwm Servo PWM value for 90 degrees
     # @param p_log Log file to print messages to.
+    # @param p_profile Name of the motion profile, one of c_profile_names
     #
-    def __init__(self, p_head_id, p_gpio_id, p_degrees_per_second, p_0_degrees_pwm, p_90_degrees_pwm, p_log):
+    def __init__(self, p_head_id, p_gpio_id, p_degrees_per_second, p_0_degrees_pwm, p_90_degrees_pwm, p_log, p_profile="linear"):
         self.m_head_id = p_head_id
+        # The Head of this semaphore, set by Head.add_semaphore()
+        self.m_head = None
         self.m_gpio_id = p_gpio_id
         self.m_gpio_pin = None
         self.m_degrees_per_second = p_degrees_per_second
         self.m_degrees_0_pwm = p_0_degrees_pwm
         self.m_degrees_90_pwm = p_90_degrees_pwm
-        pwm_per_90degrees = abs(p_90_degrees_pwm - p_0_degrees_pwm)
-        pwm_per_degree = pwm_per_90degrees / 90.0
-        self.m_pwm_per_second = pwm_per_degree * p_degrees_per_second
+        self.m_profile_name = p_profile
+        self.m_profile = None
+        # All duty values are kept in 16-bit duty units (0-65535)
+        self.m_duty_0 = duty_to_u16(p_0_degrees_pwm)
+        self.m_duty_90 = duty_to_u16(p_90_degrees_pwm)
+        # Duty change per second at the configured speed, times 90.  It is
+        # kept unscaled so slow speeds are not rounded down, see set_aspect()
+        self.m_pwm_rate = abs(self.m_duty_90 - self.m_duty_0) * p_degrees_per_second
         self.m_pwm_duty = None
-        self.m_pwm_step = None
+        self.m_pwm_start = None
         self.m_pwm_target = None
+        self.m_move_tick = 0
+        self.m_move_ticks = 0
         self.m_servo_moving = False
         self.m_angle_target = None
         self.m_servo = None
-        self.m_timer = None
+        self.m_servo_u16 = False
         self.m_log = p_log
 
+        if p_profile not in Semaphore.c_profile_names:
+            msg = "Invalid motion-profile ("
+            msg += str(p_profile)
+            msg += "), using linear 202610171140"
+            self.m_log.add("Semaphore", msg)
+            self.m_profile_name = "linear"
+
         # Keep a local list of Semaphores
         Semaphore.c_semaphore_list.append(self)
 
@@ -76,40 +111,57 @@ class Semaphore:
     def __del__(self):
         if self.m_servo:
             self.m_servo.deinit()
-        if self.m_timer:
-            self.m_timer.deinit()
 
 
     # Initialize the servo hardware, must be called prior to set_servo_angle()
     #
     @classmethod
     def InitHardware(p_class, p_config):
+        if len(p_class.c_semaphore_list) == 0:
+            return
+
+        p_class.BuildProfiles()
         for semaphore in p_class.c_semaphore_list:
             semaphore.init_hardware()
 
+        # One timer drives all semaphores at the servo frame rate
+        p_class.c_timer = machine.Timer(p_class.c_timer_id)
+        p_class.c_timer.init(mode=Timer.PERIODIC, freq=p_class.c_tick_hz, callback=servo_callback)
 
-    # @returns The number of created Semaphore objects
+
+    # Precompute the motion profile tables
     #
     @classmethod
-    def Count(p_class):
-        return len(p_class.c_semaphore_list)
+    def BuildProfiles(p_class):
+        size = p_class.c_profile_size
+        for name in p_class.c_profile_names:
+            table = array('H', [0] * (size + 1))
+            for i in range(size + 1):
+                x = i / size
+                if name == "ease-in":
+                    y = x * x
+                elif name == "ease-out":
+                    y = 1.0 - (1.0 - x) * (1.0 - x)
+                elif name == "ease-in-out":
+                    y = x * x * (3.0 - 2.0 * x)
+                else:
+                    y = x
+                table[i] = int(y * 1024.0 + 0.5)
+            p_class.c_profiles[name] = table
 
 
-    # Check the Semaphore list for one that matches the input parameters
-    # @param p_head_id The Head ID of the Semaphore to match
-    # @returns The matching Semaphore, or None
+    # @returns The number of created Semaphore objects
     #
     @classmethod
-    def CheckForMatch(p_class, p_head_id):
-        for semaphore in p_class.c_semaphore_list:
-            if p_head_id == semaphore.m_head_id:
-                return semaphore
-        return None
+    def Count(p_class):
+        return len(p_class.c_semaphore_list)
+
 
     # Adjust servos that are in the process of changing state
     #
     @classmethod
     def AdjustDuty(p_class):
+        Metrics.Metrics.Count(p_class.c_tick_metric)
         for semaphore in p_class.c_semaphore_list:
             semaphore.adjust_duty()
 
@@ -119,67 +171,52 @@ class Semaphore:
     def init_hardware(self):
         # Setup PWM hardware for server signal
         pwm_freq = 50 # freq=50 is required for servos
-        self.m_pwm_duty = self.m_degrees_90_pwm # servo flag low-position
-        self.m_pwm_target = self.m_degrees_90_pwm
+        self.m_pwm_duty = self.m_duty_90 # servo flag low-position
+        self.m_pwm_target = self.m_duty_90
         self.m_angle_target = 90
+        self.m_profile = Semaphore.c_profiles[self.m_profile_name]
         self.m_gpio_pin = GPIO.GPIO("Semaphore", self.m_gpio_id, Pin.OUT, None, self.m_log)
 
-        # Read the current PWM duty, so we can smoothly transition to initial position
-        self.m_servo = PWM(self.m_gpio_id, freq=pwm_freq, duty=self.m_pwm_duty)
-        #self.m_servo = PWM(self.m_gpio_id, freq=pwm_freq)
-        #self.m_pwm_duty = self.m_servo.duty()
+        self.m_servo = PWM(self.m_gpio_id, freq=pwm_freq, duty=self.m_pwm_duty >> 6)
+        # Use the 16-bit duty where the port supports it, for finer steps
+        self.m_servo_u16 = hasattr(self.m_servo, "duty_u16")
+        self.set_servo_duty(self.m_pwm_duty)
 
-        # Create and start timer
-        self.m_timer = machine.Timer(Semaphore.c_timer_id)
-        pwm_per_second = int(self.m_pwm_per_second)
-        self.m_timer.init(mode=Timer.PERIODIC, freq=pwm_per_second, callback=servo_callback)
 
-
-    # Convert from degrees to PWM duty cycle
+    # Convert from degrees to PWM duty cycle, using integer math only
     # @p_angle The angle of the flag, 0, 45, or 90
-    # @returns PWM duty cycle
+    # @returns PWM duty cycle, in 16-bit duty units
     #
     def degrees_to_pwm(self, p_angle):
-        # Convert from angle to percent
-        ratio = 100.0 / 90.0
-        percent = p_angle * ratio
-        # Convert percent to duty
-        min = self.m_degrees_0_pwm
-        max = self.m_degrees_90_pwm
-        delta = max - min
-        if min > max:
-            # Swap min and max and invert percent
-            temp = min
-            min = max
-            max = temp
-            delta = max - min
-            percent = 100. - percent
-        duty_offset = (delta * percent) / 100.0
-        duty = min + duty_offset
-        return duty
-
-
-    # Adjust the duty cycle by 1 and restart timer if necessary
+        # Interpolate between the 0 and 90 degree duty, works for either
+        # direction of servo travel
+        delta = self.m_duty_90 - self.m_duty_0
+        return self.m_duty_0 + (delta * int(p_angle)) // 90
+
+
+    # Advance the servo one motion engine tick along its motion profile.
+    # Called from the timer interrupt, integer math only.
     #
     def adjust_duty(self):
         if not self.m_servo_moving:
             return
 
-        # Compute the new duty from the old self.m_pwm_duty
-        new_duty = self.m_pwm_duty
-        if int(new_duty) < int(self.m_pwm_target):
-            new_duty += 1
-        elif int(new_duty) > int(self.m_pwm_target):
-            new_duty -= 1
-        else:
-            # Re-enable light output
-            Light.Light.Inhibit(self.m_head_id, False)
+        self.m_move_tick += 1
+        if self.m_move_tick >= self.m_move_ticks:
             # Movement complete
+            self.set_servo_duty(self.m_pwm_target)
             self.m_servo_moving = False
+            # Re-enable light output
+            self.inhibit_lights(False)
+            return
 
-        # Update the servo position
-        #print(new_duty)
-        self.set_servo_duty(new_duty)
+        # Position within the profile table, 8 bits of fraction
+        pos = (self.m_move_tick * Semaphore.c_profile_size * 256) // self.m_move_ticks
+        index = pos >> 8
+        low = self.m_profile[index]
+        progress = low + (((self.m_profile[index + 1] - low) * (pos & 0xFF)) >> 8)
+        delta = self.m_pwm_target - self.m_pwm_start
+        self.set_servo_duty(self.m_pwm_start + ((delta * progress) >> 10))
 
 
     # Set a new aspect for the semaphore flag
@@ -189,22 +226,57 @@ class Semaphore:
     def set_aspect(self, p_angle):
         # Update targets to new request
         self.m_angle_target = p_angle
-        duty = self.degrees_to_pwm(p_angle)
-        self.m_pwm_target = duty
-        if int(self.m_pwm_target) != int(self.m_pwm_duty):
-            self.m_servo_moving = True
-            # Inhibit light output during movement
-            Light.Light.Inhibit(self.m_head_id, True)
+        target = self.degrees_to_pwm(p_angle)
+        if target == self.m_pwm_target and self.m_servo_moving:
+            # Already on the way there
+            return True
+
+        # Stop the motion engine while the move is set up
+        was_moving = self.m_servo_moving
+        self.m_servo_moving = False
+        self.m_pwm_start = self.m_pwm_duty
+        self.m_pwm_target = target
+        if target == self.m_pwm_duty:
+            if was_moving:
+                # Stopped exactly on the new target
+                self.inhibit_lights(False)
+            return True
+
+        # Number of ticks for the move at the configured speed, rounded up.
+        # adjust_duty() interpolates the position from the tick count, so
+        # each tick moves distance / ticks and never rounds down to zero.
+        distance = abs(target - self.m_pwm_duty)
+        ticks = 1
+        if self.m_pwm_rate > 0:
+            ticks = int(-(-(distance * 90 * Semaphore.c_tick_hz) // self.m_pwm_rate))
+            if ticks < 1:
+                ticks = 1
+        self.m_move_ticks = ticks
+        self.m_move_tick = 0
+
+        # Inhibit light output during movement
+        self.inhibit_lights(True)
+        self.m_servo_moving = True
         return True
 
 
+    # Inhibit the light output of this semaphore's head during movement
+    # @param p_inhibit The inhibit state, True for inhibit
+    #
+    def inhibit_lights(self, p_inhibit):
+        if self.m_head is not None:
+            self.m_head.inhibit(p_inhibit)
+
+
     # Set the angular position of the semaphore flag
-    # @param p_duty The duty cycle value of the servo waveform
+    # @param p_duty The duty cycle value of the servo waveform, 16-bit duty units
     #
     def set_servo_duty(self, p_duty):
-        duty = int(p_duty)
-        self.m_pwm_duty = duty
-        self.m_servo.duty(duty)
+        self.m_pwm_duty = p_duty
+        if self.m_servo_u16:
+            self.m_servo.duty_u16(p_duty)
+        else:
+            self.m_servo.duty(p_duty >> 6)
 
 
     # @returns A string representation of this Semaphore
@@ -215,12 +287,35 @@ class Semaphore:
         s += str(self.m_head_id)
         s += "\n    degrees-per-second: "
         s += str(self.m_degrees_per_second)
+        s += "\n    motion-profile: "
+        s += str(self.m_profile_name)
         return s
 
 
+# Convert a 10-bit PWM duty (0-1023), as used in config.json, to a 16-bit duty
+# @param p_duty The 10-bit duty value
+# @returns The 16-bit duty value
+#
+def duty_to_u16(p_duty):
+    return (int(p_duty) * 65535) // 1023
+
+
 # Timer callback to adjust the servo duty cycle
 #
 def servo_callback(p_timer):
     Semaphore.AdjustDuty()
 
 
+# Unit test: the servo timer callback must not allocate. Call from the REPL
+# after InitHardware(), with a semaphore moving.
+# @param p_ticks Number of simulated timer ticks
+#
+def unit_test(p_ticks=5000):
+    for semaphore in Semaphore.c_semaphore_list:
+        semaphore.set_aspect(0)
+    grown = Deferred.Deferred.HeapGrowth(Semaphore.AdjustDuty, p_ticks)
+    if grown != 0:
+        print("Failed 1100 heap grew", grown, "bytes\n")
+    print("Unit tests completed\n")
+
+
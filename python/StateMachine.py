@@ -25,7 +25,6 @@
 
 import Config
 import Log
-import Timestamp
 
 
 class StateMachine:
@@ -33,9 +32,6 @@ class StateMachine:
     # Store each created StateMachine in this class list
     c_state_machine_file = None
     c_state_machine_list = list()
-    # Perform poll every second
-    c_poll_limit = 1.0
-    c_poll_count = 0.0
 
 
     # Create an object to encapsulate configuraton for state machines
@@ -92,22 +88,29 @@ class StateMachine:
             self.enter_state(next_state)
 
 
-    # Perform periodic polling for all of the registered StateMachines.
-    # Call this method only after loading all Config
-    # @param p_poll_time The frequency this function is called, in
-    #        fractions of seconds
+    # Test every registered StateMachine for a timeout transition
     #
     @classmethod
-    def Poll(p_class, p_poll_time):
-        p_class.c_poll_count += p_poll_time
-        if p_class.c_poll_limit < p_class.c_poll_count:
-            p_class.c_poll_count = 0
-            return
+    def CheckTimeouts(p_class):
 
         for state_machine in p_class.c_state_machine_list:
             state_machine.poll()
 
 
+    # @returns Milliseconds until the earliest state timeout of all
+    #          StateMachines, or None if no timeout is pending
+    #
+    @classmethod
+    def NextTimeoutMs(p_class):
+        earliest = None
+        for state_machine in p_class.c_state_machine_list:
+            for trans in state_machine.m_current_state.m_trans_list:
+                remaining = trans.m_expire_time.remaining_ms()
+                if remaining is not None and (earliest is None or remaining < earliest):
+                    earliest = remaining
+        return earliest
+
+
     # Poll for state timeouts, transition if found
     #
     def poll(self):
@@ -24,7 +24,8 @@
 #
 
 import Log
-import Timestamp
+import Deadline
+import Scheduler
 
 
 class StateTrans:
@@ -42,7 +43,11 @@ class StateTrans:
         self.m_state_name = p_state_name
         self.m_input_name = p_input_name
         self.m_timeout_sec = p_timeout_sec
-        self.m_expire_time = None
+        # The json file may provide the timeout as a number or a string
+        self.m_timeout_ms = 0
+        if p_timeout_sec:
+            self.m_timeout_ms = int(float(p_timeout_sec) * 1000)
+        self.m_expire_time = Deadline.Deadline()
         self.m_next_state = p_next_state
         self.m_log = p_log
 
@@ -50,11 +55,12 @@ class StateTrans:
     # Must be called when the StateMachine enters a State containing this transition.
     #
     def enter(self):
-        if self.m_timeout_sec:
-            self.m_expire_time = Timestamp.Timestamp;
-            self.m_expire_time.expire_after(self.m_timeout_sec)
+        if self.m_timeout_ms > 0:
+            self.m_expire_time.start(self.m_timeout_ms)
+            # Make sure the main loop checks back when the timeout expires
+            Scheduler.Scheduler.WakeTask("state-machines", self.m_timeout_ms)
         else:
-            self.m_expire_time = None
+            self.m_expire_time.cancel()
 
 
     # Test if the input will cause a transition to a new state.
@@ -71,7 +77,7 @@ class StateTrans:
     # @returns The name of a new state on a timeout, or empty string
     #
     def test_timeout(self):
-        if self.m_expire_time and self.m_expire_time.expired():
+        if self.m_expire_time.expired():
             return self.m_next_state
         return ''
 
@@ -87,7 +93,7 @@ class StateTrans:
         if self.m_timeout_sec:
             s += "\n      timeout-sec:"
             s += str(self.m_timeout_sec)
-        if self.m_expire_time:
+        if self.m_expire_time.armed():
             s += "\n      expire_time:"
             s += str(self.m_expire_time)
         return s
@@ -0,0 +1,233 @@
+#
+# Syslog forwarding of the Log for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+import time
+import socket
+import Log
+import Deadline
+import WiFi
+
+# Forward every new Log entry to a syslog collector as UDP datagrams,
+# in the BSD syslog format of RFC 3164.  Entries are sent in batches from
+# a main loop task, never from Log.add().  The messages of a batch are
+# packed into as few datagrams as fit c_datagram_max, one message per line.
+# The collector name is resolved only while WiFi is connected, and a failed
+# lookup is retried with an increasing delay, since a lookup blocks the main
+# loop.  A collector given as a literal IPv4 address is never looked up.
+
+class Syslog:
+
+    # Class variables
+
+    # The singleton, or None when forwarding is disabled
+    c_syslog = None
+
+    # Priority of the messages: facility local0, severity informational
+    c_priority = "<134>"
+
+    # Most entries sent on one poll, the rest wait for the next poll
+    c_batch_max = 16
+
+    # Largest datagram, the RFC 3164 limit of a message
+    c_datagram_max = 1024
+
+    # Delay before retrying a failed lookup of the collector, doubled
+    # on each failure up to c_resolve_max_ms
+    c_resolve_min_ms = 5000
+    c_resolve_max_ms = 300000
+
+    c_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+        "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+    # Create the forwarder.  The collector address is resolved on the first
+    # poll, after WiFi has connected.
+    # @param p_host The host name or address of the collector
+    # @param p_port The UDP port of the collector
+    # @param p_hostname The hostname of this signal
+    # @param p_log Reference to the Log object
+    #
+    def __init__(self, p_host, p_port, p_hostname, p_log):
+        self.m_host = p_host
+        self.m_port = p_port
+        self.m_log = p_log
+        self.m_address = None
+        self.m_socket = None
+        self.m_resolve_ms = Syslog.c_resolve_min_ms
+        self.m_resolve_deadline = Deadline.Deadline()
+        # Tags may not contain spaces, and the host name ends at the first dot
+        self.m_hostname = p_hostname.split(".")[0]
+
+        # Log.c_log_total of the next entry to send
+        self.m_next = Log.Log.c_log_total - Log.Log.c_log_count
+
+        # Statistics
+        self.m_sent = 0
+        self.m_missed = 0
+        self.m_failed = 0
+
+        # Save this singleton
+        Syslog.c_syslog = self
+
+
+    # Format a Log entry as a syslog message
+    # @param p_entry A tuple from Log.get_entry()
+    # @param p_repeats A tuple from Log.get_repeats()
+    # @returns The message as bytes
+    #
+    def format(self, p_entry, p_repeats):
+        (entry_time, source, text) = p_entry
+        ltime = time.localtime(entry_time)
+        s = Syslog.c_priority
+        s += Syslog.c_months[ltime[1] - 1]
+        s += " {:2d} {:02d}:{:02d}:{:02d} ".format(ltime[2], ltime[3], ltime[4], ltime[5])
+        s += self.m_hostname
+        s += " "
+        s += source.replace(" ", "_")
+        s += ": "
+        s += text
+        if p_repeats[0]:
+            s += " (repeated "
+            s += str(p_repeats[0])
+            s += " times)"
+        return s.encode()
+
+
+    # @returns True if the collector host is a literal IPv4 address
+    #
+    def is_literal(self):
+        parts = self.m_host.split(".")
+        if len(parts) != 4:
+            return False
+        for part in parts:
+            if not part.isdigit():
+                return False
+        return True
+
+
+    # Resolve the collector address, once WiFi is connected and the
+    # retry delay of a failed lookup has passed
+    # @returns True if the address is known
+    #
+    def resolve(self):
+        if self.m_address:
+            return True
+        if self.is_literal():
+            self.m_address = (self.m_host, self.m_port)
+            return True
+        wifi = WiFi.WiFi.c_wifi
+        if wifi is None or not wifi.m_wifi.isconnected():
+            return False
+        if self.m_resolve_deadline.armed() and not self.m_resolve_deadline.expired():
+            return False
+        try:
+            self.m_address = socket.getaddrinfo(self.m_host, self.m_port)[0][-1]
+        except OSError:
+            msg = "Syslog lookup of " + self.m_host + " failed, retry in "
+            msg += str(self.m_resolve_ms) + "ms 202610171160"
+            self.m_log.add("Syslog", msg)
+            self.m_resolve_deadline.start(self.m_resolve_ms)
+            self.m_resolve_ms = min(self.m_resolve_ms * 2, Syslog.c_resolve_max_ms)
+            return False
+        self.m_resolve_deadline.cancel()
+        self.m_resolve_ms = Syslog.c_resolve_min_ms
+        return True
+
+
+    # Open the socket, and resolve the collector address
+    # @returns True if ready to send
+    #
+    def open(self):
+        if self.m_socket:
+            return True
+        if not self.resolve():
+            return False
+        try:
+            self.m_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        except OSError:
+            # Try again on the next poll
+            return False
+        return True
+
+
+    # Send one datagram
+    # @param p_datagram The messages, as bytes
+    # @param p_count The number of messages in the datagram
+    #
+    def send(self, p_datagram, p_count):
+        try:
+            self.m_socket.sendto(p_datagram, self.m_address)
+            self.m_sent += p_count
+        except OSError:
+            # Drop the entries, a syslog datagram may be lost anyway
+            self.m_failed += p_count
+
+
+    # Send the Log entries added since the last poll
+    #
+    def poll(self):
+        total = Log.Log.c_log_total
+        if self.m_next >= total:
+            return
+        if not self.open():
+            return
+        oldest = total - Log.Log.c_log_count
+        if self.m_next < oldest:
+            self.m_missed += oldest - self.m_next
+            self.m_next = oldest
+        log = Log.Log()
+        end = min(total, self.m_next + Syslog.c_batch_max)
+        datagram = b""
+        count = 0
+        for k in range(self.m_next, end):
+            index = k - oldest
+            message = self.format(log.get_entry(index), log.get_repeats(index))
+            message = message[:Syslog.c_datagram_max]
+            if count > 0 and len(datagram) + 1 + len(message) > Syslog.c_datagram_max:
+                self.send(datagram, count)
+                datagram = b""
+                count = 0
+            if count > 0:
+                datagram += b"\n"
+            datagram += message
+            count += 1
+        if count > 0:
+            self.send(datagram, count)
+        self.m_next = end
+
+
+    # @returns A string with the state of the forwarder
+    #
+    def __str__(self):
+        s = "Syslog: "
+        s += self.m_host
+        s += ":"
+        s += str(self.m_port)
+        s += ", sent: "
+        s += str(self.m_sent)
+        s += ", missed: "
+        s += str(self.m_missed)
+        s += ", failed: "
+        s += str(self.m_failed)
+        return s
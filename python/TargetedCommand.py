@@ -47,6 +47,17 @@ class TargetedCommand:
         if p_hostname == self.m_target:
             self.m_local = True
 
+        # Resolve a local command once, so execute() is a direct call
+        self.m_word_list = None
+        self.m_func = None
+        if self.m_local:
+            self.m_word_list = Command.Command.Tokenize(self.m_command)
+            cmd = Command.Command.Lookup(self.m_word_list)
+            if cmd is None:
+                self.m_log.add(self.m_target, self.error_msg("Invalid command") + " 202610171104")
+            else:
+                self.m_func = cmd.m_func
+
     # Destructor
     #
     def __del__(self):
@@ -58,30 +69,15 @@ class TargetedCommand:
     #
     def execute(self):
         if self.m_local:
-            # Attempt to parse and execute the specified command line
-            # print(line)
-            (cmd_match, func_result, result_list) = Command.Command.ParseAndExec(self.m_command, self.m_target)
-            if not cmd_match:
-                msg = "Invalid command ["
-                msg += self.m_command
-                msg += "] target ["
-                msg += self.m_target
-                msg += "]"
-                self.m_log.add(self.m_target, msg)
+            if not self.m_func:
+                # Reported when loaded
                 return False
 
+            (func_result, result_list) = self.m_func(self.m_word_list, self.m_target)
             if not func_result:
-                msg = "Command failed ["
-                msg += self.m_command
-                msg += "] target ["
-                msg += self.m_target
-                msg += "]"
-                self.m_log.add(self.m_target, msg)
+                self.m_log.add(self.m_target, self.error_msg("Command failed"))
                 return False
 
-            for out_line in result_list:
-                self.m_log.add(self.m_target, out_line)
-
             return True
 
         # dnevil - temporary debug output
@@ -95,6 +91,19 @@ class TargetedCommand:
         return True
 
 
+    # @param p_error The error description
+    # @returns An error message naming the command and target
+    #
+    def error_msg(self, p_error):
+        msg = p_error
+        msg += " ["
+        msg += self.m_command
+        msg += "] target ["
+        msg += self.m_target
+        msg += "]"
+        return msg
+
+
     # @returns A string representation of this Detector
     #
     def __str__(self):
@@ -0,0 +1,93 @@
+#
+# Telnet command filter for SigOS
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+# Removes telnet command sequences from the bytes received from a client.
+# TelnetServer and the AsyncRuntime share it, so both handle IAC IAC,
+# option negotiation and sub-negotiation the same way.  It imports no
+# hardware modules.
+
+
+class TelnetFilter:
+
+    # Receive states
+    c_data = 0
+    c_iac = 1
+    c_option = 2
+    c_sub = 3
+    c_sub_iac = 4
+
+    # Telnet command bytes
+    c_iac_byte = 0xFF
+    c_sb_byte = 0xFA
+    c_se_byte = 0xF0
+    c_will_byte = 0xFB
+    c_dont_byte = 0xFE
+
+    # Create a filter for one connection
+    #
+    def __init__(self):
+        self.m_state = TelnetFilter.c_data
+
+
+    # Remove telnet command sequences and null bytes from p_buf in
+    # place.  The state carries over, so a sequence may span calls.
+    # @param p_buf A bytearray holding the received bytes
+    # @param p_count The number of bytes received into p_buf
+    # @returns The number of data bytes left at the start of p_buf
+    #
+    def strip(self, p_buf, p_count):
+        state = self.m_state
+        out = 0
+        for i in range(p_count):
+            byte = p_buf[i]
+            if state == TelnetFilter.c_data:
+                if byte == TelnetFilter.c_iac_byte:
+                    state = TelnetFilter.c_iac
+                elif byte != 0:
+                    p_buf[out] = byte
+                    out += 1
+            elif state == TelnetFilter.c_iac:
+                if byte == TelnetFilter.c_sb_byte:
+                    state = TelnetFilter.c_sub
+                elif byte >= TelnetFilter.c_will_byte and byte <= TelnetFilter.c_dont_byte:
+                    # WILL, WONT, DO or DONT are followed by an option byte
+                    state = TelnetFilter.c_option
+                else:
+                    # Two byte command, or an escaped 0xFF which is not
+                    # valid in a command line
+                    state = TelnetFilter.c_data
+            elif state == TelnetFilter.c_option:
+                state = TelnetFilter.c_data
+            elif state == TelnetFilter.c_sub:
+                if byte == TelnetFilter.c_iac_byte:
+                    state = TelnetFilter.c_sub_iac
+            else:
+                # Sub-negotiation ends with IAC SE
+                if byte == TelnetFilter.c_se_byte:
+                    state = TelnetFilter.c_data
+                else:
+                    state = TelnetFilter.c_sub
+        self.m_state = state
+        return out
@@ -34,12 +34,31 @@ import errno
 from uio import IOBase 
 import Log
 import Command
+import Scheduler
+import Deadline
+import TelnetFilter
 
 class TelnetConn(IOBase):
     
     # Class variables
+    # Open client connections, AsyncRuntime connections are kept here too
     c_client_list = list()
-    c_input_buffer = bytearray(512)
+
+    # Function called with the source name of a client host when its last
+    # connection closes, or None
+    c_close_handler = None
+
+    # Size of the per-connection receive buffer
+    c_rx_size = 256
+    # Longest command line accepted
+    c_line_max = 256
+
+    # Most output bytes queued for one client, more output is dropped
+    c_tx_max = 4096
+    # Disconnect a client that accepts no output for this long
+    c_tx_stall_ms = 30000
+    # Appended once when output is dropped
+    c_tx_dropped = b"\r\n... output dropped, client too slow\r\n"
 
     # Initialize instance variable for a new object
     # @param p_client_socket A socket object for read/writing to the attached client
@@ -51,11 +70,41 @@ class TelnetConn(IOBase):
         self.m_client_socket = p_client_socket
         self.m_client_addr = p_client_addr
         self.m_client_port = p_client_port
-        self.m_to_discard = 0
+        # The source name of this connection's commands and rule requests,
+        # the client host, so a later session can release its requests
+        self.m_source = str(p_client_addr)
+        # The next Log entry to send for "log follow", None when not following
+        self.m_follow_index = None
+        self.m_eof = False
+
+        # Bytes are received in bulk into m_rx_buf, stripped of telnet
+        # commands in place, then gathered into m_line_buf until a line
+        # break.  Partial lines carry over to the next read.
+        self.m_rx_buf = bytearray(TelnetConn.c_rx_size)
+        self.m_rx_view = memoryview(self.m_rx_buf)
+        self.m_rx_filter = TelnetFilter.TelnetFilter()
+        self.m_rx_cr = False
+        self.m_line_buf = bytearray(TelnetConn.c_line_max)
+        self.m_line_view = memoryview(self.m_line_buf)
+        self.m_line_len = 0
+        self.m_line_overflow = False
+
+        # Output is queued in m_tx_buf from m_tx_start on, and sent in
+        # as few socket writes as possible
+        self.m_tx_buf = bytearray()
+        self.m_tx_start = 0
+        self.m_tx_dropped = False
+        self.m_tx_waiting = False
+        self.m_tx_stall = Deadline.Deadline()
 
         TelnetConn.c_client_list.append(self)
 
         self.m_client_socket.setblocking(False)
+
+        # Let the Scheduler tell us when input arrives
+        scheduler = Scheduler.Scheduler.c_scheduler
+        if scheduler:
+            scheduler.register_socket(self.m_client_socket, select.POLLIN, self.socket_event)
         #self.m_client_socket.sendall(bytes([255, 252, 34])) # dont allow line mode
         #self.m_client_socket.sendall(bytes([255, 251, 1])) # turn off local echo
 
@@ -80,78 +129,209 @@ class TelnetConn(IOBase):
         uos.dupterm(None, 0)
 
 
-    # Read characters (if any) into p_buffer
+    # Read characters (if any) into p_buffer, used by dupterm
     # @param p_buffer A memory buffer to receive characters into
     # @returns The number of bytes read into p_buffer
     # 
     def readinto(self, p_buffer):
-        readbytes = 0
-        for i in range(len(p_buffer)):
-            try:
-                byte = 0
-                while (byte == 0):
-                    byte = self.m_client_socket.recv(1)[0]
-
-                    # discard telnet control characters and null bytes 
-                    if byte == 0:
-                        continue
-
-                    if byte == 0xFF:
-                        self.m_to_discard = 2
-                        byte = 0
-                        continue
-
-                    if self.m_to_discard > 0:
-                        self.m_to_discard -= 1
-                        byte = 0
-                        continue
-
-                p_buffer[i] = byte
-                readbytes += 1
-
-            except (IndexError, OSError) as e:
-                if type(e) == IndexError or len(e.args) > 0 and e.args[0] == errno.EAGAIN:
-                    # No more bytes in the socket, return and try again later
-                    return readbytes
-                elif type(e) == OSError and len(e.args) > 0:
-                    if e.args[0] == errno.ECONNABORTED or e.args[0] == errno.ECONNRESET or e.args[0] == errno.ENOTCONN:
-                        # Close this connection
-                        self.close()
-                        return 0
-                    else:
-                        # Some other error?
-                        raise
-                else:
-                    # Some other error?
-                    raise
+        count = self.receive(len(p_buffer))
+        p_buffer[0:count] = self.m_rx_view[0:count]
+        return count
+
 
-        return readbytes
+    # Receive whatever the socket has ready into m_rx_buf with a single
+    # call, and strip the telnet commands
+    # @param p_max The most bytes to receive, up to c_rx_size
+    # @returns The number of data bytes now at the start of m_rx_buf
+    #
+    def receive(self, p_max=None):
+        if not self.m_client_socket:
+            return 0
+        if p_max is None or p_max > TelnetConn.c_rx_size:
+            p_max = TelnetConn.c_rx_size
+        try:
+            count = self.m_client_socket.readinto(self.m_rx_view, p_max)
+        except OSError as e:
+            if len(e.args) > 0 and e.args[0] == errno.EAGAIN:
+                # No more bytes in the socket, try again later
+                return 0
+            elif len(e.args) > 0 and (e.args[0] == errno.ECONNABORTED or e.args[0] == errno.ECONNRESET or e.args[0] == errno.ENOTCONN):
+                # Close this connection
+                self.close()
+                return 0
+            else:
+                # Some other error?
+                raise
+        if count is None:
+            # Nothing ready on the non-blocking socket
+            return 0
+        if count == 0:
+            # The client closed the connection
+            self.m_eof = True
+            return 0
+        return self.m_rx_filter.strip(self.m_rx_buf, count)
 
 
-    # Write bytes into the stream 
+    # Gather the received data bytes into the line buffer
+    # @param p_count The number of data bytes at the start of m_rx_buf
+    # @returns A list of the completed lines, partial lines are kept
+    #          for the next read
+    #
+    def take_lines(self, p_count):
+        lines = list()
+        start = 0
+        for i in range(p_count):
+            byte = self.m_rx_buf[i]
+            if byte == 0x0A and self.m_rx_cr:
+                # LF of a CR LF pair, the line was already taken
+                self.m_rx_cr = False
+                start = i + 1
+                continue
+            self.m_rx_cr = byte == 0x0D
+            if byte == 0x0D or byte == 0x0A:
+                self.append_line(start, i)
+                start = i + 1
+                line = self.end_line()
+                if line is not None:
+                    lines.append(line)
+        self.append_line(start, p_count)
+        return lines
+
+
+    # Append bytes of m_rx_buf to the line buffer
+    # @param p_start Index of the first byte in m_rx_buf
+    # @param p_end Index after the last byte in m_rx_buf
+    #
+    def append_line(self, p_start, p_end):
+        count = p_end - p_start
+        if count <= 0:
+            return
+        if self.m_line_len + count > TelnetConn.c_line_max:
+            self.m_line_overflow = True
+            return
+        self.m_line_view[self.m_line_len:self.m_line_len + count] = self.m_rx_view[p_start:p_end]
+        self.m_line_len += count
+
+
+    # Complete the line in the line buffer and empty the buffer
+    # @returns The line as a string, or None if it was too long or
+    #          not valid text
+    #
+    def end_line(self):
+        length = self.m_line_len
+        overflow = self.m_line_overflow
+        self.m_line_len = 0
+        self.m_line_overflow = False
+        if overflow:
+            self.write("Line too long\r\n")
+            return None
+        try:
+            return bytes(self.m_line_view[0:length]).decode()
+        except UnicodeError:
+            return None
+
+
+    # Write bytes into the stream.  The bytes are queued and sent as
+    # soon as the socket accepts them.
     # @param p_buffer A string of one or more characters
-    # @returns The number of bytes written
+    # @returns The number of bytes accepted
     #
     def write(self, p_buffer):
+        count = self.queue(p_buffer)
+        self.flush()
+        return count
+
+
+    # Add output to the queue without sending it.  When the queue nears
+    # c_tx_max it is flushed first, so the limit only applies to output
+    # the client has not accepted yet.
+    # @param p_buffer A string or bytes
+    # @returns The number of bytes queued, 0 if the queue is full
+    #
+    def queue(self, p_buffer):
+        if (not self.m_client_socket):
+            return 0
+        if isinstance(p_buffer, str):
+            p_buffer = p_buffer.encode()
+        pending = len(self.m_tx_buf) - self.m_tx_start
+        if pending + len(p_buffer) > TelnetConn.c_tx_max:
+            self.flush()
+            if not self.m_client_socket:
+                return 0
+            if self.m_tx_start > 0:
+                # Drop the bytes already sent
+                self.m_tx_buf = self.m_tx_buf[self.m_tx_start:]
+                self.m_tx_start = 0
+            pending = len(self.m_tx_buf)
+        if pending + len(p_buffer) > TelnetConn.c_tx_max:
+            # Drop the output, and tell the client once
+            if not self.m_tx_dropped:
+                self.m_tx_dropped = True
+                self.m_tx_buf.extend(TelnetConn.c_tx_dropped)
+            return 0
+        self.m_tx_buf.extend(p_buffer)
+        return len(p_buffer)
+
+
+    # Send as much of the queued output as the socket accepts.  If the
+    # socket is full, ask the Scheduler to call back when it is writable.
+    # @returns The number of bytes sent
+    #
+    def flush(self):
         if (not self.m_client_socket):
             return 0
         bytes_out = 0
-        while (len(p_buffer) > 0):
+        while self.m_tx_start < len(self.m_tx_buf):
             try:
-                written_bytes = self.m_client_socket.write(p_buffer)
-                bytes_out += written_bytes
-                p_buffer = p_buffer[written_bytes:]
+                written_bytes = self.m_client_socket.write(memoryview(self.m_tx_buf)[self.m_tx_start:])
             except OSError as e:
                 if len(e.args) > 0 and e.args[0] == errno.EAGAIN:
-                    # Can't write yet, try again later
+                    written_bytes = None
+                elif len(e.args) > 0 and (e.args[0] == errno.ECONNABORTED or e.args[0] == errno.ECONNRESET or e.args[0] == errno.ENOTCONN):
+                    self.close()
                     return bytes_out
                 else:
                     # Something else...propagate the exception
                     raise
-
+            if not written_bytes:
+                # Can't write yet, try again when the socket is writable
+                break
+            bytes_out += written_bytes
+            self.m_tx_start += written_bytes
+
+        if self.m_tx_start >= len(self.m_tx_buf):
+            # All sent, reuse the buffer
+            self.m_tx_buf = bytearray()
+            self.m_tx_start = 0
+            self.m_tx_dropped = False
+            self.m_tx_stall.cancel()
+            self.wait_writable(False)
+            return bytes_out
+
+        if bytes_out > 0 or not self.m_tx_stall.armed():
+            self.m_tx_stall.start(TelnetConn.c_tx_stall_ms)
+        elif self.m_tx_stall.expired():
+            Log.Log().add(str(self.m_client_addr), "Disconnected client, output stalled")
+            self.close()
+            return bytes_out
+        self.wait_writable(True)
         return bytes_out
 
 
+    # Watch the socket for POLLOUT while output is waiting
+    # @param p_waiting True to watch for POLLOUT
+    #
+    def wait_writable(self, p_waiting):
+        if p_waiting == self.m_tx_waiting:
+            return
+        self.m_tx_waiting = p_waiting
+        scheduler = Scheduler.Scheduler.c_scheduler
+        if scheduler:
+            events = select.POLLIN
+            if p_waiting:
+                events |= select.POLLOUT
+            scheduler.modify_socket(self.m_client_socket, events)
+
 
     # Print a prompt on the terminal
     #
@@ -159,45 +339,101 @@ class TelnetConn(IOBase):
         self.write("> ")
 
 
-    # Poll will check for messages from the Telnet Client and
+    # Send lines that were not requested by a command, such as "log follow"
+    # @param p_lines A list of strings
+    #
+    def push(self, p_lines):
+        for line in p_lines:
+            self.queue(line)
+            self.queue("\r\n")
+        self.flush()
+
+
+    # Poll will check for messages from all Telnet Clients and
     # execute commands as requested
     #
     @classmethod
     def Poll(p_class):
-        # Check for traffic from each Telnet clinet
-        client_list = p_class.c_client_list
-        for client in client_list:
-            len = client.readinto(p_class.c_input_buffer)
-            # Get the string name of Telnet client (usually its IP address)
-            source = str(client.m_client_addr)
-            # print("len=", len)
-            keeplinebreaks = False
-            lines = p_class.c_input_buffer[0:len].splitlines(keeplinebreaks)
-            for line in lines:
-                # Convert binary buffer to string
-                line_decoded = line.decode()
-                # Attempt to parse and execute the specified command line
-                # print(line)
-                (cmd_match, func_result, result_list) = Command.Command.ParseAndExec(line_decoded, source)
-                if (not cmd_match):
-                    pass
-                if (not func_result):
-                    result_list.append('Command failed')
-                for out_line in result_list:
-                    try:
-                        client.m_client_socket.write(out_line)
-                        client.m_client_socket.write("\r\n")
-                    except Exception as e:
-                        # Log the error
-                        pass
-                client.prompt()
+        # Check for traffic from each Telnet client. Iterate over a copy,
+        # a command may close its connection.
+        for client in list(p_class.c_client_list):
+            client.poll()
+            if client.m_client_socket:
+                client.flush()
+
+
+    # Send the waiting output of all Telnet Clients, and disconnect
+    # clients that have not accepted output for c_tx_stall_ms
+    #
+    @classmethod
+    def FlushAll(p_class):
+        for client in list(p_class.c_client_list):
+            if client.m_client_socket and client.m_tx_start < len(client.m_tx_buf):
+                client.flush()
+
+
+    # Called by the Scheduler when the client socket has input or has
+    # been closed by the client
+    # @param p_socket The client socket
+    # @param p_events The select events
+    #
+    def socket_event(self, p_socket, p_events):
+        if p_events & (select.POLLHUP | select.POLLERR):
+            self.close()
+            return
+        if p_events & select.POLLOUT:
+            self.flush()
+        if p_events & select.POLLIN:
+            self.poll()
+
+
+    # Check for messages from this Telnet Client and
+    # execute commands as requested
+    #
+    def poll(self):
+        lines = self.take_lines(self.receive())
+        if self.m_eof:
+            self.close()
+            return
+        for line_decoded in lines:
+            # Attempt to parse and execute the specified command line
+            # print(line)
+            (cmd_match, func_result, result_list) = Command.Command.ParseAndExec(line_decoded, self.m_source, self)
+            if (not cmd_match):
+                pass
+            if (not func_result):
+                result_list.append('Command failed')
+            if not self.m_client_socket:
+                # The command closed this connection
+                return
+            # Queue the whole result, then send it in as few writes as possible
+            for out_line in result_list:
+                self.queue(out_line)
+                self.queue("\r\n")
+            self.queue("> ")
+        self.flush()
+
+
+    # @returns True if another connection from this client host is open
+    #
+    def host_connected(self):
+        for client in TelnetConn.c_client_list:
+            if client.m_source == self.m_source:
+                return True
+        return False
 
 
     # Close the connection
     # 
     def close(self):
-        TelnetConn.c_client_list.remove(self)
+        if self in TelnetConn.c_client_list:
+            TelnetConn.c_client_list.remove(self)
         if (self.m_client_socket):
+            if TelnetConn.c_close_handler and not self.host_connected():
+                TelnetConn.c_close_handler(self.m_source)
+            scheduler = Scheduler.Scheduler.c_scheduler
+            if scheduler:
+                scheduler.unregister_socket(self.m_client_socket)
             self.stop_repl()
             self.m_client_socket.close()
         self.m_client_socket = None
@@ -260,8 +496,14 @@ class TelnetServer:
         server_socket.bind(addr)
         server_socket.listen(p_backlog)
 
-        # Register a callback function for accepting new connections
-        server_socket.setsockopt(socket.SOL_SOCKET, 20, cb_accept_telnet_connect)
+        scheduler = Scheduler.Scheduler.c_scheduler
+        if scheduler:
+            # The Scheduler accepts new connections when the socket is ready
+            server_socket.setblocking(False)
+            scheduler.register_socket(server_socket, select.POLLIN, cb_accept_telnet_connect)
+        else:
+            # Register a callback function for accepting new connections
+            server_socket.setsockopt(socket.SOL_SOCKET, 20, cb_accept_telnet_connect)
 
         # Setup poller
         self.m_poller = select.poll()
@@ -299,8 +541,7 @@ class TelnetServer:
     @classmethod
     def Close(p_class, p_client_name):
         for client in TelnetConn.c_client_list:
-            client_name = str(client.m_client_addr)
-            if client_name == p_client_name:
+            if client.m_source == p_client_name:
                 client.close()
                 return True
         return False
@@ -309,11 +550,17 @@ class TelnetServer:
 # Attach new clients to dupterm and 
 # send telnet control characters to disable line mode
 # and stop local echoing
+# @param p_server_socket The listening socket
+# @param p_events The select events, when called by the Scheduler
 # @returns A ClientWrapper for reading and writing
 #
-def cb_accept_telnet_connect(p_server_socket):
+def cb_accept_telnet_connect(p_server_socket, p_events=None):
 
-    client_socket, client_addr_port = p_server_socket.accept()
+    try:
+        client_socket, client_addr_port = p_server_socket.accept()
+    except OSError:
+        # Nothing to accept after all
+        return
     client_addr = client_addr_port[0]
     client_port = client_addr_port[1]
 
@@ -25,6 +25,9 @@
 
 import time
 
+# Timestamp follows the wall clock, which jumps when NTP sets the RTC.
+# Use it for displaying times, and use Deadline for measuring intervals.
+
 class Timestamp:
 
     # Initialize the new Timestamp to the current time
@@ -45,7 +48,7 @@ class Timestamp:
     # @returns True if this Timestamp has expired
     #
     def expired(self):
-        if (self.m_time + self.m_expire_sec) > time.time():
+        if time.time() >= (self.m_time + self.m_expire_sec):
             return True
 
         return False
@@ -66,7 +69,15 @@ class Timestamp:
     # @returns A human-readable string value of this Timestamp
     #
     def __str__(self):
-        ltime = time.localtime(self.m_time)
+        return Timestamp.Format(self.m_time)
+
+
+    # @param p_time A time in seconds, as from time.time()
+    # @returns A human-readable string value of the time
+    #
+    @staticmethod
+    def Format(p_time):
+        ltime = time.localtime(p_time)
         s = "{:04n}".format(ltime[0])
         s += "/"
         s += "{:02n}".format(ltime[1])
@@ -23,22 +23,43 @@
 # 
 #
 
+import time
+from array import array
 from machine import Pin
 from neopixel import NeoPixel
 import Config
 import GPIO
+import Deferred
+import Metrics
 
 
 class WS281:
 
+    # Class variable holding the WS281 singleton
+    c_ws281 = None
+
+    # Writes to the LED chain
+    c_write_metric = Metrics.Metrics.Counter("ws281 writes")
+
     # Create a NeoPixel driver on a specific GPIO pin
     # @p_pin The output pin driving the NeoPixel signal
     # @p_light_count Number of lights driven on this chaing
     # @p_color_char The color chart from Config
     # @param p_log The logger object for error messages
+    # @param p_frame_buffered When True, set() only marks the frame dirty and
+    #        refresh() pushes the whole chain once per tick. When False every
+    #        set() writes the chain immediately.
+    # @param p_gamma Gamma correction applied to the intensity table, 1.0 is linear
     #
-    def __init__(self, p_pin, p_light_count, p_color_chart, p_log):
+    def __init__(self, p_pin, p_light_count, p_color_chart, p_log, p_frame_buffered=True, p_gamma=1.0):
         self.m_led_count = p_light_count
+        self.m_frame_buffered = p_frame_buffered
+        self.m_dirty = False
+
+        # Statistics for the frame buffer
+        self.m_set_count = 0
+        self.m_write_count = 0
+        self.m_stats_start_ms = time.ticks_ms()
 
         # Set GPIO to output to drive NeoPixels
         self.m_gpio = GPIO.GPIO("WS281", p_pin, Pin.OUT, None, p_log)
@@ -46,9 +67,29 @@ class WS281:
         # create NeoPixel driver the specified GPIO for p_led_count pixels
         self.m_neopixel = NeoPixel(self.m_gpio.m_pin, self.m_led_count)
 
+        # Pixels are written straight into the NeoPixel buffer, so that
+        # set() does not allocate a tuple per pixel in the timer callback
+        self.m_buf = self.m_neopixel.buf
+        self.m_bpp = self.m_neopixel.bpp
+        self.m_offset_r = self.m_neopixel.ORDER[0]
+        self.m_offset_g = self.m_neopixel.ORDER[1]
+        self.m_offset_b = self.m_neopixel.ORDER[2]
+
+        # Errors found in the timer callback are logged later
+        self.m_no_color_id = Deferred.Deferred.RegisterLog("WS281", "No matching color in chart 202410160905")
+
         # Get the WS281 color chart
         self.m_color_chart = p_color_chart
 
+        # Compile the color chart and intensity into lookup tables
+        self.m_color_names = list()
+        self.m_color_index = dict()
+        self.m_color_table = bytearray()
+        self.m_black_index = None
+        self.compile_color_chart(p_color_chart)
+        self.m_brightness = None
+        self.compile_brightness(p_gamma)
+
         self.all_off()
 
 
@@ -67,34 +108,158 @@ class WS281:
     #
     @classmethod
     def InitHardware(p_class, p_config, p_light_count, p_log):
-        WS281.c_ws281 = WS281(p_config.m_ws281_gpio_pin, p_light_count, p_config.m_color_chart, p_log)
+        WS281.c_ws281 = WS281(p_config.m_ws281_gpio_pin, p_light_count, p_config.m_color_chart, p_log, \
+            p_config.m_ws281_frame_buffered, p_config.m_ws281_gamma)
         WS281.c_ws281.all_off()
 
 
+    # Push the frame buffer to the LED chain, if anything changed.
+    # Called once per tick by the Light flash timer.
+    #
+    @classmethod
+    def Refresh(p_class):
+        if p_class.c_ws281:
+            p_class.c_ws281.refresh()
+
+
+    # Compile the color chart from Config into a table of RGB triples
+    # indexed by color number, plus a name to color number dictionary.
+    # "black" is added to the table if the chart does not define it.
+    # @param p_color_chart The color chart from Config
+    #
+    def compile_color_chart(self, p_color_chart):
+        for color in p_color_chart:
+            name = color["name"]
+            if name in self.m_color_index:
+                # First definition wins, same as the old linear search
+                continue
+            self.m_color_index[name] = len(self.m_color_names)
+            self.m_color_names.append(name)
+            self.m_color_table.append(int(color["r"]) & 0xFF)
+            self.m_color_table.append(int(color["g"]) & 0xFF)
+            self.m_color_table.append(int(color["b"]) & 0xFF)
+
+        if "black" not in self.m_color_index:
+            self.m_color_index["black"] = len(self.m_color_names)
+            self.m_color_names.append("black")
+            self.m_color_table.extend(b'\x00\x00\x00')
+        self.m_black_index = self.m_color_index["black"]
+
+
+    # Compute the brightness table for intensities 0% to 100%. Each entry
+    # is a scale factor where 256 is full brightness, so a color channel
+    # is scaled with (c * scale) >> 8 using integer math only.
+    # @param p_gamma Gamma correction, 1.0 is linear
+    #
+    def compile_brightness(self, p_gamma):
+        self.m_brightness = array('H', [0] * 101)
+        for percent in range(101):
+            scale = ((percent / 100.0) ** p_gamma) * 256.0
+            self.m_brightness[percent] = int(scale + 0.5)
+
+
+    # @param p_color_name The name of a color in the color chart
+    # @returns The color number used by set_color(), or None if not in the chart
+    #
+    def color_index(self, p_color_name):
+        return self.m_color_index.get(p_color_name)
+
+
+    # @param p_color_index A color number from color_index()
+    # @returns The name of the color
+    #
+    def color_name(self, p_color_index):
+        if p_color_index is None or p_color_index >= len(self.m_color_names):
+            return None
+        return self.m_color_names[p_color_index]
+
+
     # Turn off all LEDs
     #
     def all_off(self):
         # Turn off all LEDs
         for i in range(self.m_led_count):
             self.set(i, 0, 0, 0)
+        self.refresh()
 
 
-    # Set the RGB values for a specific NeoPixel LED
+    # Set the RGB values for a specific NeoPixel LED. Does not allocate,
+    # safe to call from a timer callback.
     # @param p_led_index The zero-based LED index
-    # @param p_r The Red value 0-255
-    # @param p_g The green value 0-255
-    # @param p_b The blue value 0-255
+    # @param p_r The Red value 0-255, integer
+    # @param p_g The green value 0-255, integer
+    # @param p_b The blue value 0-255, integer
     # @returns True on success, false on invalid index
     #
     def set(self, p_led_index, p_r, p_g, p_b):
         if p_led_index >= self.m_led_count:
             return False
 
-        self.m_neopixel[p_led_index] = (int(p_r), int(p_g), int(p_b))
+        offset = p_led_index * self.m_bpp
+        self.m_buf[offset + self.m_offset_r] = p_r
+        self.m_buf[offset + self.m_offset_g] = p_g
+        self.m_buf[offset + self.m_offset_b] = p_b
+        self.m_set_count += 1
+        if self.m_frame_buffered:
+            # Defer the bus write to the next refresh()
+            self.m_dirty = True
+        else:
+            self.m_neopixel.write()
+            self.m_write_count += 1
+            Metrics.Metrics.Count(WS281.c_write_metric)
+        return True
+
+
+    # Write the frame buffer to the LED chain if any pixel has changed
+    # since the last refresh.
+    # @returns True if the chain was written
+    #
+    def refresh(self):
+        if not self.m_dirty:
+            return False
+        self.m_dirty = False
         self.m_neopixel.write()
+        self.m_write_count += 1
+        Metrics.Metrics.Count(WS281.c_write_metric)
         return True
 
 
+    # Clear the frame buffer statistics
+    #
+    def reset_stats(self):
+        self.m_set_count = 0
+        self.m_write_count = 0
+        self.m_stats_start_ms = time.ticks_ms()
+
+
+    # Report the frame buffer statistics. Without the frame buffer every
+    # pixel update costs one write of the chain, so the saving is the
+    # difference between the number of updates and the actual writes.
+    # @returns A list of strings
+    #
+    def get_stats(self):
+        out = list()
+        elapsed_ms = time.ticks_diff(time.ticks_ms(), self.m_stats_start_ms)
+        saved = self.m_set_count - self.m_write_count
+        msg = "frame-buffered: "
+        msg += str(self.m_frame_buffered)
+        out.append(msg)
+        msg = "pixel updates: "
+        msg += str(self.m_set_count)
+        msg += ", chain writes: "
+        msg += str(self.m_write_count)
+        msg += ", writes saved: "
+        msg += str(saved)
+        out.append(msg)
+        if elapsed_ms > 0:
+            msg = "writes/sec: "
+            msg += str((self.m_write_count * 1000) // elapsed_ms)
+            msg += ", writes saved/sec: "
+            msg += str((saved * 1000) // elapsed_ms)
+            out.append(msg)
+        return out
+
+
     # Get the value of the specified NeoPixel LED
     # @param p_led_index The zero-based LED index
     # @returns (r, g, b) values of the LED, or None, None, None
@@ -107,24 +272,30 @@ class WS281:
         return self.m_neopixel[p_led_index]
 
 
-    # Set the specified LED according to the color name
+    # Set the specified LED according to the color number. Does not
+    # allocate, safe to call from a timer callback.
     # @param p_led_index The zero-based LED index
-    # @param p_color_name The name of the color to set
+    # @param p_color_index The color number from color_index()
     # @param p_intensity Brightness of the color as a percentage, 0% to 100%
-    # @param p_log Log to write errors to
-    # @returns True on success, false on invalid index or color name
+    # @param p_log Unused, errors are reported through the Deferred queue
+    # @returns True on success, false on invalid index or color number
     #
-    def set_color(self, p_led_index, p_color_name, p_intensity, p_log):
-        for color in self.m_color_chart:
-            if color["name"] == p_color_name:
-                r = int(color["r"])
-                g = int(color["g"])
-                b = int(color["b"])
-                if (p_intensity < 100):
-                    r = (r * p_intensity) / 100
-                    g = (g * p_intensity) / 100
-                    b = (b * p_intensity) / 100
-                return self.set(p_led_index, r, g, b)
-        p_log.add("WS281", "No matching color in chart 202410160905")
-        return False
+    def set_color(self, p_led_index, p_color_index, p_intensity, p_log):
+        if p_color_index is None or p_color_index >= len(self.m_color_names):
+            Deferred.Deferred.Post(self.m_no_color_id)
+            return False
+
+        if p_intensity >= 100:
+            scale = 256
+        elif p_intensity <= 0:
+            scale = 0
+        else:
+            scale = self.m_brightness[p_intensity]
+
+        offset = p_color_index * 3
+        table = self.m_color_table
+        r = (table[offset] * scale) >> 8
+        g = (table[offset + 1] * scale) >> 8
+        b = (table[offset + 2] * scale) >> 8
+        return self.set(p_led_index, r, g, b)
 
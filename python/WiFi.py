@@ -30,6 +30,11 @@ import machine
 import ntptime
 import Log
 import Config
+import Deadline
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 
 class WiFi:
@@ -37,6 +42,18 @@ class WiFi:
     # The class object holding the singleton WiFi object
     c_wifi = None
 
+    # States of a reconnection started by maintain()
+    c_idle = 0
+    c_activating = 1
+    c_connecting = 2
+
+    # Time allowed for the interface to start before connecting
+    c_activate_ms = 1000
+    # Time allowed for the Router/AP to accept the connection
+    c_connect_timeout_ms = 20000
+    # Time between connection checks while reconnecting
+    c_connect_poll_ms = 250
+
     # Intialize the object as a Station that will connect to a Router
     # or Access Point
     # @param p_config Reference to the main Configuration object
@@ -58,8 +75,14 @@ class WiFi:
 
         # Update using NTP every hour
         self.m_ntp_update_sec = 1 * 60 * 60
-        # Last time an NTP update occurred
-        self.m_ntp_last_update = 0
+        # Time of the next NTP update, due immediately
+        self.m_ntp_deadline = Deadline.Deadline()
+        self.m_ntp_deadline.start(0)
+
+        # Reconnection from maintain() is a non-blocking state machine,
+        # one of c_idle, c_activating or c_connecting
+        self.m_connect_state = WiFi.c_idle
+        self.m_connect_deadline = Deadline.Deadline()
 
         WiFi.c_wifi = self
 
@@ -69,33 +92,7 @@ class WiFi:
     #
     def connect(self):
         if not self.m_wifi.isconnected():
-            s = 'WiFi connecting to network...'
-            self.m_log.add(self.m_hostname, s)
-            print(s)
-            self.m_wifi.active(True)
-
-            # Limit the transmit power, otherwise the board will reboot
-            if (sys.platform == 'esp8266'):
-                # txpower Not support in ESP8266
-                pass
-            else:
-                s = "default txpower=" + str(self.m_wifi.config('txpower'))
-                self.m_log.add(self.m_hostname, s)
-                print(s)
-                self.m_wifi.config(txpower = 7.0)
-                s = "configured txpower=" + str(self.m_wifi.config('txpower'))
-                self.m_log.add(self.m_hostname, s)
-                print(s)
-
-            # Set hostname
-            print("Setting hostname:", self.m_hostname)
-            wifi_hostname = self.m_hostname
-            no_local = self.m_hostname.split(".")
-            if no_local.pop() == "local":
-                wifi_hostname = no_local[0]
-            #print("Setting wifi_hostname:", wifi_hostname)
-            self.m_wifi.config(dhcp_hostname = wifi_hostname)
-
+            self.begin_connect()
             time.sleep(1)
             self.m_wifi.connect(self.m_ssid, self.m_password)
 
@@ -105,6 +102,45 @@ class WiFi:
                 if self.m_wifi.isconnected():
                     break
 
+        self.end_connect()
+        return True
+
+
+    # Prepare the interface for connecting to the Router/AP
+    #
+    def begin_connect(self):
+        s = 'WiFi connecting to network...'
+        self.m_log.add(self.m_hostname, s)
+        print(s)
+        self.m_wifi.active(True)
+
+        # Limit the transmit power, otherwise the board will reboot
+        if (sys.platform == 'esp8266'):
+            # txpower Not support in ESP8266
+            pass
+        else:
+            s = "default txpower=" + str(self.m_wifi.config('txpower'))
+            self.m_log.add(self.m_hostname, s)
+            print(s)
+            self.m_wifi.config(txpower = 7.0)
+            s = "configured txpower=" + str(self.m_wifi.config('txpower'))
+            self.m_log.add(self.m_hostname, s)
+            print(s)
+
+        # Set hostname
+        print("Setting hostname:", self.m_hostname)
+        wifi_hostname = self.m_hostname
+        no_local = self.m_hostname.split(".")
+        if no_local.pop() == "local":
+            wifi_hostname = no_local[0]
+        #print("Setting wifi_hostname:", wifi_hostname)
+        self.m_wifi.config(dhcp_hostname = wifi_hostname)
+
+
+    # Finish a connection to the Router/AP, update the clock and
+    # get the DHCP configuration
+    #
+    def end_connect(self):
         # Update time with NTP
         self.update_clock_ntp()
 
@@ -117,8 +153,6 @@ class WiFi:
         self.m_wifi_router = config[2]
         self.m_wifi_dns = config[3]
 
-        return True
-
 
     # Disconnect from the WiFi Router/AP
     #
@@ -127,21 +161,72 @@ class WiFi:
         self.m_wifi.active(False)
 
 
-    # Perform periodic tasks here, called from Main.py loop
+    # Perform periodic tasks here, called from the AsyncRuntime WiFi task.
+    # A lost connection is restarted by the maintain() state machine, which
+    # times out and retries, yielding to the other tasks between steps.
+    # @returns True once connected
     #
     async def poll(self):
+        while not self.maintain():
+            await asyncio.sleep(self.next_maintain_ms() / 1000)
+        return True
+
+
+
+    # Perform periodic tasks here, called from the Main.py Scheduler.
+    # A lost connection is restarted in steps across several calls, so
+    # this never waits for the Router/AP and the watchdog keeps being fed.
+    # @returns True if connected
+    #
+    def maintain(self):
+        if self.m_wifi.isconnected():
+            if self.m_connect_state != WiFi.c_idle:
+                self.m_connect_state = WiFi.c_idle
+                self.m_connect_deadline.cancel()
+                self.end_connect()
+            else:
+                # Time to update local clock from NTP?
+                self.update_clock_ntp()
+            return True
+
         # Reconnect if we lost connectivity
-        if not self.m_wifi.isconnected():
-            return self.connect()
+        if self.m_connect_state == WiFi.c_idle:
+            self.begin_connect()
+            self.m_connect_state = WiFi.c_activating
+            self.m_connect_deadline.start(WiFi.c_activate_ms)
+        elif not self.m_connect_deadline.expired():
+            # Still waiting
+            pass
+        elif self.m_connect_state == WiFi.c_activating:
+            self.m_wifi.connect(self.m_ssid, self.m_password)
+            self.m_connect_state = WiFi.c_connecting
+            self.m_connect_deadline.start(WiFi.c_connect_timeout_ms)
+        else:
+            msg = "WiFi connection timed out after "
+            msg += str(WiFi.c_connect_timeout_ms)
+            msg += "ms, retrying 202610171113"
+            self.m_log.add(self.m_hostname, msg)
+            self.m_wifi.disconnect()
+            self.m_connect_state = WiFi.c_idle
+        return False
 
-        # Perform Wifi background processing
-        await uasyncio.sleep(0)
 
-        # Time to update local clock from NTP?
-        self.update_clock_ntp()
+    # @returns Milliseconds until the next NTP update is due
+    #
+    def next_ntp_ms(self):
+        return self.m_ntp_deadline.remaining_ms()
 
-        return True
 
+    # @returns Milliseconds until maintain() has work to do, the next step of
+    #          a reconnection or the next NTP update
+    #
+    def next_maintain_ms(self):
+        if self.m_connect_state == WiFi.c_idle:
+            return self.next_ntp_ms()
+        remaining = self.m_connect_deadline.remaining_ms()
+        if remaining is None or remaining > WiFi.c_connect_poll_ms:
+            return WiFi.c_connect_poll_ms
+        return remaining
 
 
     # Provide the Received Signal Strength Indicator
@@ -267,7 +352,9 @@ class WiFi:
     #
     def update_clock_ntp(self):
         # Time to update local clock from NTP?
-        if time.time() > self.m_ntp_last_update:
+        # This uses ticks_ms(), so it is not affected by the clock
+        # change made here
+        if self.m_ntp_deadline.expired():
             ntptime.host = self.m_config.m_ntp_host
             ntptime.timeout = self.m_config.m_ntp_timeout_sec
             ntptime.settime()
@@ -277,7 +364,7 @@ class WiFi:
                 new_time = new_time + self.m_config.m_tz_offset_sec
                 tm = time.gmtime(new_time)
                 machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
-            self.m_ntp_last_update = time.time() + self.m_ntp_update_sec
+            self.m_ntp_deadline.start(self.m_ntp_update_sec * 1000)
 
 
     # Destructor will disconnect
@@ -0,0 +1,354 @@
+#
+# Host-side fleet rules compiler
+#
+# Copyright (C) 2021-2026 Daris A Nevil - International Brotherhood of Live Steamers
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# DARIS A NEVIL, OR ANY OTHER CONTRIBUTORS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE
+# OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# 
+#
+
+
+# Compile the rules of a fleet of signals on the host.
+#
+# Each signal config is evaluated against each rules file with the same
+# Config, Rules and Aspect code that runs on the signal, using stand-ins
+# for the hardware modules.  For every signal a pruned rules file is
+# written holding only the rules the signal can display, each with only
+# its matching aspect, so the signal loads and stores only what it needs.
+# A coverage matrix of signals by rules is written for each rules file.
+#
+# The signals are evaluated in a process pool, one signal per process,
+# because the repo modules keep the lights and semaphores of a signal in
+# class variables.
+#
+# Usage:
+#   python3 tools/fleet_compile.py python rules -o fleet
+#   python3 tools/fleet_compile.py configs/ rules/atsf1959_rules_ss2.json -j 8
+#
+
+import argparse
+import csv
+import glob
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+
+# The signal code is in ../python
+c_python_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+
+# Optional config keys only used at runtime, filled in when missing
+c_runtime_defaults = {
+    "state-file": "",
+    "tz-offset-sec": 0,
+    "tz-abbrev": "UTC",
+    "ntp-host": "pool.ntp.org",
+    "ntp-timeout-sec": 1,
+}
+
+
+# Stand-in for machine.Pin, machine.PWM, machine.Timer, machine.ADC and
+# machine.WDT.  Accepts any arguments and does nothing.
+#
+class StandIn:
+
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+    PERIODIC = 1
+    ONE_SHOT = 0
+    ATTN_11DB = 3
+
+    def __init__(self, *p_args, **p_kwargs):
+        self.m_value = 0
+
+    def value(self, p_value=None):
+        if p_value is None:
+            return self.m_value
+        self.m_value = p_value
+
+    def __getattr__(self, p_name):
+        return lambda *p_args, **p_kwargs: None
+
+
+# Stand-in for neopixel.NeoPixel, with the buffer layout used by WS281
+#
+class NeoPixelStandIn:
+
+    ORDER = (1, 0, 2, 3)
+
+    def __init__(self, p_pin, p_count, bpp=3, timing=1):
+        self.n = p_count
+        self.bpp = bpp
+        self.buf = bytearray(p_count * bpp)
+
+    def write(self):
+        pass
+
+    def deinit(self):
+        pass
+
+
+# Install stand-ins for the MicroPython modules imported by the signal code.
+# Must be called before importing Config, Rules or Aspect.
+#
+def install_standins():
+    machine = types.ModuleType("machine")
+    for name in ("Pin", "PWM", "Timer", "ADC", "WDT"):
+        setattr(machine, name, StandIn)
+    machine.disable_irq = lambda: 0
+    machine.enable_irq = lambda p_state: None
+    machine.unique_id = lambda: b"\x00\x00\x00\x00"
+    machine.reset = lambda: None
+    sys.modules.setdefault("machine", machine)
+
+    neopixel = types.ModuleType("neopixel")
+    neopixel.NeoPixel = NeoPixelStandIn
+    sys.modules.setdefault("neopixel", neopixel)
+
+    micropython = types.ModuleType("micropython")
+    micropython.const = lambda p_value: p_value
+    micropython.schedule = lambda p_func, p_arg: p_func(p_arg)
+    sys.modules.setdefault("micropython", micropython)
+
+    # time.ticks_ms() and friends, with the 30-bit wrap of the ESP32 port
+    if not hasattr(time, "ticks_ms"):
+        mask = 0x3fffffff
+        def ticks_diff(p_end, p_start):
+            diff = (p_end - p_start) & mask
+            if diff >= 0x20000000:
+                diff -= 0x40000000
+            return diff
+        time.ticks_ms = lambda: int(time.monotonic() * 1000) & mask
+        time.ticks_us = lambda: int(time.monotonic() * 1000000) & mask
+        time.ticks_add = lambda p_ticks, p_delta: (p_ticks + p_delta) & mask
+        time.ticks_diff = ticks_diff
+
+    if c_python_dir not in sys.path:
+        sys.path.insert(0, c_python_dir)
+
+
+# Compile the rules of one signal
+# @param p_job A tuple of (config file, list of rules files, output directory)
+# @returns A dict with the signal name, the rule numbers kept for each rules
+#          file, and any log messages
+#
+def compile_signal(p_job):
+    (config_file, rule_files, out_dir) = p_job
+    install_standins()
+    import Config
+    import Log
+    import Light
+    import WS281
+    import Aspect
+    import Rules
+
+    signal = os.path.basename(config_file)
+    result = dict()
+    result["signal"] = signal
+    result["rules-file"] = None
+    result["rules"] = dict()
+    result["default"] = dict()
+    result["log"] = list()
+
+    # Fill in runtime-only keys, and never touch the rules cache
+    fs = io.open(config_file, "r")
+    config = json.load(fs)
+    fs.close()
+    for name in c_runtime_defaults:
+        if name not in config:
+            config[name] = c_runtime_defaults[name]
+    config["rules-cache-file"] = ""
+    (fd, tmp_file) = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as fs:
+        json.dump(config, fs)
+
+    log = Log.Log()
+    try:
+        cfg = Config.Config(tmp_file, log)
+        result["rules-file"] = os.path.basename(cfg.m_rules_file)
+        WS281.WS281.InitHardware(cfg, Light.Light.Count(), log)
+        for rule_file in rule_files:
+            rules = Rules.Rules(rule_file, cfg, log)
+            kept = list()
+            pruned = list()
+            for rule in rules.m_rule_list:
+                kept.append(rule.m_rule)
+                rd = dict()
+                rd["rule"] = rule.m_rule
+                rd["name"] = rule.m_name
+                rd["indication"] = rule.m_indication
+                rd["priority"] = rule.m_priority
+                rd["aspect"] = [rule.m_aspect.m_aspect_commands]
+                pruned.append(rd)
+            rd = dict()
+            rd["rule-set"] = rules.m_rule_set
+            rd["rule-set-source"] = rules.m_source
+            rd["author"] = rules.m_author
+            rd["default-rule"] = rules.m_default_rule_number
+            rd["rules"] = pruned
+            if out_dir:
+                signal_dir = os.path.join(out_dir, signal)
+                os.makedirs(signal_dir, exist_ok=True)
+                fs = io.open(os.path.join(signal_dir, os.path.basename(rule_file)), "w")
+                json.dump(rd, fs, indent=2)
+                fs.close()
+            key = os.path.basename(rule_file)
+            result["rules"][key] = kept
+            result["default"][key] = rules.find_rule(rules.m_default_rule_number) is not None
+            Aspect.Aspect.ClearCache()
+    finally:
+        os.remove(tmp_file)
+
+    for index in range(log.get_num_entries()):
+        (entry_time, source, text) = log.get_entry(index)
+        result["log"].append(source + ": " + text)
+    return result
+
+
+# @param p_rule_file A rules file
+# @returns The list of all rule numbers in the rules file
+#
+def rule_numbers(p_rule_file):
+    fs = io.open(p_rule_file, "r")
+    rd = json.load(fs)
+    fs.close()
+    numbers = list()
+    for rule in rd["rules"]:
+        if rule["rule"] not in numbers:
+            numbers.append(rule["rule"])
+    return numbers
+
+
+# Write the coverage matrix of one rules file as CSV, one row per signal
+# and one column per rule, "x" where the signal can display the rule
+# @param p_file The CSV file to write
+# @param p_numbers All rule numbers of the rules file
+# @param p_results The results of compile_signal()
+# @param p_key The rules file name in the results
+#
+def write_coverage(p_file, p_numbers, p_results, p_key):
+    fs = io.open(p_file, "w", newline="")
+    writer = csv.writer(fs)
+    writer.writerow(["signal"] + p_numbers)
+    for result in p_results:
+        kept = result["rules"][p_key]
+        row = [result["signal"]]
+        for number in p_numbers:
+            row.append("x" if number in kept else "")
+        writer.writerow(row)
+    fs.close()
+
+
+# Print the coverage matrix of one rules file
+# @param p_numbers All rule numbers of the rules file
+# @param p_results The results of compile_signal()
+# @param p_key The rules file name in the results
+#
+def print_coverage(p_numbers, p_results, p_key):
+    width = 8
+    for result in p_results:
+        width = max(width, len(result["signal"]))
+    column = 1
+    for number in p_numbers:
+        column = max(column, len(str(number)))
+    print(p_key)
+    print(" " * width + " " + " ".join("{:>{}}".format(str(n), column) for n in p_numbers) + "  kept")
+    for result in p_results:
+        kept = result["rules"][p_key]
+        s = "{:<{}}".format(result["signal"], width) + " "
+        s += " ".join("{:>{}}".format("x" if n in kept else ".", column) for n in p_numbers)
+        s += "  {}/{}".format(len(kept), len(p_numbers))
+        if not result["default"][p_key]:
+            s += "  no default rule"
+        print(s)
+    print()
+
+
+def main(p_argv=None):
+    parser = argparse.ArgumentParser(description="Compile pruned rules files and a coverage matrix for a fleet of signals")
+    parser.add_argument("configs", help="Directory of signal configs, or a single config file")
+    parser.add_argument("rules", nargs="+", help="Rules files, or a directory of *.json rules files")
+    parser.add_argument("-o", "--out", default="fleet", help="Output directory (default: fleet)")
+    parser.add_argument("-p", "--pattern", default="config.json*", help="Config file name pattern (default: config.json*)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print the coverage matrix")
+    args = parser.parse_args(p_argv)
+
+    if os.path.isdir(args.configs):
+        config_files = sorted(glob.glob(os.path.join(args.configs, args.pattern)))
+    else:
+        config_files = [args.configs]
+    rule_files = list()
+    for path in args.rules:
+        if os.path.isdir(path):
+            rule_files += sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            rule_files.append(path)
+    if not config_files or not rule_files:
+        parser.error("no configs or no rules files found")
+
+    # Import the signal code once in the parent, so a forked worker starts
+    # with the modules loaded but no signal configured
+    install_standins()
+    import Rules
+
+    start = time.time()
+    jobs = [(config_file, rule_files, args.out) for config_file in config_files]
+    pool = multiprocessing.Pool(args.jobs, maxtasksperchild=1)
+    try:
+        results = pool.map(compile_signal, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+
+    # A signal must be able to display the default rule of its own rules file
+    failed = False
+    for result in results:
+        for line in result["log"]:
+            print(result["signal"] + ": " + line, file=sys.stderr)
+        key = result["rules-file"]
+        if key in result["default"] and not result["default"][key]:
+            print(result["signal"] + ": cannot display the default rule of " + key, file=sys.stderr)
+            failed = True
+
+    for rule_file in rule_files:
+        key = os.path.basename(rule_file)
+        numbers = rule_numbers(rule_file)
+        write_coverage(os.path.join(args.out, "coverage-" + os.path.splitext(key)[0] + ".csv"), numbers, results, key)
+        if not args.quiet:
+            print_coverage(numbers, results, key)
+
+    print("Compiled {} signals against {} rules files in {:.2f}s".format(len(results), len(rule_files), elapsed))
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())